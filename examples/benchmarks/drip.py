@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""\
+Usage: %prog [options]
+
+  Measure how long DiazoMiddleware takes to theme a response after the last
+  byte arrives from a slow upstream application. The application yields the
+  page in CHUNK byte chunks, sleeping DELAY milliseconds before each one.
+  When the response is parsed as the chunks arrive, the time after the last
+  byte stays small however slowly the body is sent.\
+"""
+usage = __doc__
+
+import os.path
+import time
+
+from optparse import OptionParser
+from webob import Request
+
+from diazo.wsgi import DiazoMiddleware
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+def make_application(paragraphs, chunk_size, delay, finished):
+    """Return a WSGI application dripping out a page, which appends the time
+    it sent the last chunk to the list ``finished``.
+    """
+    body = '<html><body><div id="content">%s</div></body></html>' % ''.join(
+        ['<p class="c">para %d</p>' % i for i in range(paragraphs)])
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+    def application(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/html')])
+        for chunk in chunks:
+            time.sleep(delay)
+            yield chunk
+        finished.append(time.time())
+    application.chunks = len(chunks)
+    return application
+
+def main():
+    """Called from console script
+    """
+    parser = OptionParser(usage=usage)
+    parser.add_option("-n", "--requests", metavar="REQUESTS", type="int",
+                      help="Number of requests, the fastest is reported (default 5)",
+                      dest="requests", default=5)
+    parser.add_option("-p", "--paragraphs", metavar="PARAGRAPHS", type="int",
+                      help="Paragraphs in the themed page (default 40000)",
+                      dest="paragraphs", default=40000)
+    parser.add_option("-c", "--chunk", metavar="CHUNK", type="int",
+                      help="Bytes in each chunk (default 16384)",
+                      dest="chunk", default=16384)
+    parser.add_option("-d", "--delay", metavar="DELAY", type="float",
+                      help="Milliseconds to wait before each chunk (default 5)",
+                      dest="delay", default=5.0)
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error("Wrong number of arguments.")
+
+    finished = []
+    application = make_application(options.paragraphs, options.chunk,
+                                   options.delay / 1000, finished)
+    middleware = DiazoMiddleware(application, {}, os.path.join(HERE, 'rules.xml'))
+    # Compile the theme before measuring
+    Request.blank('/').get_response(middleware)
+    totals = []
+    tails = []
+    for i in range(options.requests):
+        start = time.time()
+        Request.blank('/').get_response(middleware)
+        end = time.time()
+        totals.append(end - start)
+        tails.append(end - finished[-1])
+    print '%d chunks: total %.1f ms, after the last chunk %.1f ms' % (
+        application.chunks, min(totals) * 1000, min(tails) * 1000)
+
+if __name__ == '__main__':
+    main()
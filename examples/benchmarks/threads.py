@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""\
+Usage: %prog [options]
+
+  Measure the throughput of DiazoMiddleware when one middleware instance
+  serves requests from several threads at once. Each thread requests a
+  generated page of PARAGRAPHS paragraphs until REQUESTS requests have been
+  made in total, and the requests per second are printed for each number of
+  threads.\
+"""
+usage = __doc__
+
+import os.path
+import threading
+import time
+
+from optparse import OptionParser
+from webob import Request
+
+from diazo.wsgi import DiazoMiddleware
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+def make_application(paragraphs):
+    body = '<html><body><div id="content">%s</div></body></html>' % ''.join(
+        ['<p class="c">para %d</p>' % i for i in range(paragraphs)])
+    def application(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/html')])
+        return [body]
+    return application
+
+def measure(middleware, threads, requests):
+    """Return the requests per second served by ``threads`` threads making
+    ``requests`` requests between them.
+    """
+    errors = []
+    def run():
+        for i in range(requests // threads):
+            response = Request.blank('/').get_response(middleware)
+            if response.status_int != 200:
+                errors.append(response.status)
+    workers = [threading.Thread(target=run) for i in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+    if errors:
+        raise AssertionError("Unexpected responses: %s" % ', '.join(errors))
+    return (requests // threads) * threads / elapsed
+
+def main():
+    """Called from console script
+    """
+    parser = OptionParser(usage=usage)
+    parser.add_option("-n", "--requests", metavar="REQUESTS", type="int",
+                      help="Total number of requests for each run (default 200)",
+                      dest="requests", default=200)
+    parser.add_option("-p", "--paragraphs", metavar="PARAGRAPHS", type="int",
+                      help="Paragraphs in the themed page (default 2000)",
+                      dest="paragraphs", default=2000)
+    parser.add_option("-t", "--threads", metavar="1,2,4,8",
+                      help="Comma separated numbers of threads to measure",
+                      dest="threads", default="1,2,4,8")
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error("Wrong number of arguments.")
+
+    middleware = DiazoMiddleware(make_application(options.paragraphs), {},
+                                 os.path.join(HERE, 'rules.xml'))
+    # Compile the theme before measuring
+    Request.blank('/').get_response(middleware)
+    for threads in [int(value) for value in options.threads.split(',')]:
+        print '%d threads: %.1f requests/second' % (
+            threads, measure(middleware, threads, options.requests))
+
+if __name__ == '__main__':
+    main()
@@ -16,12 +16,26 @@
     <xsl:param name="esisuffix"></xsl:param>
     <xsl:param name="esiquerysuffix">;filter_xpath=</xsl:param>
 
+    <!-- Rules and themes whose conditions are tested in the theme templates -->
+    <xsl:key name="merged-conditions"
+        match="diazo:*[@theme or self::diazo:theme or self::diazo:notheme]"
+        use="@merged-condition"/>
+
     <xsl:template match="@*|node()">
         <xsl:copy>
             <xsl:apply-templates select="@*|node()"/>
         </xsl:copy>
     </xsl:template>
 
+    <!--
+        Each distinct condition is evaluated once, in a global variable named
+        after the first rule with that condition.
+    -->
+    <xsl:template match="diazo:*[@theme or self::diazo:theme or self::diazo:notheme]/@merged-condition">
+        <xsl:copy/>
+        <xsl:attribute name="condition-variable">diazo-condition-<xsl:value-of select="generate-id(key('merged-conditions', .)[1])"/></xsl:attribute>
+    </xsl:template>
+
     <xsl:template match="diazo:drop[@content]">
         <xsl:if test="@theme">
             <xsl:call-template name="error-message" select=".">
@@ -92,8 +92,8 @@
                 <xsl:element name="xsl:choose">
                     <xsl:element name="xsl:when">
                         <xsl:attribute name="test">
-                            <xsl:for-each select="$matching-this/@merged-condition">
-                                <xsl:text>(</xsl:text><xsl:value-of select="."/><xsl:text>)</xsl:text>
+                            <xsl:for-each select="$matching-this/@condition-variable">
+                                <xsl:text>$</xsl:text><xsl:value-of select="."/>
                                 <xsl:if test="position() != last()">
                                     <xsl:text> or </xsl:text>
                                 </xsl:if>
@@ -146,7 +146,7 @@
                     <xsl:for-each select="$conditional">
                         <xsl:element name="xsl:when">
                             <xsl:attribute name="test">
-                                <xsl:value-of select="@merged-condition"/>
+                                <xsl:text>$</xsl:text><xsl:value-of select="@condition-variable"/>
                             </xsl:attribute>
                             <xsl:apply-templates select="." mode="include"/>
                         </xsl:element>
@@ -209,8 +209,8 @@
                 <xsl:element name="xsl:choose">
                     <xsl:element name="xsl:when">
                         <xsl:attribute name="test">
-                            <xsl:for-each select="$matching-this/@merged-condition">
-                                <xsl:text>(</xsl:text><xsl:value-of select="."/><xsl:text>)</xsl:text>
+                            <xsl:for-each select="$matching-this/@condition-variable">
+                                <xsl:text>$</xsl:text><xsl:value-of select="."/>
                                 <xsl:if test="position() != last()">
                                     <xsl:text> or </xsl:text>
                                 </xsl:if>
@@ -278,8 +278,8 @@
                     <xsl:element name="xsl:if">
                         <xsl:attribute name="test">
                             <xsl:text>not(</xsl:text>
-                            <xsl:for-each select="$conditional-drop-some[contains(@attributes, concat(' ', name($current-attr), ' '))]/@merged-condition">
-                                <xsl:text>(</xsl:text><xsl:value-of select="."/><xsl:text>)</xsl:text>
+                            <xsl:for-each select="$conditional-drop-some[contains(@attributes, concat(' ', name($current-attr), ' '))]/@condition-variable">
+                                <xsl:text>$</xsl:text><xsl:value-of select="."/>
                                 <xsl:if test="position() != last()">
                                     <xsl:text> or </xsl:text>
                                 </xsl:if>
@@ -298,8 +298,8 @@
                 <xsl:element name="xsl:if">
                     <xsl:attribute name="test">
                         <xsl:text>not(</xsl:text>
-                        <xsl:for-each select="$conditional-drop-all/@merged-condition">
-                            <xsl:text>(</xsl:text><xsl:value-of select="."/><xsl:text>)</xsl:text>
+                        <xsl:for-each select="$conditional-drop-all/@condition-variable">
+                            <xsl:text>$</xsl:text><xsl:value-of select="."/>
                             <xsl:if test="position() != last()">
                                 <xsl:text> or </xsl:text>
                             </xsl:if>
@@ -319,8 +319,8 @@
                         <xsl:element name="xsl:if">
                             <xsl:attribute name="test">
                                 <xsl:text>not(</xsl:text>
-                                <xsl:for-each select="$conditional-drop-some[contains(@attributes, concat(' ', name($current-attr), ' '))]/@merged-condition">
-                                    <xsl:text>(</xsl:text><xsl:value-of select="."/><xsl:text>)</xsl:text>
+                                <xsl:for-each select="$conditional-drop-some[contains(@attributes, concat(' ', name($current-attr), ' '))]/@condition-variable">
+                                    <xsl:text>$</xsl:text><xsl:value-of select="."/>
                                     <xsl:if test="position() != last()">
                                         <xsl:text> or </xsl:text>
                                     </xsl:if>
@@ -348,7 +348,7 @@
             <xsl:choose>
                 <xsl:when test="@merged-condition">
                     <xsl:element name="xsl:if">
-                        <xsl:attribute name="test"><xsl:value-of select="@merged-condition"/></xsl:attribute>
+                        <xsl:attribute name="test"><xsl:text>$</xsl:text><xsl:value-of select="@condition-variable"/></xsl:attribute>
                         <xsl:element name="xsl:apply-templates">
                             <xsl:attribute name="select"><xsl:value-of select="@content"/><xsl:choose>
                                 <xsl:when test="contains($attributes, ' * ')">/@*</xsl:when>
@@ -370,6 +370,7 @@
 
         <xsl:for-each select="$matching-this[@action='merge']">
             <xsl:variable name="merged-condition" select="@merged-condition"/>
+            <xsl:variable name="condition-variable" select="@condition-variable"/>
             <xsl:variable name="content" select="@content"/>
             <xsl:variable name="separator" select="@separator"/>
             <xsl:variable name="attributes" select="str:tokenize(@attributes)"/>
@@ -379,7 +380,7 @@
                 <xsl:choose>
                     <xsl:when test="$merged-condition">
                         <xsl:element name="xsl:if">
-                            <xsl:attribute name="test"><xsl:value-of select="$merged-condition"/></xsl:attribute>
+                            <xsl:attribute name="test"><xsl:text>$</xsl:text><xsl:value-of select="$condition-variable"/></xsl:attribute>
                             <xsl:element name="xsl:attribute">
                                 <xsl:attribute name="name"><xsl:value-of select="."/></xsl:attribute><xsl:if test="$context-attr"><xsl:value-of select="$context-attr"/><xsl:value-of select="$separator"/></xsl:if><xsl:element name="xsl:value-of">
                                     <xsl:attribute name="select"><xsl:value-of select="$content"/>/@<xsl:value-of select="."/></xsl:attribute>
@@ -437,7 +438,7 @@
                                     <xsl:text>&#10;</xsl:text>
                                     <xsl:element name="xsl:when">
                                         <xsl:attribute name="test">
-                                            <xsl:value-of select="@merged-condition"/>
+                                            <xsl:text>$</xsl:text><xsl:value-of select="@condition-variable"/>
                                         </xsl:attribute>
                                         <xsl:apply-templates select="." mode="include"/>
                                     </xsl:element>
@@ -488,7 +489,7 @@
             <xsl:when test="@merged-condition">
                 <xsl:element name="xsl:if">
                     <xsl:attribute name="test">
-                        <xsl:value-of select="@merged-condition"/>
+                        <xsl:text>$</xsl:text><xsl:value-of select="@condition-variable"/>
                     </xsl:attribute>
                     <xsl:apply-templates mode="include" select="."/>
                 </xsl:element>
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""\
+Usage: %prog [options] MANIFEST
+
+  Compile many themes in parallel. MANIFEST is an ini file with a section for
+  each compiled theme, e.g:
+
+    [DEFAULT]
+    absolute-prefix = /static
+
+    [site1]
+    rules = site1/rules.xml
+    theme = site1/theme.html
+    output = build/site1.xsl
+    custom-parameters = lang=en
+
+  Relative paths are resolved against the directory of the manifest. Other
+  keys are includemode, extra, network, pretty-print, native and
+  runtime-prefix.\
+"""
+usage = __doc__
+
+import ConfigParser
+import errno
+import logging
+import multiprocessing
+import os
+import os.path
+import sys
+import time
+import traceback
+
+from optparse import OptionParser
+
+from diazo.cache import ThemeCache
+from diazo.compiler import ThemeCompiler
+from diazo.utils import split_params
+
+logger = logging.getLogger('diazo')
+
+# State for the current worker process
+_compiler = None
+_cache = None
+
+def read_manifest(filename):
+    """Return a list of the items in the manifest file. Each item is a dict
+    with ``name``, ``rules``, ``theme``, ``output`` and ``options`` keys.
+    """
+    config = ConfigParser.RawConfigParser()
+    if not config.read([filename]):
+        raise IOError("Could not read manifest '%s'" % filename)
+    base = os.path.dirname(os.path.abspath(filename))
+
+    def path(section, name):
+        if not config.has_option(section, name) or not config.get(section, name):
+            return None
+        return os.path.join(base, config.get(section, name))
+
+    items = []
+    for section in config.sections():
+        options = {}
+        if config.has_option(section, 'absolute-prefix'):
+            options['absolute_prefix'] = config.get(section, 'absolute-prefix')
+        if config.has_option(section, 'includemode'):
+            options['includemode'] = config.get(section, 'includemode')
+        if config.has_option(section, 'extra'):
+            options['extra'] = path(section, 'extra')
+        if config.has_option(section, 'network'):
+            options['read_network'] = config.getboolean(section, 'network')
+        if config.has_option(section, 'native'):
+            options['native'] = config.getboolean(section, 'native')
+        if config.has_option(section, 'runtime-prefix'):
+            options['runtime_prefix'] = config.getboolean(section, 'runtime-prefix')
+        if config.has_option(section, 'custom-parameters'):
+            options['xsl_params'] = split_params(config.get(section, 'custom-parameters'))
+        pretty_print = False
+        if config.has_option(section, 'pretty-print'):
+            pretty_print = config.getboolean(section, 'pretty-print')
+        output = path(section, 'output')
+        if output is None:
+            output = os.path.join(base, section + '.xsl')
+        items.append(dict(
+            name=section,
+            rules=path(section, 'rules'),
+            theme=path(section, 'theme'),
+            output=output,
+            pretty_print=pretty_print,
+            options=options,
+            ))
+    return items
+
+def _init_worker(cache_dir=None, defaults=None):
+    global _compiler, _cache
+    _compiler = ThemeCompiler(**(defaults or {}))
+    _cache = None
+    if cache_dir is not None:
+        _cache = ThemeCache(cache_dir)
+
+def compile_item(item):
+    """Compile a single manifest item in the current worker and write it to
+    its output file. Returns a ``(name, seconds, error)`` tuple, where error
+    is None on success.
+    """
+    start = time.time()
+    try:
+        if item['rules'] is None:
+            raise ValueError("No rules file specified")
+        compiled = _compiler.compile(item['rules'], item['theme'], cache=_cache, **item['options'])
+        directory = os.path.dirname(item['output'])
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                # Another worker may have created it
+                if e.errno != errno.EEXIST:
+                    raise
+        root = compiled.getroot()
+        if not root.tail:
+            root.tail = '\n'
+        compiled.write(item['output'], encoding='utf-8', pretty_print=item['pretty_print'])
+    except Exception, e:
+        logger.debug(traceback.format_exc())
+        return item['name'], time.time() - start, '%s: %s' % (e.__class__.__name__, e)
+    return item['name'], time.time() - start, None
+
+def compile_items(items, jobs=None, cache_dir=None, **defaults):
+    """Compile the manifest items, yielding the result of ``compile_item``
+    for each as it completes.
+
+    * ``jobs`` is the number of worker processes, defaulting to the number of
+      CPUs. With a single job the items are compiled in this process.
+    * ``cache_dir`` is an optional directory of compiled themes shared by the
+      workers, see ``diazo.cache.ThemeCache``.
+
+    Other keyword arguments are used as defaults for the compiler options.
+    """
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(items))
+    if jobs <= 1:
+        _init_worker(cache_dir, defaults)
+        for item in items:
+            yield compile_item(item)
+        return
+    pool = multiprocessing.Pool(jobs, _init_worker, (cache_dir, defaults))
+    try:
+        for result in pool.imap_unordered(compile_item, items):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def main():
+    """Called from console script
+    """
+    parser = OptionParser(usage=usage)
+    parser.add_option("-j", "--jobs", metavar="N", type="int",
+                      help="Number of worker processes (defaults to the number of CPUs)",
+                      dest="jobs", default=None)
+    parser.add_option("--cache-dir", metavar="DIR",
+                      help="Directory of compiled themes to reuse between runs",
+                      dest="cache_dir", default=None)
+    parser.add_option("--native", action="store_true",
+                      help="Run some of the rules processing stages in Python rather than XSLT",
+                      dest="native", default=False)
+    parser.add_option("--trace", action="store_true",
+                      help="Compiler trace logging",
+                      dest="trace", default=False)
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("Wrong number of arguments.")
+    manifest, = args
+
+    logging.basicConfig()
+    if options.trace:
+        logger.setLevel(logging.DEBUG)
+
+    items = read_manifest(manifest)
+    defaults = {}
+    if options.native:
+        defaults['native'] = True
+
+    start = time.time()
+    failures = 0
+    for name, seconds, error in compile_items(items, options.jobs, options.cache_dir, **defaults):
+        if error is None:
+            print "%-40s %8.3fs" % (name, seconds)
+        else:
+            failures += 1
+            print "%-40s %8.3fs FAILED %s" % (name, seconds, error)
+    print "Compiled %d of %d themes in %.3fs" % (len(items) - failures, len(items), time.time() - start)
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+"""\
+Persistent, content addressed storage for compiled themes.
+
+Compiling a theme runs the rules through a long pipeline of XSLT passes. The
+result only depends on the rules, themes and XIncluded files along with the
+compiler options, so it may be stored on disk and reused by later processes.
+"""
+
+import errno
+import hashlib
+import logging
+import os
+import os.path
+import pkg_resources
+import tempfile
+
+logger = logging.getLogger('diazo')
+
+_diazo_version = None
+
+def diazo_version():
+    """Return a string identifying this version of the compiler, including
+    the stylesheets that make up the compilation pipeline.
+    """
+    global _diazo_version
+    if _diazo_version is None:
+        try:
+            version = pkg_resources.get_distribution('diazo').version
+        except pkg_resources.DistributionNotFound:
+            version = 'unknown'
+        digest = hashlib.sha1(version)
+        for name in sorted(pkg_resources.resource_listdir('diazo', '')):
+            if name.endswith('.xsl') or name.endswith('.html'):
+                digest.update(name)
+                digest.update(pkg_resources.resource_string('diazo', name))
+        _diazo_version = digest.hexdigest()
+    return _diazo_version
+
+def url_filename(url):
+    """Return the local filename for url, or None if it is not a local file.
+    """
+    if url.lower().startswith('python://'):
+        package, resource_name = url[9:].split('/', 1)
+        return pkg_resources.resource_filename(package, resource_name)
+    if url.startswith('file://'):
+        url = url[7:]
+    elif '://' in url:
+        return None
+    return url
+
+def digest_url(url):
+    """Return a hash of the contents of url, or None if it cannot be read
+    from the filesystem.
+    """
+    filename = url_filename(url)
+    if filename is None:
+        return None
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return None
+    try:
+        return hashlib.sha1(f.read()).hexdigest()
+    finally:
+        f.close()
+
+class Dependencies(list):
+    """A list of the urls read while compiling a theme, which hashes the
+    contents of each file as it is appended. Urls must be appended before
+    they are read, so the hashes match the contents the compiler saw.
+    """
+
+    def __init__(self, urls=()):
+        list.__init__(self)
+        self.digests = {}
+        self.extend(urls)
+
+    def append(self, url):
+        if url not in self.digests:
+            self.digests[url] = digest_url(url)
+        list.append(self, url)
+
+    def extend(self, urls):
+        for url in urls:
+            self.append(url)
+
+class ThemeCache(object):
+    """A directory of compiled themes.
+
+    Entries are looked up in two steps. The compiler options and the rules
+    and theme names map to a manifest of the files read by the compiler. The
+    compiled theme itself is stored under a hash of the manifest key and the
+    current contents of those files, so editing any rules, theme or XIncluded
+    fragment results in a cache miss.
+
+    Writes go to a temporary file which is then renamed into place, so
+    several processes may safely share a cache directory.
+    """
+
+    manifest_suffix = '.deps'
+    compiled_suffix = '.xsl'
+
+    def __init__(self, directory, max_size=None):
+        """Create the cache.
+
+        * ``directory``, the directory entries are stored in. It is created
+          if it does not exist.
+        * ``max_size``, an optional limit in bytes on the total size of the
+          cache. The least recently used entries are removed once it is
+          exceeded.
+        """
+        self.directory = directory
+        if max_size is not None:
+            max_size = int(max_size)
+        self.max_size = max_size
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def key(self, rules, **options):
+        """Return the lookup key for compiling rules with options, or None if
+        the result cannot be cached.
+        """
+        if not isinstance(rules, basestring):
+            return None
+        theme = options.get('theme')
+        if theme is not None and not isinstance(theme, basestring):
+            return None
+        if url_filename(rules) is not None:
+            rules = os.path.abspath(url_filename(rules))
+        digest = hashlib.sha1(diazo_version())
+        digest.update(repr(rules))
+        for name, value in sorted(options.items()):
+            if isinstance(value, dict):
+                value = sorted(value.items())
+            digest.update(repr((name, value)))
+        return digest.hexdigest()
+
+    def get(self, key, dependencies=None):
+        """Return the serialized compiled theme for key, or None. If
+        ``dependencies`` is a list, the urls the compiled theme was built from
+        are appended to it on success.
+        """
+        manifest = self._read(key + self.manifest_suffix)
+        if manifest is None:
+            return None
+        manifest = manifest.splitlines()
+        compiled_key = self._compiled_key(key, manifest)
+        if compiled_key is None:
+            return None
+        compiled = self._read(compiled_key + self.compiled_suffix)
+        if compiled is None:
+            return None
+        # Mark the entry as recently used for evict
+        for name in (key + self.manifest_suffix, compiled_key + self.compiled_suffix):
+            try:
+                os.utime(self._filename(name), None)
+            except OSError:
+                pass
+        if dependencies is not None:
+            dependencies.extend(manifest)
+        logger.debug('Loaded compiled theme %s from cache' % compiled_key)
+        return compiled
+
+    def set(self, key, compiled, dependencies):
+        """Store the serialized compiled theme for key. ``dependencies`` is a
+        list of the urls read during compilation. When it is a
+        ``Dependencies`` list the theme is stored under the hashes taken as
+        the files were read, and is not stored at all if any of them has
+        changed since.
+        """
+        digests = getattr(dependencies, 'digests', None)
+        dependencies = sorted(set(dependencies))
+        compiled_key = self._compiled_key(key, dependencies, digests)
+        if compiled_key is None:
+            logger.debug('Not caching compiled theme with non-file dependencies')
+            return
+        if digests is not None and self._compiled_key(key, dependencies) != compiled_key:
+            logger.debug('Not caching compiled theme, its files changed while compiling')
+            return
+        if not self._write(compiled_key + self.compiled_suffix, compiled):
+            return
+        self._write(key + self.manifest_suffix, '\n'.join(dependencies))
+        if self.max_size is not None:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits
+        within ``max_size``. An entry's manifest and compiled theme are
+        removed together, and compiled themes no manifest refers to are
+        removed first.
+        """
+        files = {}
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            try:
+                files[name] = os.stat(self._filename(name))
+            except OSError:
+                continue
+        entries = []
+        total = 0
+        for name, st in files.items():
+            if not name.endswith(self.manifest_suffix):
+                continue
+            names = [name]
+            key = name[:-len(self.manifest_suffix)]
+            manifest = self._read(name)
+            if manifest is not None:
+                compiled_key = self._compiled_key(key, manifest.splitlines())
+                if compiled_key is not None and compiled_key + self.compiled_suffix in files:
+                    names.append(compiled_key + self.compiled_suffix)
+            size = sum([files[entry_name].st_size for entry_name in names])
+            mtime = max([files[entry_name].st_mtime for entry_name in names])
+            entries.append((mtime, size, names))
+            total += size
+        used = set()
+        for mtime, size, names in entries:
+            used.update(names)
+        for name in files:
+            if name not in used:
+                self._remove(name)
+        entries.sort()
+        for mtime, size, names in entries:
+            if total <= self.max_size:
+                break
+            for name in names:
+                self._remove(name)
+            total -= size
+
+    def _remove(self, name):
+        try:
+            os.unlink(self._filename(name))
+        except OSError:
+            pass
+
+    def _compiled_key(self, key, dependencies, digests=None):
+        digest = hashlib.sha1(key)
+        for url in dependencies:
+            if digests is not None and url in digests:
+                url_digest = digests[url]
+            else:
+                url_digest = digest_url(url)
+            if url_digest is None:
+                return None
+            digest.update(url)
+            digest.update(url_digest)
+        return digest.hexdigest()
+
+    def _filename(self, name):
+        return os.path.join(self.directory, name)
+
+    def _read(self, name):
+        try:
+            f = open(self._filename(name), 'rb')
+        except IOError:
+            return None
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def _write(self, name, data):
+        """Write data to the named file, returning True on success. Errors,
+        such as running out of space, are logged and leave no temporary
+        file behind, as the entry is then simply not cached.
+        """
+        try:
+            fd, tmpname = tempfile.mkstemp(prefix='.', dir=self.directory)
+        except (IOError, OSError), e:
+            logger.debug('Could not write %s to the cache: %s' % (name, e))
+            return False
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(tmpname, self._filename(name))
+        except (IOError, OSError), e:
+            # Another writer got there first (rename does not replace on
+            # Windows), or the write failed
+            logger.debug('Could not write %s to the cache: %s' % (name, e))
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+            return os.path.exists(self._filename(name))
+        return True
@@ -13,25 +13,78 @@ usage = __doc__
 
 import logging
 import pkg_resources
+import re
+import sys
+import threading
+import time
 
 from lxml import etree
 
-from diazo.rules import process_rules
-from diazo.utils import pkg_xsl, _createOptionParser, CustomResolver, quote_param, split_params
+from diazo.cache import Dependencies
+from diazo.rules import process_rules, RUNTIME_PREFIX, RUNTIME_PREFIX_MARKER, RUNTIME_PREFIX_END
+from diazo.utils import namespaces, pkg_xsl, _createOptionParser, quote_param, split_params, \
+    record_stage, format_profile
 
 logger = logging.getLogger('diazo')
 
+# The documents loaded by includes with method="document" or "transform"
+INCLUDE_SELECT = re.compile(r"^document\('([^']*)', \$diazo-base-document\)")
+VARIABLE_REFERENCE = re.compile(r"\$([\w.-]+)")
+
+# Relative urls marked at compile time for the prefix supplied when the theme
+# is applied
+RUNTIME_URL = re.compile(re.escape(RUNTIME_PREFIX_MARKER) + '(.*?)' + re.escape(RUNTIME_PREFIX_END))
+RUNTIME_PREFIX_VARIABLE = """\
+<xsl:variable name="diazo-absolute-prefix" xmlns:xsl="http://www.w3.org/1999/XSL/Transform"><xsl:value-of select="$diazo-prefix"/><xsl:if test="$diazo-prefix and substring($diazo-prefix, string-length($diazo-prefix)) != '/'">/</xsl:if></xsl:variable>"""
+# Return the prefix without its last path segment, as ../ resolves against it
+RUNTIME_PARENT_TEMPLATES = """\
+<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+<xsl:template name="diazo-parent-prefix">
+    <xsl:param name="prefix"/>
+    <xsl:variable name="parent">
+        <xsl:call-template name="diazo-through-last-slash">
+            <xsl:with-param name="text" select="substring($prefix, 1, string-length($prefix) - 1)"/>
+        </xsl:call-template>
+    </xsl:variable>
+    <xsl:choose>
+        <xsl:when test="substring($parent, string-length($parent) - 1) = '//'"><xsl:value-of select="$prefix"/></xsl:when>
+        <xsl:when test="$parent = '' and starts-with($prefix, '/')">/</xsl:when>
+        <xsl:otherwise><xsl:value-of select="$parent"/></xsl:otherwise>
+    </xsl:choose>
+</xsl:template>
+<xsl:template name="diazo-through-last-slash">
+    <xsl:param name="text"/>
+    <xsl:if test="contains($text, '/')">
+        <xsl:value-of select="substring-before($text, '/')"/>
+        <xsl:text>/</xsl:text>
+        <xsl:call-template name="diazo-through-last-slash">
+            <xsl:with-param name="text" select="substring-after($text, '/')"/>
+        </xsl:call-template>
+    </xsl:if>
+</xsl:template>
+</xsl:stylesheet>"""
+# The scheme of the prefix, and its scheme and host, as root-relative and
+# protocol-relative URLs resolve against them
+RUNTIME_ROOT_VARIABLES = """\
+<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+<xsl:variable name="diazo-prefix-scheme">
+    <xsl:if test="contains(substring-before($diazo-absolute-prefix, '/'), ':')">
+        <xsl:value-of select="substring-before($diazo-absolute-prefix, '/')"/>
+    </xsl:if>
+</xsl:variable>
+<xsl:variable name="diazo-prefix-root">
+    <xsl:variable name="rest" select="substring($diazo-absolute-prefix, string-length($diazo-prefix-scheme) + 1)"/>
+    <xsl:if test="starts-with($rest, '//')">
+        <xsl:value-of select="concat($diazo-prefix-scheme, '//', substring-before(substring($rest, 3), '/'))"/>
+    </xsl:if>
+</xsl:variable>
+</xsl:stylesheet>"""
+
 def set_parser(stylesheet, parser, compiler_parser=None):
-    dummy_doc = etree.parse(open(pkg_resources.resource_filename('diazo', 'dummy.html')), parser=parser)
-    name = 'file:///__diazo__'
-    resolver = CustomResolver({name: stylesheet})
-    if compiler_parser is None:
-        compiler_parser = etree.XMLParser()
-    compiler_parser.resolvers.add(resolver)
-    identity = pkg_xsl('identity.xsl', compiler_parser)
-    output_doc = identity(dummy_doc, docurl="'%s'"%name)
-    compiler_parser.resolvers.remove(resolver)
-    return output_doc
+    """Return a copy of the compiled stylesheet (a string or lxml tree) which
+    uses parser to load documents at transform time.
+    """
+    return default_compiler.set_parser(stylesheet, parser, compiler_parser)
 
 def build_xsl_params_document(xsl_params):
     if xsl_params is None:
@@ -43,21 +96,209 @@ def build_xsl_params_document(xsl_params):
         param_element = etree.SubElement(known_params, "{http://www.w3.org/1999/XSL/Transform}param")
         param_element.attrib['name'] = param_name
         if isinstance(param_value, basestring):
-            param_element.text = param_value
+            if param_value:
+                param_element.text = param_value
         else:
             param_element.attrib['select'] = str(quote_param(param_value))
         param_element.tail = '\n'
     
     return known_params    
 
+class ThemeCompiler(object):
+    """A reusable Diazo compiler.
+    
+    The stylesheets for the final compilation stages are parsed once, rather
+    than on every compile. Each thread gets its own copy of the stylesheets
+    and parsers, so a single compiler may be shared between threads.
+    
+    Keyword arguments are used as defaults for the arguments to ``compile``,
+    which takes the same arguments as ``compile_theme``.
+    """
+    
+    def __init__(self, **defaults):
+        self.defaults = defaults
+        self.dummy = pkg_resources.resource_string('diazo', 'dummy.html')
+        self.extensions = {(namespaces['diazo'], 'tree'): self._tree}
+        self._local = threading.local()
+    
+    def _tree(self, context, name):
+        """XSLT extension function returning the top level nodes of an
+        in-memory document, so that trees may be passed between stages
+        without serializing them.
+        """
+        root = self._local.documents[name].getroot()
+        preceding = list(root.itersiblings(preceding=True))
+        preceding.reverse()
+        return preceding + [root] + list(root.itersiblings())
+    
+    def _stages(self):
+        """Return the stylesheets and parsers for the current thread
+        """
+        local = self._local
+        if not hasattr(local, 'emit_stylesheet'):
+            local.documents = {}
+            local.emit_stylesheet = pkg_xsl('emit-stylesheet.xsl', extensions=self.extensions)
+            local.identity = pkg_xsl('identity.xsl', extensions=self.extensions)
+            local.rules_parser = etree.XMLParser(recover=False)
+            local.theme_parser = etree.HTMLParser()
+        return local
+    
+    def _apply(self, transform, doc, documents, **params):
+        """Apply transform, making documents available to diazo:tree()
+        """
+        local = self._stages()
+        local.documents = documents
+        try:
+            return transform(doc, **params)
+        finally:
+            local.documents = {}
+    
+    def set_parser(self, stylesheet, parser, compiler_parser=None):
+        """Return a copy of the compiled stylesheet (a string or lxml tree)
+        which uses parser to load documents at transform time.
+        
+        The result of a transform uses the parser of its input document, so
+        the stylesheet is copied through an identity transform of a dummy
+        document parsed with parser.
+        """
+        local = self._stages()
+        if isinstance(stylesheet, basestring):
+            stylesheet = etree.fromstring(stylesheet, parser=local.rules_parser)
+        if isinstance(stylesheet, etree._Element):
+            stylesheet = stylesheet.getroottree()
+        identity = local.identity
+        if compiler_parser is not None:
+            identity = pkg_xsl('identity.xsl', compiler_parser, extensions=self.extensions)
+        dummy_doc = etree.fromstring(self.dummy, parser=parser).getroottree()
+        return self._apply(identity, dummy_doc, {'stylesheet': stylesheet},
+                           docname=quote_param('stylesheet'))
+    
+    def compile(self, rules, theme=None, **options):
+        """Compile rules and theme, returning an lxml tree containing the
+        XSLT document. See ``compile_theme`` for the options.
+        """
+        if self.defaults:
+            options = dict(self.defaults, **options)
+        return self._compile(rules, theme, **options)
+    
+    def compile_many(self, items, **options):
+        """Compile several themes, yielding compiled trees in order. Each
+        item is a ``(rules, theme)`` pair, or a ``(rules, theme, options)``
+        triple of per item options.
+        """
+        for item in items:
+            item_options = options
+            if len(item) > 2:
+                item_options = dict(options, **item[2])
+            yield self.compile(item[0], item[1], **item_options)
+    
+    def _compile(self, rules, theme=None, extra=None, css=True, xinclude=True,
+        absolute_prefix=None, update=True, trace=False, includemode=None,
+        parser=None, compiler_parser=None, rules_parser=None,
+        access_control=None, read_network=False, indent=None,
+        xsl_params=None, cache=None, dependencies=None, native=False,
+        profile=None, runtime_prefix=False
+    ):
+        if access_control is not None:
+            read_network = access_control.options['read_network']
+        stages = self._stages()
+        if rules_parser is None:
+            rules_parser = stages.rules_parser
+        cache_key = None
+        if cache is not None:
+            key_params = dict(xsl_params or {})
+            key_params.setdefault('path', '')
+            cache_key = cache.key(rules,
+                theme=theme,
+                extra=extra,
+                css=css,
+                xinclude=xinclude,
+                absolute_prefix=absolute_prefix,
+                update=update,
+                trace=trace,
+                includemode=includemode,
+                read_network=read_network,
+                indent=indent,
+                xsl_params=key_params,
+                runtime_prefix=runtime_prefix,
+                )
+        if cache_key is not None:
+            start = time.time()
+            compiled = cache.get(cache_key, dependencies)
+            if compiled is not None:
+                compiled = self.set_parser(compiled, parser, compiler_parser)
+                record_stage(profile, 'cache', start, compiled)
+                return compiled
+            # Hash the files as they are read, passing the caller the urls
+            # afterwards
+            recorded = dependencies
+            if not isinstance(recorded, Dependencies):
+                recorded = Dependencies()
+            dependencies_arg = recorded
+        else:
+            dependencies_arg = dependencies
+        if runtime_prefix:
+            xsl_params = dict(xsl_params or {})
+            xsl_params['diazo-prefix'] = absolute_prefix or ''
+            absolute_prefix = RUNTIME_PREFIX
+        rules_doc = process_rules(
+            rules=rules,
+            theme=theme,
+            extra=extra,
+            css=css,
+            xinclude=xinclude,
+            absolute_prefix=absolute_prefix,
+            update=update,
+            trace=trace,
+            includemode=includemode,
+            parser=parser or stages.theme_parser,
+            rules_parser=rules_parser,
+            read_network=read_network,
+            dependencies=dependencies_arg,
+            native=native,
+            profile=profile,
+            )
+    
+        # Build a document with all the <xsl:param /> values to set the defaults
+        # for every value passed in as xsl_params
+        known_params = build_xsl_params_document(xsl_params)
+    
+        # Set up parameters
+        params = {}
+        if indent is not None:
+            params['indent'] = indent and "'yes'" or "'no'"
+        params['known_params'] = quote_param('known-params')
+    
+        # Run the final stage compiler. The known parameters are passed to
+        # it in memory.
+        start = time.time()
+        compiled_doc = self._apply(stages.emit_stylesheet, rules_doc,
+                                   {'known-params': known_params.getroottree()},
+                                   **params)
+        record_stage(profile, 'emit_stylesheet', start, compiled_doc)
+        if runtime_prefix:
+            start = time.time()
+            apply_runtime_prefix(compiled_doc)
+            record_stage(profile, 'apply_runtime_prefix', start, compiled_doc)
+        if cache_key is not None:
+            cache.set(cache_key, etree.tostring(compiled_doc), recorded)
+            if dependencies is not None and dependencies is not recorded:
+                dependencies.extend(recorded)
+        start = time.time()
+        compiled_doc = self.set_parser(compiled_doc, parser, compiler_parser)
+        record_stage(profile, 'set_parser', start)
+    
+        return compiled_doc
+
 def compile_theme(rules, theme=None, extra=None, css=True, xinclude=True,
     absolute_prefix=None, update=True, trace=False, includemode=None,
     parser=None, compiler_parser=None, rules_parser=None,
     access_control=None, read_network=False, indent=None,
-    xsl_params=None
+    xsl_params=None, cache=None, dependencies=None, native=False,
+    profile=None, runtime_prefix=False
 ):
     """Invoke the diazo compiler.
-    
+
     * ``rules`` is the rules file
     * ``theme`` is the theme file
     * ``extra`` is an optional XSLT file with Diazo extensions (depracated, use
@@ -88,11 +329,24 @@ def compile_theme(rules, theme=None, extra=None, css=True, xinclude=True,
     * ``xsl_params`` can be set to a dictionary of parameters that will be
       known to the compiled theme transform. The keys should be the parameter
       names. Values are default values.
+    * ``cache`` can be set to a ``diazo.cache.ThemeCache`` to load the
+      compiled theme from disk when none of its inputs have changed.
+    * ``dependencies`` can be set to a list, to which the urls of the rules
+      and themes read by the compiler are appended, and those of XIncluded
+      files when ``cache`` is set.
+    * ``native`` can be set to True to run the condition and theme
+      annotation stages in Python rather than XSLT. The compiled theme is
+      the same, but large themes compile faster.
+    * ``profile`` can be set to a list, to which a ``(stage, seconds, nodes,
+      memory)`` tuple is appended for each compilation stage. See
+      ``diazo.utils.format_profile``.
+    * ``runtime_prefix`` can be set to True to prefix the relative URLs in
+      the theme with the ``diazo-prefix`` parameter when the compiled theme
+      is applied, rather than with ``absolute_prefix`` when it is compiled,
+      so that one compiled theme can serve several prefixes.
+      ``absolute_prefix`` becomes the default value of the parameter.
     """
-    if access_control is not None:
-        read_network = access_control.options['read_network']
-    rules_doc = process_rules(
-        rules=rules,
+    return default_compiler.compile(rules,
         theme=theme,
         extra=extra,
         css=css,
@@ -102,38 +356,195 @@ def compile_theme(rules, theme=None, extra=None, css=True, xinclude=True,
         trace=trace,
         includemode=includemode,
         parser=parser,
+        compiler_parser=compiler_parser,
         rules_parser=rules_parser,
+        access_control=access_control,
         read_network=read_network,
+        indent=indent,
+        xsl_params=xsl_params,
+        cache=cache,
+        dependencies=dependencies,
+        native=native,
+        profile=profile,
+        runtime_prefix=runtime_prefix,
         )
+
+default_compiler = ThemeCompiler()
+
+def split_relative_url(url):
+    """Return the number of leading ``..`` segments of the relative url once
+    its other dot segments are removed, and the rest of the url.
+    """
+    index = len(url)
+    for separator in '?#':
+        if separator in url:
+            index = min(index, url.index(separator))
+    path, suffix = url[:index], url[index:]
+    segments = path.split('/')
+    parents = 0
+    stack = []
+    for segment in segments:
+        if segment == '..':
+            if stack:
+                stack.pop()
+            else:
+                parents += 1
+        elif segment != '.':
+            stack.append(segment)
+    if segments[-1] in ('.', '..'):
+        stack.append('')
+    return parents, '/'.join(stack) + suffix
+
+def apply_runtime_prefix(compiled):
+    """Replace the relative URLs marked in the compiled theme with variables
+    joining them to the ``diazo-absolute-prefix`` variable: an attribute
+    value template in attributes, and ``xsl:value-of`` in text and comments.
+    ``..`` is resolved against the prefix, root-relative URLs against its
+    scheme and host, and URLs are left unchanged when the prefix is empty.
+    """
+    if hasattr(compiled, 'getroot'):
+        compiled = compiled.getroot()
+    xsl = namespaces['xsl']
+    
+    variables = {}
+    urls = []
+    def variable_name(url):
+        if url not in variables:
+            variables[url] = 'diazo-runtime-url-%d' % len(urls)
+            urls.append(url)
+        return variables[url]
     
-    # Build a document with all the <xsl:param /> values to set the defaults
-    # for every value passed in as xsl_params
-    known_params = build_xsl_params_document(xsl_params)
+    def value_of(name, tail):
+        element = etree.Element('{%s}value-of' % xsl, select='$' + name)
+        element.tail = tail
+        return element
     
-    # Create a pseudo resolver for this
-    known_params_url = 'file:///__diazo_known_params__'
-    emit_stylesheet_resolver = CustomResolver({known_params_url: etree.tostring(known_params)})
-    emit_stylesheet_parser = etree.XMLParser()
-    emit_stylesheet_parser.resolvers.add(emit_stylesheet_resolver)
+    def split(text):
+        # Alternating text and variable names
+        parts = RUNTIME_URL.split(text)
+        for index in range(1, len(parts), 2):
+            parts[index] = variable_name(parts[index])
+        return parts
     
-    # Set up parameters
-    params = {}
-    if indent is not None:
-        params['indent'] = indent and "'yes'" or "'no'"
-    params['known_params_url'] = quote_param(known_params_url)
+    marked = []
+    for node in compiled.iter():
+        if (node.text and RUNTIME_PREFIX_MARKER in node.text or
+            node.tail and RUNTIME_PREFIX_MARKER in node.tail):
+            marked.append(node)
+        if not isinstance(node.tag, basestring) or node.tag.startswith('{%s}' % xsl):
+            continue
+        for name, value in node.attrib.items():
+            if RUNTIME_PREFIX_MARKER in value:
+                node.set(name, RUNTIME_URL.sub(lambda match: '{$%s}' % variable_name(match.group(1)), value))
     
-    # Run the final stage compiler
-    emit_stylesheet = pkg_xsl('emit-stylesheet.xsl', parser=emit_stylesheet_parser)
-    compiled_doc = emit_stylesheet(rules_doc, **params)
-    compiled_doc = set_parser(etree.tostring(compiled_doc), parser, compiler_parser)
+    for node in marked:
+        if node.tail and RUNTIME_PREFIX_MARKER in node.tail:
+            parts = split(node.tail)
+            node.tail = parts[0]
+            for index in range(len(parts) - 2, 0, -2):
+                node.addnext(value_of(parts[index], parts[index + 1]))
+        if not node.text or RUNTIME_PREFIX_MARKER not in node.text:
+            continue
+        parts = split(node.text)
+        if node.tag is etree.Comment:
+            # Literal comments cannot contain instructions
+            comment = etree.Element('{%s}comment' % xsl)
+            comment.tail = node.tail
+            node.getparent().replace(node, comment)
+            node = comment
+        node.text = parts[0]
+        for index in range(1, len(parts), 2):
+            node.insert(index // 2, value_of(parts[index], parts[index + 1]))
     
-    return compiled_doc
+    # Each URL is left alone without a prefix, otherwise it is joined to the
+    # prefix, less a path segment for each leading ..
+    declarations = [etree.XML(RUNTIME_PREFIX_VARIABLE)]
+    prefixes = set()
+    roots = False
+    for url in urls:
+        name = variables[url]
+        if url.startswith('/'):
+            roots = True
+            variable = etree.Element('{%s}variable' % xsl, name=name)
+            root = url.startswith('//') and 'diazo-prefix-scheme' or 'diazo-prefix-root'
+            etree.SubElement(variable, '{%s}value-of' % xsl, select='$' + root).tail = url
+            declarations.append(variable)
+            continue
+        parents, rest = split_relative_url(url)
+        prefix = 'diazo-absolute-prefix'
+        if parents:
+            prefix = 'diazo-absolute-prefix-%d' % parents
+            prefixes.add(parents)
+        variable = etree.Element('{%s}variable' % xsl, name=name)
+        choose = etree.SubElement(variable, '{%s}choose' % xsl)
+        etree.SubElement(choose, '{%s}when' % xsl, test="$diazo-absolute-prefix = ''").text = url
+        otherwise = etree.SubElement(choose, '{%s}otherwise' % xsl)
+        etree.SubElement(otherwise, '{%s}value-of' % xsl, select='$' + prefix).tail = rest
+        declarations.append(variable)
+    for parents in range(1, max(prefixes or [0]) + 1):
+        variable = etree.Element('{%s}variable' % xsl, name='diazo-absolute-prefix-%d' % parents)
+        call = etree.SubElement(variable, '{%s}call-template' % xsl, name='diazo-parent-prefix')
+        etree.SubElement(call, '{%s}with-param' % xsl, name='prefix',
+                         select=parents == 1 and '$diazo-absolute-prefix' or '$diazo-absolute-prefix-%d' % (parents - 1))
+        declarations.append(variable)
+    if roots:
+        declarations[1:1] = etree.XML(RUNTIME_ROOT_VARIABLES)
+    if prefixes:
+        declarations.extend(etree.XML(RUNTIME_PARENT_TEMPLATES))
+    for index, declaration in enumerate(declarations):
+        declaration.tail = '\n'
+        compiled.insert(index, declaration)
+    return compiled
 
+def find_includes(compiled):
+    """Return a list of ``(url, condition)`` tuples for the documents included
+    by the compiled theme. The condition is an XPath expression, using the
+    parameters of the theme, which is true when the include is used, or None
+    if it is always used.
+    
+    Includes resolved against the base url of the content (``usebase``) are
+    not returned.
+    """
+    if hasattr(compiled, 'getroot'):
+        compiled = compiled.getroot()
+    xsl = namespaces['xsl']
+    
+    variables = {}
+    for variable in compiled.iterchildren('{%s}variable' % xsl):
+        name = variable.get('name')
+        if name == 'diazo-base-document' and variable.get('select') is None:
+            return []
+        if name.startswith('diazo-condition-'):
+            variables[name] = variable.get('select')
+    
+    def expand(expression):
+        return VARIABLE_REFERENCE.sub(lambda match: match.group(1) in variables
+            and '(%s)' % variables[match.group(1)] or match.group(0), expression)
+    
+    conditions = {}
+    urls = []
+    for element in compiled.iter('{%s}*' % xsl):
+        match = INCLUDE_SELECT.match(element.get('select', ''))
+        if match is None:
+            continue
+        url = match.group(1)
+        tests = [expand(ancestor.get('test')) for ancestor in element.iterancestors(
+            '{%s}if' % xsl, '{%s}when' % xsl)]
+        condition = tests and ' and '.join('(%s)' % test for test in reversed(tests)) or None
+        if url not in conditions:
+            urls.append(url)
+            conditions[url] = condition
+        elif conditions[url] is not None:
+            conditions[url] = condition and '(%s) or (%s)' % (conditions[url], condition) or None
+    return [(url, conditions[url]) for url in urls]
 
 def main():
     """Called from console script
     """
     parser = _createOptionParser(usage=usage)
+    parser.add_option("--runtime-prefix", action="store_true",
+                      help="Prefix relative urls in the theme with the diazo-prefix parameter when the theme is applied, defaulting to the absolute prefix",
+                      dest="runtime_prefix", default=False)
     (options, args) = parser.parse_args()
 
     if options.rules is None:
@@ -153,6 +564,10 @@ def main():
     if options.xsl_params:
         xsl_params = split_params(options.xsl_params)
     
+    profile = None
+    if options.profile:
+        profile = []
+
     output_xslt = compile_theme(
         rules=options.rules,
         theme=options.theme,
@@ -161,12 +576,17 @@ def main():
         absolute_prefix=options.absolute_prefix,
         includemode=options.includemode,
         read_network=options.read_network,
-        xsl_params=xsl_params
+        xsl_params=xsl_params,
+        native=options.native,
+        profile=profile,
+        runtime_prefix=options.runtime_prefix,
         )
     root = output_xslt.getroot()
     if not root.tail:
         root.tail = '\n'
     output_xslt.write(options.output, encoding='utf-8', pretty_print=options.pretty_print)
+    if profile is not None:
+        sys.stderr.write(format_profile(profile))
 
 if __name__ == '__main__':
     main()
@@ -15,11 +15,105 @@ from optparse import OptionParser
 from lxml import etree
 from experimental.cssselect import css_to_xpath
 
+import re
 import utils
 
 import logging
 logger = logging.getLogger('diazo')
 
+# The start of the XPath generated for id and class selectors
+ID_XPATH = re.compile(r"^//(\*|[A-Za-z][\w-]*)\[@id = '([\w-]+)'\]")
+CLASS_XPATH = re.compile(r"^//(\*|[A-Za-z][\w-]*)\[@class and contains\(concat\(' ', normalize-space\(@class\), ' '\), ' ([\w-]+) '\)\]")
+
+# Content attributes which are evaluated as expressions against the content
+# document, rather than as template match patterns
+CONDITION_ATTRIBUTES = ('if-content', 'if-not-content')
+CONTENT_ATTRIBUTES = ('content', 'content-children')
+
+# Translated selectors, shared by all compilations in this process
+selector_cache = utils.LRUCache(maxsize=2000)
+
+def convert_css(selector, prefix='descendant-or-self::'):
+    """Translate a css selector to XPath, memoized in ``selector_cache``
+    """
+    key = (selector, prefix)
+    xpath = selector_cache.get(key)
+    if xpath is None:
+        xpath = css_to_xpath(selector, prefix=prefix)
+        selector_cache.set(key, xpath)
+    return xpath
+
+def warm_selector_cache(selectors, prefixes=('//', 'descendant-or-self::')):
+    """Translate the css selectors ahead of time with each of the prefixes,
+    e.g. with the selectors of the rules files about to be compiled. Invalid
+    selectors are logged and skipped. Returns the number of selectors added.
+    """
+    added = 0
+    for selector in selectors:
+        for prefix in prefixes:
+            if (selector, prefix) in selector_cache:
+                continue
+            try:
+                selector_cache.set((selector, prefix), css_to_xpath(selector, prefix=prefix))
+            except Exception, e:
+                logger.warning("Could not translate css selector %r: %s" % (selector, e))
+                break
+            added += 1
+    return added
+
+def selector_cache_stats():
+    """Return the hits, misses and size of the selector cache
+    """
+    return selector_cache.stats()
+
+def _balanced(expression):
+    return (expression.count('[') == expression.count(']') and
+            expression.count('(') == expression.count(')'))
+
+def key_xpath(xpath):
+    """Rewrite an XPath generated for an id or class selector to use the
+    ``diazo-id`` or ``diazo-class`` keys, so the content document is indexed
+    once rather than searched on each evaluation. Returns None if the
+    expression cannot be rewritten.
+    """
+    branches = xpath.split(' | ')
+    result = []
+    for branch in branches:
+        if not _balanced(branch):
+            return None
+        match = ID_XPATH.match(branch)
+        key = 'diazo-id'
+        if match is None:
+            match = CLASS_XPATH.match(branch)
+            key = 'diazo-class'
+        if match is None:
+            return None
+        tag, value = match.groups()
+        rest = branch[match.end():]
+        if rest and not rest.startswith('/'):
+            return None
+        expression = "key('%s', '%s')" % (key, value)
+        if tag != '*':
+            expression += '[self::%s]' % tag
+        result.append(expression + rest)
+    return ' | '.join(result)
+
+def use_keys(element, localname):
+    """Return True if the content selector in attribute localname is used as
+    an expression on the content document, where key() may be used.
+    """
+    if utils.namespace(element.tag) != utils.namespaces['diazo']:
+        return False
+    if localname in CONDITION_ATTRIBUTES:
+        return True
+    if localname not in CONTENT_ATTRIBUTES or element.get('href') is not None:
+        return False
+    # Content rules without a theme selector become template match patterns
+    for name in ('theme', 'theme-children'):
+        if element.get(name) is not None or element.get(utils.fullname(utils.namespaces['css'], name)) is not None:
+            return True
+    return False
+
 def convert_css_selectors(rules):
     """Convert css rules to xpath rules element tree in place
     """
@@ -46,7 +140,10 @@ def convert_css_selectors(rules):
                 prefix = '//'
             else:
                 prefix = 'descendant-or-self::'                    
-            element.attrib[localname] = css_to_xpath(value, prefix=prefix)
+            xpath = convert_css(value, prefix)
+            if css_prefix is None and use_keys(element, localname):
+                xpath = key_xpath(xpath) or xpath
+            element.attrib[localname] = xpath
 
     return rules
 
@@ -14,7 +14,8 @@
     <xsl:param name="defaultsurl">defaults.xsl</xsl:param>
     <xsl:param name="usebase"/>
     <xsl:param name="indent"/>
-    <xsl:param name="known_params_url">file:///__diazo_known_params__</xsl:param>
+    <!-- Name of the in-memory document holding the known xsl:param elements -->
+    <xsl:param name="known_params">known-params</xsl:param>
     
     <xsl:variable name="rules" select="//dv:*[@theme]"/>
     <xsl:variable name="drop-content-rules" select="//dv:drop[@content]"/>
@@ -28,6 +29,11 @@
     <xsl:variable name="conditional" select="$conditional-theme|$conditional-notheme"/>
     <xsl:variable name="unconditional-theme" select="//dv:theme[not(@merged-condition)]"/>
     <xsl:variable name="defaults" select="document($defaultsurl)"/>
+    <xsl:variable name="id-key-rules" select="//dv:*[@*[contains(., &quot;key('diazo-id'&quot;)]]"/>
+    <xsl:variable name="class-key-rules" select="//dv:*[@*[contains(., &quot;key('diazo-class'&quot;)]]"/>
+    <xsl:key name="condition-variables" match="dv:*[@condition-variable]" use="@condition-variable"/>
+    <xsl:variable name="condition-variables"
+        select="//dv:*[@condition-variable][generate-id() = generate-id(key('condition-variables', @condition-variable)[1])]"/>
 
     <xsl:template match="@*|node()">
         <xsl:copy>
@@ -59,7 +65,7 @@
             <xsl:apply-templates select="@*"/>
             
             <xsl:text>&#10;&#10;</xsl:text>
-            <xsl:apply-templates select="document($known_params_url)/xsl:stylesheet/node()" />
+            <xsl:apply-templates select="dv:tree($known_params)/node()" />
             
             <xsl:if test="$rules[@method='document']">
                 <xsl:choose>
@@ -88,6 +94,34 @@
                     </xsl:otherwise>
                 </xsl:choose>
             </xsl:if>
+            <!-- Indexes for id and class selectors, see cssrules.key_xpath -->
+            <xsl:if test="$id-key-rules">
+                <xsl:text>&#10;    </xsl:text>
+                <xsl:element name="xsl:key">
+                    <xsl:attribute name="name">diazo-id</xsl:attribute>
+                    <xsl:attribute name="match">*[@id]</xsl:attribute>
+                    <xsl:attribute name="use">@id</xsl:attribute>
+                </xsl:element>
+                <xsl:text>&#10;</xsl:text>
+            </xsl:if>
+            <xsl:if test="$class-key-rules">
+                <xsl:text>&#10;    </xsl:text>
+                <xsl:element name="xsl:key">
+                    <xsl:attribute name="name">diazo-class</xsl:attribute>
+                    <xsl:attribute name="match">*[@class]</xsl:attribute>
+                    <xsl:attribute name="use">str:tokenize(@class)</xsl:attribute>
+                </xsl:element>
+                <xsl:text>&#10;</xsl:text>
+            </xsl:if>
+            <!-- Conditions are evaluated once per transform -->
+            <xsl:for-each select="$condition-variables">
+                <xsl:text>&#10;    </xsl:text>
+                <xsl:element name="xsl:variable">
+                    <xsl:attribute name="name"><xsl:value-of select="@condition-variable"/></xsl:attribute>
+                    <xsl:attribute name="select">boolean(<xsl:value-of select="@merged-condition"/>)</xsl:attribute>
+                </xsl:element>
+                <xsl:text>&#10;</xsl:text>
+            </xsl:for-each>
             <xsl:apply-templates select="node()"/>
             <xsl:if test="$themes">
                 <xsl:text>&#10;    </xsl:text>
@@ -101,7 +135,7 @@
                                     <xsl:text>&#10;</xsl:text>
                                     <xsl:element name="xsl:when">
                                         <xsl:attribute name="test">
-                                            <xsl:value-of select="@merged-condition"/>
+                                            <xsl:text>$</xsl:text><xsl:value-of select="@condition-variable"/>
                                         </xsl:attribute>
                                         <xsl:element name="xsl:apply-templates">
                                             <xsl:attribute name="select">@*|node()</xsl:attribute>
@@ -114,7 +148,7 @@
                                     <xsl:text>&#10;</xsl:text>
                                     <xsl:element name="xsl:when">
                                         <xsl:attribute name="test">
-                                            <xsl:value-of select="@merged-condition"/>
+                                            <xsl:text>$</xsl:text><xsl:value-of select="@condition-variable"/>
                                         </xsl:attribute>
                                         <xsl:element name="xsl:apply-templates">
                                             <xsl:attribute name="select">.</xsl:attribute>
@@ -5,11 +5,11 @@
     xmlns:css="http://namespaces.plone.org/diazo/css"
     xmlns:xhtml="http://www.w3.org/1999/xhtml"
     >
-    <xsl:param name="docurl"/>
-    <xsl:variable name="doc" select="document($docurl)"/>
+    <!-- Name of the in-memory document to copy -->
+    <xsl:param name="docname"/>
 
     <xsl:template match="/">
-        <xsl:apply-templates select="$doc" mode="identity"/>
+        <xsl:apply-templates select="diazo:tree($docname)" mode="identity"/>
     </xsl:template>
 
     <xsl:template match="@*|node()" mode="identity">
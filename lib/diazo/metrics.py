@@ -0,0 +1,115 @@
+"""\
+Counters and timing histograms for the theming middleware.
+
+The middleware records how long each phase of a request takes: waiting for
+the application, parsing, fetching includes, the transform, serialization and
+compression. ``Metrics`` aggregates these across requests and renders them in
+the Prometheus text format.
+"""
+
+import threading
+
+# Upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+COUNTERS = (
+    ('themed', "Responses transformed by the theme"),
+    ('bypassed', "Responses passed through without transforming them"),
+    ('cache_hits', "Responses served from the themed response cache"),
+    ('not_modified', "Conditional requests answered with 304 Not Modified"),
+    ('errors', "Requests raising an error in the middleware or application"),
+    ('bytes_in', "Bytes of upstream responses which were themed"),
+    ('bytes_out', "Bytes of themed responses sent"),
+    )
+
+class Metrics(object):
+    """Thread safe counters and per phase timing histograms
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self.counters = dict((name, 0) for name, description in COUNTERS)
+            # Phase name to [bucket counts, count, sum]
+            self.phases = {}
+        finally:
+            self._lock.release()
+
+    def increment(self, name, value=1):
+        """Add value to the named counter
+        """
+        self._lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + value
+        finally:
+            self._lock.release()
+
+    def observe(self, phase, seconds):
+        """Record the time taken by a phase of a request
+        """
+        self._lock.acquire()
+        try:
+            histogram = self.phases.get(phase)
+            if histogram is None:
+                histogram = self.phases[phase] = [[0] * len(self.buckets), 0, 0.0]
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[0][index] += 1
+                    break
+            histogram[1] += 1
+            histogram[2] += seconds
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """Return a dict with the ``counters`` and a dict of ``phases``, each
+        with its ``count``, total ``sum`` of seconds and a list of cumulative
+        ``(upper bound, count)`` ``buckets``.
+        """
+        self._lock.acquire()
+        try:
+            phases = {}
+            for phase, (counts, count, total) in self.phases.items():
+                buckets = []
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    buckets.append((bound, cumulative))
+                phases[phase] = dict(count=count, sum=total, buckets=buckets)
+            return dict(counters=dict(self.counters), phases=phases)
+        finally:
+            self._lock.release()
+
+    def prometheus(self, namespace='diazo'):
+        """Return the metrics in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        helps = dict(COUNTERS)
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            metric = '%s_%s_total' % (namespace, name)
+            lines.append('# HELP %s %s' % (metric, helps.get(name, name)))
+            lines.append('# TYPE %s counter' % metric)
+            lines.append('%s %d' % (metric, value))
+        metric = '%s_phase_seconds' % namespace
+        lines.append('# HELP %s Time spent in each phase of themed requests' % metric)
+        lines.append('# TYPE %s histogram' % metric)
+        for phase, histogram in sorted(snapshot['phases'].items()):
+            for bound, count in histogram['buckets']:
+                lines.append('%s_bucket{phase="%s",le="%r"} %d' % (metric, phase, bound, count))
+            lines.append('%s_bucket{phase="%s",le="+Inf"} %d' % (metric, phase, histogram['count']))
+            lines.append('%s_sum{phase="%s"} %r' % (metric, phase, histogram['sum']))
+            lines.append('%s_count{phase="%s"} %d' % (metric, phase, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+def server_timing(timing):
+    """Format a dict of phase names to seconds as a Server-Timing header
+    """
+    return ', '.join(['diazo-%s;dur=%.1f' % (phase, seconds * 1000)
+                      for phase, seconds in sorted(timing.items())])
@@ -0,0 +1,189 @@
+"""\
+Native implementations of some of the rules processing stages.
+
+The ``apply-conditions.xsl``, ``merge-conditions.xsl``, ``fixup-themes.xsl``
+and ``annotate-themes.xsl`` passes each copy the entire rules document,
+including the expanded themes. The functions here modify the document in
+place instead, producing the same result in two tree walks.
+"""
+
+import itertools
+
+from lxml import etree
+
+from diazo.utils import namespaces, fullname
+
+DIAZO = '{%s}' % namespaces['diazo']
+XML_ID = '{http://www.w3.org/XML/1998/namespace}id'
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+
+CONDITION_ATTRIBUTES = ('if-content', 'if-not-content', 'if-path', 'if-not-path', 'if', 'if-not')
+
+def path_condition(path):
+    """Return the XPath test for one token of an if-path attribute
+    """
+    if path.startswith('/') and path.endswith('/'):
+        return "$normalized_path = '%s'" % path
+    elif path.endswith('/'):
+        return "substring($normalized_path, string-length($normalized_path) - %d) = '/%s'" % (len(path), path)
+    elif path.startswith('/'):
+        return "starts-with($normalized_path, '%s/')" % path
+    else:
+        return "contains($normalized_path, '/%s/')" % path
+
+def build_condition(element):
+    """Combine the if-* attributes of a rule into a single XPath condition
+    """
+    get = element.get
+    parts = []
+    if_content = get('if-content')
+    if if_content == '':
+        parts.append(get('content') or '')
+    elif if_content is not None:
+        parts.append('(%s)' % if_content)
+    if_not_content = get('if-not-content')
+    if if_not_content == '':
+        parts.append('not(%s)' % (get('content') or ''))
+    elif if_not_content is not None:
+        parts.append('not(%s)' % if_not_content)
+    if_path = get('if-path')
+    if if_path is not None:
+        paths = if_path.split()
+        condition = ' or '.join(path_condition(path) for path in paths)
+        if len(paths) > 1:
+            condition = '(%s)' % condition
+        parts.append(condition)
+    if_not_path = get('if-not-path')
+    if if_not_path is not None:
+        paths = if_not_path.split()
+        parts.append('not(%s)' % ' or '.join(path_condition(path) for path in paths))
+    if get('if') is not None:
+        parts.append('(%s)' % get('if'))
+    if get('if-not') is not None:
+        parts.append('not(%s)' % get('if-not'))
+    return ' and '.join(parts)
+
+def apply_conditions(rules_doc):
+    """Set the condition and merged-condition attributes of the rules in
+    place. Equivalent to the apply-conditions and merge-conditions stages.
+    """
+    def walk(element, conditions):
+        if element.tag.startswith(DIAZO):
+            for name in CONDITION_ATTRIBUTES:
+                if element.get(name) is not None:
+                    element.set('condition', build_condition(element))
+                    break
+            condition = element.get('condition')
+            if condition is not None:
+                conditions = conditions + [condition]
+            if conditions:
+                element.set('merged-condition', ' and '.join(conditions))
+        for child in element:
+            if isinstance(child.tag, basestring):
+                walk(child, conditions)
+    walk(rules_doc.getroot(), [])
+    return rules_doc
+
+def _xsl_element(parent, index, name):
+    """Insert a new element in the XSL namespace, declaring it locally when
+    it is not in scope, as libxslt does.
+    """
+    if parent.nsmap.get('xsl') == namespaces['xsl']:
+        element = parent.makeelement(fullname(namespaces['xsl'], name))
+    else:
+        element = parent.makeelement(fullname(namespaces['xsl'], name), nsmap={'xsl': namespaces['xsl']})
+    parent.insert(index, element)
+    return element
+
+def _fix_text(text):
+    if text and '\r\n' in text:
+        return text.replace('\r\n', '\n')
+    return text
+
+def _tag_text(parent, index, text):
+    variable = _xsl_element(parent, index, 'variable')
+    variable.set('name', 'tag_text')
+    variable.text = text
+    value_of = _xsl_element(parent, index + 1, 'value-of')
+    value_of.set('select', '$tag_text')
+    value_of.set('disable-output-escaping', 'yes')
+    return value_of
+
+def fixup_themes(rules_doc, annotate=True):
+    """Fix up the theme html in place. Equivalent to the fixup-themes stage
+    followed by the annotate-themes stage when ``annotate`` is true.
+
+    The xml:id attributes are added after the existing attributes rather than
+    before them, which does not change the compiled theme.
+    """
+    root = rules_doc.getroot()
+    esi = bool(rules_doc.xpath('//diazo:*[@method="esi"]', namespaces=namespaces))
+    ids = itertools.count(1)
+
+    # in_theme is True inside a diazo:theme, None inside a rule with a theme
+    # attribute (where comments are converted too) and False elsewhere.
+    def fixup(element, in_theme, href):
+        # Equivalent to the text() template
+        if element.text and element.tag not in ('style', 'script'):
+            element.text = _fix_text(element.text)
+        if element.tag in ('style', 'script'):
+            if element.text:
+                text, element.text = element.text, None
+                _tag_text(element, 0, _fix_text(text))
+            for child in list(element):
+                if child.tail:
+                    tail, child.tail = child.tail, None
+                    _tag_text(element, element.index(child) + 1, _fix_text(tail))
+        for child in list(element):
+            if isinstance(child.tag, basestring):
+                child_in_theme = in_theme
+                child_href = href
+                if child.tag == 'html':
+                    fixup_html(child)
+                if in_theme:
+                    if annotate:
+                        child.set(XML_ID, 'id%d-%s' % (next(ids), href))
+                elif child.tag == DIAZO + 'theme':
+                    child_in_theme = True
+                    child_href = child.get('href', '')
+                    if annotate:
+                        child.set(XML_ID, 'id%d' % next(ids))
+                elif child.tag.startswith(DIAZO) and child.get('theme') is not None:
+                    child_in_theme = None
+                fixup(child, child_in_theme, child_href)
+            elif in_theme is not False and child.tag is etree.Comment:
+                comment = _xsl_element(element, element.index(child), 'comment')
+                comment.text = child.text
+                comment.tail = child.tail
+                element.remove(child)
+                if in_theme and annotate:
+                    comment.set(XML_ID, 'id%d-%s' % (next(ids), href))
+                child = comment
+            if child.tail and element.tag not in ('style', 'script'):
+                child.tail = _fix_text(child.tail)
+
+    def fixup_html(element):
+        if element.get(XML_LANG) is not None:
+            del element.attrib[XML_LANG]
+        if element.get('xml:lang') is not None:
+            del element.attrib['xml:lang']
+        xmlns = element.get('xmlns')
+        if xmlns is not None:
+            if esi:
+                # Attributes following xmlns are discarded, as libxslt
+                # refuses to add attributes after a child element.
+                items = element.attrib.items()
+                element.attrib.clear()
+                for key, value in items:
+                    if key == 'xmlns':
+                        break
+                    element.attrib[key] = value
+                attribute = _xsl_element(element, 0, 'attribute')
+                attribute.set('name', 'xmlns')
+                attribute.text = xmlns
+                attribute.tail, element.text = element.text, None
+            else:
+                del element.attrib['xmlns']
+
+    fixup(root, False, '')
+    return rules_doc
@@ -8,19 +8,29 @@ usage = __doc__
 
 import logging
 import re
+import sys
+import time
 
 from optparse import OptionParser
 from lxml import etree
-from urlparse import urljoin
+from urlparse import urljoin, urlsplit
 
+from diazo import native as native_stages
+from diazo.cache import Dependencies
 from diazo.cssrules import convert_css_selectors
-from diazo.utils import namespaces, fullname, AC_READ_NET, AC_READ_FILE, pkg_xsl, _createOptionParser
+from diazo.utils import namespaces, fullname, AC_READ_NET, AC_READ_FILE, pkg_xsl, _createOptionParser, \
+    record_stage, format_profile
 
 logger = logging.getLogger('diazo')
 
 IMPORT_STYLESHEET = re.compile(r'''(?P<before>@import[ \t]+(?P<paren>url\([ \t]?)?(?P<quote>['"]?))(?P<url>\S+)(?P<after>(?P=quote)(?(paren)\)))''', re.IGNORECASE)
 CONDITIONAL_SRC= re.compile(r'''(?P<before><[^>]*?(src|href)=(?P<quote>['"]?))(?P<url>[^ \t\n\r\f\v>]+)(?P<after>(?P=quote)[^>]*?>)''', re.IGNORECASE)
 
+# Used as the absolute prefix when it is applied at transform time. A relative
+# url is kept unresolved between the markers, see join_url.
+RUNTIME_PREFIX_MARKER = '/diazo-runtime-prefix/'
+RUNTIME_PREFIX_END = '/diazo-runtime-prefix-end/'
+RUNTIME_PREFIX = RUNTIME_PREFIX_MARKER + RUNTIME_PREFIX_END
 
 update_transform = pkg_xsl('update-namespace.xsl')
 normalize_rules  = pkg_xsl('normalize-rules.xsl')
@@ -49,8 +59,23 @@ def update_namespace(rules_doc):
     else:
         return rules_doc
 
+def join_url(prefix, url):
+    """Join url to prefix with urljoin. When prefix is a runtime prefix a
+    url without a scheme is instead resolved against the relative part of
+    the prefix and kept between the runtime prefix markers, so that
+    ``diazo.compiler.apply_runtime_prefix`` can join it to the actual prefix.
+    """
+    if not prefix.startswith(RUNTIME_PREFIX_MARKER):
+        return urljoin(prefix, url)
+    if urlsplit(url)[0]:
+        return url
+    relative = prefix[len(RUNTIME_PREFIX_MARKER):-len(RUNTIME_PREFIX_END)]
+    if relative:
+        url = urljoin(relative, url)
+    return RUNTIME_PREFIX_MARKER + url + RUNTIME_PREFIX_END
+
 def expand_theme(element, theme_doc, absolute_prefix):
-    prefix = urljoin(absolute_prefix, element.get('prefix', ''))
+    prefix = join_url(absolute_prefix, element.get('prefix', ''))
     apply_absolute_prefix(theme_doc, prefix)
     theme_root = theme_doc.getroot()
     preceding = list(theme_root.itersiblings(preceding=True))
@@ -60,7 +85,7 @@ def expand_theme(element, theme_doc, absolute_prefix):
     element.append(theme_root)
     element.extend(following)
 
-def expand_themes(rules_doc, parser=None, absolute_prefix=None, read_network=False):
+def expand_themes(rules_doc, parser=None, absolute_prefix=None, read_network=False, dependencies=None):
     """Expand <theme href='...'/> nodes with the theme html.
     """
     if absolute_prefix is None:
@@ -72,6 +97,8 @@ def expand_themes(rules_doc, parser=None, absolute_prefix=None, read_network=Fal
         url = urljoin(base, element.get('href'))
         if not read_network and url[:6] in ('ftp://', 'http:/', 'https:'):
             raise ValueError("Supplied theme '%s', but network access denied." % url)
+        if dependencies is not None:
+            dependencies.append(url)
         theme_doc = etree.parse(url, parser=parser)
         expand_theme(element, theme_doc, absolute_prefix)
     return rules_doc
@@ -79,24 +106,28 @@ def expand_themes(rules_doc, parser=None, absolute_prefix=None, read_network=Fal
 def apply_absolute_prefix(theme_doc, absolute_prefix):
     if not absolute_prefix:
         return
-    if not absolute_prefix.endswith('/'):
+    if absolute_prefix.startswith(RUNTIME_PREFIX_MARKER):
+        relative = absolute_prefix[len(RUNTIME_PREFIX_MARKER):-len(RUNTIME_PREFIX_END)]
+        if relative and not relative.endswith('/'):
+            absolute_prefix = RUNTIME_PREFIX_MARKER + relative + '/' + RUNTIME_PREFIX_END
+    elif not absolute_prefix.endswith('/'):
         absolute_prefix = absolute_prefix + '/'
     for node in theme_doc.xpath('//*[@src]'):
-        url = urljoin(absolute_prefix, node.get('src'))
+        url = join_url(absolute_prefix, node.get('src'))
         node.set('src', url)
     for node in theme_doc.xpath('//*[@href]'):
-        url = urljoin(absolute_prefix, node.get('href'))
+        url = join_url(absolute_prefix, node.get('href'))
         node.set('href', url)
     for node in theme_doc.xpath('//style'):
         node.text = IMPORT_STYLESHEET.sub(
-            lambda match: match.group('before') + urljoin(absolute_prefix, match.group('url')) + match.group('after'),
+            lambda match: match.group('before') + join_url(absolute_prefix, match.group('url')) + match.group('after'),
             node.text)
     for node in theme_doc.xpath('//comment()[starts-with(., "[if")]'):
         node.text = IMPORT_STYLESHEET.sub(
-            lambda match: match.group('before') + urljoin(absolute_prefix, match.group('url')) + match.group('after'),
+            lambda match: match.group('before') + join_url(absolute_prefix, match.group('url')) + match.group('after'),
             node.text)
         node.text = CONDITIONAL_SRC.sub(
-            lambda match: match.group('before') + urljoin(absolute_prefix, match.group('url')) + match.group('after'),
+            lambda match: match.group('before') + join_url(absolute_prefix, match.group('url')) + match.group('after'),
             node.text)
 
 def add_extra(rules_doc, extra):
@@ -105,7 +136,7 @@ def add_extra(rules_doc, extra):
     root.extend(extra_elements)
     return rules_doc
 
-def add_theme(rules_doc, theme, parser=None, absolute_prefix=None, read_network=False):
+def add_theme(rules_doc, theme, parser=None, absolute_prefix=None, read_network=False, dependencies=None):
     if isinstance(theme, basestring) and theme[:6] in ('ftp://', 'http:/', 'https:'):
         raise ValueError("Supplied theme '%s', but network access denied." % theme)
     if absolute_prefix is None:
@@ -115,10 +146,32 @@ def add_theme(rules_doc, theme, parser=None, absolute_prefix=None, read_network=
     root = rules_doc.getroot()
     element = root.makeelement(fullname(namespaces['diazo'], 'theme'))
     root.append(element)
+    if dependencies is not None and isinstance(theme, basestring):
+        dependencies.append(theme)
     theme_doc = etree.parse(theme, parser=parser)
     expand_theme(element, theme_doc, absolute_prefix)
     return rules_doc
 
+def xinclude_dependencies(rules_doc, dependencies, seen=None):
+    """Record the urls of documents XIncluded by the rules, recursively.
+    Must be called before the XIncludes are processed.
+    """
+    if seen is None:
+        seen = set()
+    for element in rules_doc.xpath('//xi:include[@href]', namespaces=namespaces):
+        url = urljoin(element.base or '', element.get('href'))
+        if url in seen:
+            continue
+        seen.add(url)
+        dependencies.append(url)
+        if element.get('parse', 'xml') != 'xml':
+            continue
+        try:
+            fragment = etree.parse(url)
+        except (IOError, etree.XMLSyntaxError):
+            continue
+        xinclude_dependencies(fragment, dependencies, seen)
+
 def fixup_theme_comment_selectors(rules):
     """Comments must be converted to <xsl:comment> to be output, doing it early
     allows them to get an xml:id so they can be matched in the theme. The theme
@@ -129,51 +182,95 @@ def fixup_theme_comment_selectors(rules):
     return rules
 
 def process_rules(rules, theme=None, extra=None, trace=None, css=True, xinclude=True, absolute_prefix=None,
-                  includemode=None, update=True, parser=None, rules_parser=None, read_network=False, stop=None):
+                  includemode=None, update=True, parser=None, rules_parser=None, read_network=False, stop=None,
+                  dependencies=None, native=False, profile=None):
+    """Run the rules through the compilation stages, stopping after stage
+    ``stop`` if given. If ``profile`` is a list, a ``(stage, seconds, nodes,
+    memory)`` tuple is appended to it for each stage run.
+    """
     if trace:
         trace = '1'
     else:
         trace = '0'
     if rules_parser is None:
         rules_parser = etree.XMLParser(recover=False)
+    start = time.time()
+    # Files are recorded before they are read, so that a cache can hash the
+    # contents the compiler saw
+    if dependencies is not None and isinstance(rules, basestring):
+        dependencies.append(rules)
     rules_doc = etree.parse(rules, parser=rules_parser)
+    if dependencies is not None and not isinstance(rules, basestring) and rules_doc.docinfo.URL:
+        dependencies.append(rules_doc.docinfo.URL)
+    record_stage(profile, 'parse', start, rules_doc)
     if stop == 0: return rules_doc
     if parser is None:
         parser = etree.HTMLParser()
     if xinclude:
+        start = time.time()
+        # Reading the XIncluded files ahead of the XInclude pass is only
+        # worth it when a cache hashes them
+        if isinstance(dependencies, Dependencies):
+            xinclude_dependencies(rules_doc, dependencies)
         rules_doc.xinclude() # XXX read_network limitation not yet supported for xinclude
+        record_stage(profile, 'xinclude', start, rules_doc)
     if stop == 1: return rules_doc
     if update:
+        start = time.time()
         rules_doc = update_namespace(rules_doc)
+        record_stage(profile, 'update_namespace', start, rules_doc)
     if stop == 2: return rules_doc
     if css:
+        start = time.time()
         rules_doc = convert_css_selectors(rules_doc)
+        record_stage(profile, 'convert_css_selectors', start, rules_doc)
     if stop == 3: return rules_doc
+    start = time.time()
     rules_doc = fixup_theme_comment_selectors(rules_doc)
+    record_stage(profile, 'fixup_theme_comment_selectors', start, rules_doc)
     if stop == 4: return rules_doc
-    rules_doc = expand_themes(rules_doc, parser, absolute_prefix, read_network)
+    start = time.time()
+    rules_doc = expand_themes(rules_doc, parser, absolute_prefix, read_network, dependencies)
     if theme is not None:
-        rules_doc = add_theme(rules_doc, theme, parser, absolute_prefix, read_network)
+        rules_doc = add_theme(rules_doc, theme, parser, absolute_prefix, read_network, dependencies)
+    record_stage(profile, 'expand_themes', start, rules_doc)
     if stop == 5: return rules_doc
     if includemode is None:
         includemode = 'document'
     includemode = "'%s'" % includemode
+    start = time.time()
     rules_doc = normalize_rules(rules_doc, includemode=includemode)
+    record_stage(profile, 'normalize_rules', start, rules_doc)
     if stop == 6: return rules_doc
-    rules_doc = apply_conditions(rules_doc)
-    if stop == 7: return rules_doc
-    rules_doc = merge_conditions(rules_doc)
-    if stop == 8: return rules_doc
-    rules_doc = fixup_themes(rules_doc)
-    if stop == 9: return rules_doc
-    rules_doc = annotate_themes(rules_doc)
-    if stop == 10: return rules_doc
+    if native and (stop is None or stop > 10):
+        # The native stages modify the document in place, performing the
+        # work of stages 7 to 10 in two passes
+        start = time.time()
+        native_stages.apply_conditions(rules_doc)
+        record_stage(profile, 'native.apply_conditions', start, rules_doc)
+        start = time.time()
+        native_stages.fixup_themes(rules_doc)
+        record_stage(profile, 'native.fixup_themes', start, rules_doc)
+    else:
+        for number, name, transform in (
+            (7, 'apply_conditions', apply_conditions),
+            (8, 'merge_conditions', merge_conditions),
+            (9, 'fixup_themes', fixup_themes),
+            (10, 'annotate_themes', annotate_themes),
+            ):
+            start = time.time()
+            rules_doc = transform(rules_doc)
+            record_stage(profile, name, start, rules_doc)
+            if stop == number: return rules_doc
+    start = time.time()
     rules_doc = annotate_rules(rules_doc)
+    record_stage(profile, 'annotate_rules', start, rules_doc)
     if stop == 11: return rules_doc
+    start = time.time()
     rules_doc = apply_rules(rules_doc, trace=trace)
+    record_stage(profile, 'apply_rules', start, rules_doc)
     return rules_doc
 
-
 def main():
     """Called from console script
     """
@@ -196,6 +293,10 @@ def main():
     if options.trace:
         logger.setLevel(logging.DEBUG)
 
+    profile = None
+    if options.profile:
+        profile = []
+
     rules_doc = process_rules(
         options.rules,
         theme=options.theme,
@@ -205,11 +306,15 @@ def main():
         includemode=options.includemode,
         read_network=options.read_network,
         stop=options.stop,
+        native=options.native,
+        profile=profile,
         )
     root = rules_doc.getroot()
     if not root.tail:
         root.tail = '\n'
     rules_doc.write(options.output, pretty_print=options.pretty_print)
+    if profile is not None:
+        sys.stderr.write(format_profile(profile))
 
 if __name__ == '__main__':
     main()
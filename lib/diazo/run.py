@@ -16,7 +16,8 @@ import os.path
 from lxml import etree
 
 from diazo.compiler import compile_theme
-from diazo.utils import AC_READ_NET, AC_READ_FILE, _createOptionParser, split_params, quote_param
+from diazo.utils import AC_READ_NET, AC_READ_FILE, _createOptionParser, split_params, quote_param, \
+    format_profile
 
 logger = logging.getLogger('diazo')
 
@@ -46,6 +47,9 @@ def main():
     op.add_option("--parameters", metavar="param1=val1,param2=val2",
                       help="Set the values of arbitrary parameters",
                       dest="parameters", default=None)
+    op.add_option("--runtime-prefix", action="store_true",
+                      help="Prefix relative urls in the theme with the diazo-prefix parameter when the theme is applied, defaulting to the absolute prefix",
+                      dest="runtime_prefix", default=False)
     (options, args) = op.parse_args()
 
     if len(args) > 2:
@@ -79,6 +83,10 @@ def main():
         if options.xsl_params:
             xsl_params = split_params(options.xsl_params)
         
+        profile = None
+        if options.profile:
+            profile = []
+
         output_xslt = compile_theme(
             rules=options.rules,
             theme=options.theme,
@@ -89,7 +97,12 @@ def main():
             includemode=options.includemode,
             indent=options.pretty_print,
             xsl_params=xsl_params,
+            native=options.native,
+            profile=profile,
+            runtime_prefix=options.runtime_prefix,
             )
+        if profile is not None:
+            sys.stderr.write(format_profile(profile))
 
     if content == '-':
         content = sys.stdin
@@ -0,0 +1,87 @@
+import sys
+import os
+import os.path
+import re
+import shutil
+import tempfile
+
+import unittest2 as unittest
+
+if __name__ == '__main__':
+    __file__ = sys.argv[0]
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+MANIFEST = """\
+[DEFAULT]
+absolute-prefix = /static
+
+[replace]
+rules = %(here)s/replace/rules.xml
+theme = %(here)s/replace/theme.html
+output = build/replace.xsl
+
+[copy]
+rules = %(here)s/copy/rules.xml
+theme = %(here)s/copy/theme.html
+output = build/copy.xsl
+custom-parameters = foo=bar
+
+[missing]
+rules = %(here)s/missing/rules.xml
+output = build/missing.xsl
+"""
+
+def normalize(compiled):
+    ids = {}
+    return re.sub(r'\bidm?\d+\b', lambda m: ids.setdefault(m.group(0), 'id%d' % len(ids)), compiled)
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.manifest = os.path.join(self.tempdir, 'manifest.ini')
+        f = open(self.manifest, 'w')
+        f.write(MANIFEST.replace('%(here)s', HERE))
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_read_manifest(self):
+        from diazo.batch import read_manifest
+
+        items = dict((item['name'], item) for item in read_manifest(self.manifest))
+        self.assertEqual(sorted(items), ['copy', 'missing', 'replace'])
+        self.assertEqual(items['replace']['output'], os.path.join(self.tempdir, 'build', 'replace.xsl'))
+        self.assertEqual(items['replace']['options'], {'absolute_prefix': '/static'})
+        self.assertEqual(items['copy']['options']['xsl_params'], {'foo': 'bar'})
+        self.assertEqual(items['missing']['theme'], None)
+
+    def compile(self, jobs):
+        from lxml import etree
+        from diazo.batch import read_manifest, compile_items
+        from diazo.compiler import compile_theme
+
+        items = read_manifest(self.manifest)
+        results = dict((name, error) for name, seconds, error in compile_items(items, jobs=jobs))
+        self.assertEqual(results['replace'], None)
+        self.assertEqual(results['copy'], None)
+        self.assertTrue(results['missing'].startswith('IOError'))
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, 'build', 'missing.xsl')))
+
+        expected = compile_theme(os.path.join(HERE, 'copy', 'rules.xml'),
+            os.path.join(HERE, 'copy', 'theme.html'),
+            absolute_prefix='/static', xsl_params={'foo': 'bar'})
+        output = etree.parse(os.path.join(self.tempdir, 'build', 'copy.xsl'))
+        self.assertEqual(normalize(etree.tostring(output)), normalize(etree.tostring(expected)))
+
+    def test_compile_serial(self):
+        self.compile(jobs=1)
+
+    def test_compile_parallel(self):
+        self.compile(jobs=2)
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,171 @@
+import sys
+import os
+import os.path
+import shutil
+import tempfile
+
+import unittest2 as unittest
+
+if __name__ == '__main__':
+    __file__ = sys.argv[0]
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+class TestThemeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tempdir, 'cache')
+        self.testdir = os.path.join(self.tempdir, 'xinclude')
+        shutil.copytree(os.path.join(HERE, 'xinclude'), self.testdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def compile(self, cache, **kw):
+        from diazo.compiler import compile_theme
+        return compile_theme(os.path.join(self.testdir, 'rules.xml'),
+            theme=os.path.join(self.testdir, 'theme.html'),
+            cache=cache, **kw)
+
+    def key(self, cache, **kw):
+        return cache.key(os.path.join(self.testdir, 'rules.xml'),
+            theme=os.path.join(self.testdir, 'theme.html'), **kw)
+
+    def manifests(self):
+        return [name[:-len('.deps')] for name in os.listdir(self.cachedir)
+                if name.endswith('.deps')]
+
+    def test_store_and_load(self):
+        from lxml import etree
+        from diazo.cache import ThemeCache
+
+        cache = ThemeCache(self.cachedir)
+        self.assertEqual(self.manifests(), [])
+
+        compiled = etree.tostring(self.compile(cache))
+        key, = self.manifests()
+        self.assertEqual(cache.get(key), compiled)
+        self.assertEqual(etree.tostring(self.compile(cache)), compiled)
+
+        manifest = open(os.path.join(self.cachedir, key + '.deps')).read().splitlines()
+        self.assertEqual(sorted(os.path.basename(url) for url in manifest),
+                         ['included-rules.xml', 'rules.xml', 'theme.html'])
+
+    def test_options_change_key(self):
+        from diazo.cache import ThemeCache
+
+        cache = ThemeCache(self.cachedir)
+        self.assertNotEqual(self.key(cache), self.key(cache, absolute_prefix='/static'))
+        self.assertNotEqual(self.key(cache, xsl_params={'foo': 'bar'}),
+                            self.key(cache, xsl_params={'foo': 'baz'}))
+        self.assertEqual(self.key(cache, includemode='esi'), self.key(cache, includemode='esi'))
+
+    def test_xinclude_change_invalidates(self):
+        from diazo.cache import ThemeCache
+
+        cache = ThemeCache(self.cachedir)
+        self.compile(cache)
+        key, = self.manifests()
+        self.assertNotEqual(cache.get(key), None)
+
+        included = open(os.path.join(self.testdir, 'included-rules.xml'), 'a')
+        included.write('\n')
+        included.close()
+        self.assertEqual(cache.get(key), None)
+
+        self.compile(cache)
+        self.assertNotEqual(cache.get(key), None)
+
+    def test_xinclude_not_read_ahead_without_cache(self):
+        # Without a cache the XIncluded files are only read by the XInclude
+        # pass, so are not recorded
+        dependencies = []
+        self.compile(None, dependencies=dependencies)
+        self.assertEqual(sorted(os.path.basename(url) for url in dependencies),
+                         ['rules.xml', 'theme.html'])
+
+    def test_unreadable_rules_not_cached(self):
+        from StringIO import StringIO
+        from diazo.cache import ThemeCache
+
+        cache = ThemeCache(self.cachedir)
+        rules = StringIO(open(os.path.join(self.testdir, 'rules.xml')).read())
+        self.assertEqual(cache.key(rules), None)
+
+    def test_edit_while_compiling(self):
+        from diazo.cache import Dependencies, ThemeCache
+
+        cache = ThemeCache(self.cachedir)
+        key = self.key(cache)
+        included = os.path.join(self.testdir, 'included-rules.xml')
+        dependencies = Dependencies([os.path.join(self.testdir, 'rules.xml'), included])
+        # Store under the contents hashed when the files were read
+        cache.set(key, '<compiled/>', dependencies)
+        self.assertEqual(cache.get(key), '<compiled/>')
+
+        # A file which changes before the compiled theme is stored may not
+        # match what the compiler read, so nothing is stored
+        dependencies = Dependencies([os.path.join(self.testdir, 'rules.xml'), included])
+        f = open(included, 'a')
+        f.write('\n')
+        f.close()
+        cache.set(key, '<stale/>', dependencies)
+        self.assertEqual(cache.get(key), None)
+
+    def test_evict_least_recently_used(self):
+        import time
+        from diazo.cache import ThemeCache
+
+        cache = ThemeCache(self.cachedir)
+        dependencies = [os.path.join(self.testdir, 'rules.xml')]
+        for key in ['a', 'b', 'c']:
+            cache.set(key, '<compiled/>', dependencies)
+        open(os.path.join(self.cachedir, 'orphan.xsl'), 'w').write('<stale/>')
+        past = time.time() - 100
+        for name in os.listdir(self.cachedir):
+            os.utime(os.path.join(self.cachedir, name), (past, past))
+        for i in range(3):
+            self.assertEqual(cache.get('b'), '<compiled/>')
+
+        # Entries are removed whole, keeping the most recently read
+        entry_size = sum([os.path.getsize(os.path.join(self.cachedir, name))
+                          for name in os.listdir(self.cachedir) if name != 'orphan.xsl']) // 3
+        cache.max_size = entry_size
+        cache.evict()
+        self.assertEqual(sorted(self.manifests()), ['b'])
+        self.assertEqual(len(os.listdir(self.cachedir)), 2)
+        self.assertEqual(cache.get('b'), '<compiled/>')
+
+    def test_write_error(self):
+        from diazo import cache as cache_module
+        from diazo.cache import ThemeCache
+
+        class FullFile(object):
+            def __init__(self, fd, mode):
+                os.close(fd)
+            def write(self, data):
+                raise IOError(28, 'No space left on device')
+            def close(self):
+                pass
+
+        cache = ThemeCache(self.cachedir)
+        fdopen = cache_module.os.fdopen
+        cache_module.os.fdopen = FullFile
+        try:
+            # A failed write is a cache miss, leaving no temporary files
+            self.compile(cache)
+        finally:
+            cache_module.os.fdopen = fdopen
+        self.assertEqual(os.listdir(self.cachedir), [])
+
+    def test_max_size(self):
+        from diazo.cache import ThemeCache
+
+        cache = ThemeCache(self.cachedir, max_size=1)
+        self.compile(cache)
+        self.assertEqual(os.listdir(self.cachedir), [])
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,250 @@
+import sys
+import os
+import os.path
+import re
+
+import unittest2 as unittest
+
+if __name__ == '__main__':
+    __file__ = sys.argv[0]
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+def testfiles(name):
+    theme = os.path.join(HERE, name, 'theme.html')
+    if not os.path.exists(theme):
+        theme = None
+    return (os.path.join(HERE, name, 'rules.xml'), theme)
+
+def normalize(compiled):
+    """Replace the ids generated by the compiler, which differ between runs
+    """
+    from lxml import etree
+    ids = {}
+    return re.sub(r'\bidm?\d+\b', lambda m: ids.setdefault(m.group(0), 'id%d' % len(ids)), etree.tostring(compiled))
+
+class TestThemeCompiler(unittest.TestCase):
+
+    def test_compile(self):
+        from diazo.compiler import ThemeCompiler, compile_theme
+
+        rules, theme = testfiles('replace')
+        compiler = ThemeCompiler()
+        expected = normalize(compile_theme(rules, theme))
+        self.assertEqual(normalize(compiler.compile(rules, theme)), expected)
+        self.assertEqual(normalize(compiler.compile(rules, theme)), expected)
+
+    def test_defaults(self):
+        from diazo.compiler import ThemeCompiler, compile_theme
+
+        rules, theme = testfiles('replace')
+        compiler = ThemeCompiler(indent=False, xsl_params={'foo': 'bar'})
+        expected = normalize(compile_theme(rules, theme, indent=False, xsl_params={'foo': 'bar'}))
+        self.assertEqual(normalize(compiler.compile(rules, theme)), expected)
+
+    def test_compile_many(self):
+        from diazo.compiler import ThemeCompiler, compile_theme
+
+        names = ['replace', 'copy', 'multi-theme-1']
+        compiler = ThemeCompiler()
+        items = [testfiles(name) + ({'absolute_prefix': '/static'},) for name in names]
+        results = [normalize(compiled) for compiled in compiler.compile_many(items)]
+        expected = [normalize(compile_theme(rules, theme, absolute_prefix='/static'))
+                    for rules, theme, options in items]
+        self.assertEqual(results, expected)
+
+    def test_threads(self):
+        import threading
+        from diazo.compiler import ThemeCompiler, compile_theme
+
+        rules, theme = testfiles('multi-theme-1')
+        expected = normalize(compile_theme(rules, theme))
+        compiler = ThemeCompiler()
+        results = []
+
+        def compile():
+            for i in range(5):
+                results.append(normalize(compiler.compile(rules, theme)))
+
+        threads = [threading.Thread(target=compile) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [expected] * 20)
+
+    def test_profile(self):
+        from diazo.compiler import ThemeCompiler
+        from diazo.utils import format_profile
+
+        rules, theme = testfiles('replace')
+        profile = []
+        ThemeCompiler().compile(rules, theme, profile=profile)
+        names = [stage[0] for stage in profile]
+        self.assertEqual(names[:3], ['parse', 'xinclude', 'update_namespace'])
+        self.assertEqual(names[-3:], ['apply_rules', 'emit_stylesheet', 'set_parser'])
+        self.assertTrue('annotate_themes' in names)
+        for name, seconds, nodes, memory in profile:
+            self.assertTrue(seconds >= 0)
+            self.assertTrue(memory is None or memory > 0)
+        self.assertTrue(profile[0][2] > 0)
+        self.assertTrue('emit_stylesheet' in format_profile(profile))
+
+    def test_format_profile(self):
+        from diazo.utils import format_profile
+
+        lines = format_profile([('parse', 0.001, 10, 1000), ('xinclude', 0.002, None, 1500)]).splitlines()
+        self.assertEqual(lines[0].split(), ['stage', 'ms', 'nodes', 'RSS', 'KB', '+KB'])
+        self.assertEqual(lines[1].split(), ['parse', '1.00', '10', '1000', '-'])
+        self.assertEqual(lines[2].split(), ['xinclude', '2.00', '-', '1500', '+500'])
+        self.assertEqual(lines[3].split(), ['total', '3.00'])
+
+    def test_conditions_hoisted(self):
+        from StringIO import StringIO
+        from lxml import etree
+        from diazo.compiler import compile_theme
+
+        rules = StringIO('''<rules xmlns="http://namespaces.plone.org/diazo"
+                                xmlns:css="http://namespaces.plone.org/diazo/css">
+            <rules css:if-content="#shared">
+                <replace css:theme="#one" css:content="#a"/>
+                <replace css:theme="#two" css:content="#b"/>
+            </rules>
+            <drop css:theme="#three" css:if-content="#other"/>
+        </rules>''')
+        theme = StringIO('<html><body><div id="one"/><div id="two"/><div id="three"/></body></html>')
+        compiled = compile_theme(rules, theme)
+        variables = compiled.xpath('/xsl:stylesheet/xsl:variable[starts-with(@name, "diazo-condition-")]',
+                                   namespaces={'xsl': 'http://www.w3.org/1999/XSL/Transform'})
+        self.assertEqual(len(variables), 2)
+        tests = compiled.xpath('//@test[starts-with(., "$diazo-condition-")]')
+        for variable in variables:
+            self.assertTrue(variable.get('select').startswith('boolean('))
+        self.assertEqual(sorted(set(tests)), sorted('$' + v.get('name') for v in variables))
+        self.assertEqual(len(tests), 3)
+
+        transform = etree.XSLT(compiled)
+        content = etree.HTML('<html><body><p id="shared"/><p id="a">A</p><p id="b">B</p></body></html>')
+        self.assertEqual(len(transform(content).xpath('//div')), 1)
+        self.assertEqual(len(transform(content).xpath('//p')), 2)
+
+    def test_runtime_prefix(self):
+        from StringIO import StringIO
+        from lxml import etree
+        from diazo.compiler import compile_theme
+
+        rules = '''<rules xmlns="http://namespaces.plone.org/diazo"
+                                xmlns:css="http://namespaces.plone.org/diazo/css">
+            <replace css:theme="#one" css:content="#a"/>
+        </rules>'''
+        theme = ('<html><head><link href="style.css"/><style>@import url(x.css);</style>'
+                 '<!--[if IE]><script src="ie.js"></script><![endif]--></head>'
+                 '<body><img src="img/a.png"/><a href="/abs">x</a><div id="one"/></body></html>')
+        content = etree.HTML('<html><body><p id="a">A</p></body></html>')
+        def output(transform, **params):
+            return str(transform(content, **params)).replace('/static/', '/cdn/')
+
+        expected = output(etree.XSLT(compile_theme(StringIO(rules), StringIO(theme), absolute_prefix='/static')))
+        self.assertTrue('src="/cdn/ie.js"' in expected)
+        transform = etree.XSLT(compile_theme(StringIO(rules), StringIO(theme), absolute_prefix='/static',
+                                             runtime_prefix=True))
+        self.assertEqual(output(transform), expected)
+        self.assertEqual(str(transform(content, **{'diazo-prefix': "'/cdn'"})), expected)
+
+    def test_runtime_prefix_dot_segments(self):
+        from StringIO import StringIO
+        from lxml import etree
+        from diazo.compiler import compile_theme
+
+        rules = '''<rules xmlns="http://namespaces.plone.org/diazo"
+                                xmlns:css="http://namespaces.plone.org/diazo/css">
+            <replace css:theme="#one" css:content="#a"/>
+        </rules>'''
+        theme = ('<html><head><link href="./x.css"/><style>@import url(../up.css);</style>'
+                 '<script src="//other.example.com/p.js"></script></head>'
+                 '<body><img src="a/../b/./c.png"/><a href="..">up</a><a href="#top">top</a>'
+                 '<a href="/abs">abs</a><div id="one"/></body></html>')
+        content = etree.HTML('<html><body><p id="a">A</p></body></html>')
+        transform = etree.XSLT(compile_theme(StringIO(rules), StringIO(theme), runtime_prefix=True))
+
+        # The same as compiling with the prefix, where .. reaches above it
+        # and root-relative urls keep the host of the prefix
+        for prefix in ['/static/theme', '/static/theme/', 'http://cdn.example.com/a/b',
+                       '//cdn.example.com/a/b']:
+            expected = etree.XSLT(compile_theme(StringIO(rules), StringIO(theme), absolute_prefix=prefix))
+            self.assertEqual(str(transform(content, **{'diazo-prefix': "'%s'" % prefix})),
+                             str(expected(content)))
+        output = str(transform(content, **{'diazo-prefix': "'/static/theme'"}))
+        self.assertTrue('href="/static/theme/x.css"' in output)
+        self.assertTrue('@import url(/static/up.css);' in output)
+        self.assertTrue('<a href="/abs">' in output)
+        output = str(transform(content, **{'diazo-prefix': "'http://cdn.example.com/a/b'"}))
+        self.assertTrue('<a href="http://cdn.example.com/abs">' in output)
+        self.assertTrue('src="http://other.example.com/p.js"' in output)
+
+        # Without a prefix the urls are left alone
+        expected = etree.XSLT(compile_theme(StringIO(rules), StringIO(theme)))
+        self.assertEqual(str(transform(content)), str(expected(content)))
+        self.assertTrue('src="a/../b/./c.png"' in str(transform(content)))
+
+        # .. does not reach above the root
+        output = str(transform(content, **{'diazo-prefix': "'/'"}))
+        self.assertTrue('@import url(/up.css);' in output)
+        self.assertTrue('<a href="/">up</a>' in output)
+        output = str(transform(content, **{'diazo-prefix': "'http://cdn.example.com'"}))
+        self.assertTrue('@import url(http://cdn.example.com/up.css);' in output)
+
+    def test_find_includes(self):
+        from StringIO import StringIO
+        from diazo.compiler import compile_theme, find_includes
+
+        rules = StringIO('''<rules xmlns="http://namespaces.plone.org/diazo"
+                                xmlns:css="http://namespaces.plone.org/diazo/css">
+            <replace css:theme="#one" css:content="#a" href="/a.html"/>
+            <rules if-path="/news">
+                <replace css:theme="#two" css:content="#b" href="/b.html"/>
+                <after css:theme-children="#two" css:content="#c" href="/a.html"/>
+            </rules>
+            <replace css:theme="#three" css:content="#c" href="/c.html" if="$foo"/>
+        </rules>''')
+        theme = StringIO('<html><body><div id="one"/><div id="two"/><div id="three"/></body></html>')
+        includes = dict(find_includes(compile_theme(rules, theme, xsl_params={'foo': True})))
+        self.assertEqual(sorted(includes), ['/a.html', '/b.html', '/c.html'])
+        self.assertEqual(includes['/a.html'], None)
+        self.assertTrue("starts-with($normalized_path, '/news/')" in includes['/b.html'])
+        self.assertTrue('$foo' in includes['/c.html'])
+
+
+class TestNativeStages(unittest.TestCase):
+
+    def test_native_matches_xslt(self):
+        from diazo.compiler import compile_theme
+
+        for name in sorted(os.listdir(HERE)):
+            if not os.path.exists(os.path.join(HERE, name, 'rules.xml')):
+                continue
+            rules, theme = testfiles(name)
+            expected = normalize(compile_theme(rules, theme))
+            self.assertEqual(normalize(compile_theme(rules, theme, native=True)), expected, name)
+
+    def test_conditions(self):
+        from lxml import etree
+        from diazo.native import apply_conditions
+
+        rules_doc = etree.ElementTree(etree.XML(
+            '<rules xmlns="http://namespaces.plone.org/diazo" if-path="/a/ b">'
+            '<replace content="//x" if-content="" if-not="$foo"/>'
+            '<drop theme="//y"/>'
+            '</rules>'))
+        apply_conditions(rules_doc)
+        root = rules_doc.getroot()
+        path = "($normalized_path = '/a/' or contains($normalized_path, '/b/'))"
+        self.assertEqual(root.get('merged-condition'), path)
+        self.assertEqual(root[0].get('condition'), '//x and not($foo)')
+        self.assertEqual(root[0].get('merged-condition'), path + ' and //x and not($foo)')
+        self.assertEqual(root[1].get('condition'), None)
+        self.assertEqual(root[1].get('merged-condition'), path)
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
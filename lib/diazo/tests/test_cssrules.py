@@ -0,0 +1,78 @@
+import sys
+
+import unittest2 as unittest
+
+if __name__ == '__main__':
+    __file__ = sys.argv[0]
+
+class TestKeyXPath(unittest.TestCase):
+
+    def key_xpath(self, selector):
+        from experimental.cssselect import css_to_xpath
+        from diazo.cssrules import key_xpath
+        return key_xpath(css_to_xpath(selector, prefix='//'))
+
+    def test_id(self):
+        self.assertEqual(self.key_xpath('#portal-column-content'), "key('diazo-id', 'portal-column-content')")
+        self.assertEqual(self.key_xpath('div#content'), "key('diazo-id', 'content')[self::div]")
+        self.assertEqual(self.key_xpath('#content p'), "key('diazo-id', 'content')//p")
+
+    def test_class(self):
+        self.assertEqual(self.key_xpath('.documentFirstHeading'), "key('diazo-class', 'documentFirstHeading')")
+        self.assertEqual(self.key_xpath('h1.title'), "key('diazo-class', 'title')[self::h1]")
+
+    def test_group(self):
+        self.assertEqual(self.key_xpath('#one, .two'), "key('diazo-id', 'one') | key('diazo-class', 'two')")
+        self.assertEqual(self.key_xpath('#one, p'), None)
+
+    def test_not_simple(self):
+        self.assertEqual(self.key_xpath('p'), None)
+        self.assertEqual(self.key_xpath('div#content.main'), None)
+        self.assertEqual(self.key_xpath('body > #content'), None)
+        self.assertEqual(self.key_xpath('#content:first-child'), None)
+
+    def test_convert(self):
+        from lxml import etree
+        from diazo.cssrules import convert_css_selectors
+
+        rules = etree.XML('''<rules xmlns="http://namespaces.plone.org/diazo"
+            xmlns:css="http://namespaces.plone.org/diazo/css">
+            <replace css:theme="#main" css:content="#content"/>
+            <replace css:theme="#main" css:content="#content" href="/other"/>
+            <drop css:content="#portlets"/>
+            <rules css:if-content=".special"/>
+        </rules>''')
+        convert_css_selectors(rules)
+        replace, external, drop, nested = rules
+        self.assertEqual(replace.get('content'), "key('diazo-id', 'content')")
+        # External documents and template match patterns are not indexed
+        self.assertEqual(external.get('content'), "//*[@id = 'content']")
+        self.assertEqual(drop.get('content'), "//*[@id = 'portlets']")
+        self.assertEqual(nested.get('if-content'), "key('diazo-class', 'special')")
+
+
+class TestSelectorCache(unittest.TestCase):
+
+    def test_convert_css(self):
+        from experimental.cssselect import css_to_xpath
+        from diazo.cssrules import convert_css, selector_cache, selector_cache_stats
+
+        selector_cache.clear()
+        self.assertEqual(convert_css('#main > p', '//'), css_to_xpath('#main > p', prefix='//'))
+        self.assertEqual(convert_css('#main > p', '//'), css_to_xpath('#main > p', prefix='//'))
+        self.assertEqual(convert_css('#main > p'), css_to_xpath('#main > p', prefix='descendant-or-self::'))
+        stats = selector_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (1, 2, 2))
+
+    def test_warm(self):
+        from diazo.cssrules import convert_css, selector_cache, warm_selector_cache
+
+        selector_cache.clear()
+        self.assertEqual(warm_selector_cache(['#one', '.two', 'p:bogus(']), 4)
+        self.assertEqual(warm_selector_cache(['#one']), 0)
+        convert_css('.two', '//')
+        self.assertEqual(selector_cache.stats()['hits'], 1)
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,57 @@
+import sys
+
+import unittest2 as unittest
+
+if __name__ == '__main__':
+    __file__ = sys.argv[0]
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counters(self):
+        from diazo.metrics import Metrics
+
+        metrics = Metrics()
+        metrics.increment('themed')
+        metrics.increment('bytes_out', 100)
+        metrics.increment('bytes_out', 50)
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['themed'], 1)
+        self.assertEqual(counters['bytes_out'], 150)
+        self.assertEqual(counters['errors'], 0)
+        metrics.clear()
+        self.assertEqual(metrics.snapshot()['counters']['themed'], 0)
+
+    def test_histogram(self):
+        from diazo.metrics import Metrics
+
+        metrics = Metrics(buckets=(0.1, 0.01))
+        for seconds in (0.005, 0.05, 0.5):
+            metrics.observe('transform', seconds)
+        phase = metrics.snapshot()['phases']['transform']
+        self.assertEqual(phase['count'], 3)
+        self.assertAlmostEqual(phase['sum'], 0.555)
+        self.assertEqual(phase['buckets'], [(0.01, 1), (0.1, 2)])
+
+    def test_prometheus(self):
+        from diazo.metrics import Metrics
+
+        metrics = Metrics(buckets=(0.01,))
+        metrics.increment('themed', 2)
+        metrics.observe('app', 0.5)
+        lines = metrics.prometheus().splitlines()
+        self.assertTrue('# TYPE diazo_themed_total counter' in lines)
+        self.assertTrue('diazo_themed_total 2' in lines)
+        self.assertTrue('diazo_phase_seconds_bucket{phase="app",le="0.01"} 0' in lines)
+        self.assertTrue('diazo_phase_seconds_bucket{phase="app",le="+Inf"} 1' in lines)
+        self.assertTrue('diazo_phase_seconds_sum{phase="app"} 0.5' in lines)
+        self.assertTrue('diazo_phase_seconds_count{phase="app"} 1' in lines)
+
+    def test_server_timing(self):
+        from diazo.metrics import server_timing
+
+        self.assertEqual(server_timing({'transform': 0.0123, 'app': 0.1}),
+                         'diazo-app;dur=100.0, diazo-transform;dur=12.3')
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
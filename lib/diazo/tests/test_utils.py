@@ -0,0 +1,42 @@
+import sys
+
+import unittest2 as unittest
+
+if __name__ == '__main__':
+    __file__ = sys.argv[0]
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_maxsize(self):
+        from diazo.utils import LRUCache
+
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.stats(), dict(hits=1, misses=1, size=2, maxsize=2, bytes=0, maxbytes=None))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()['hits'], 0)
+
+    def test_maxbytes(self):
+        from diazo.utils import LRUCache
+
+        cache = LRUCache(maxbytes=10)
+        cache.set('a', 'a', 4)
+        cache.set('b', 'b', 4)
+        cache.set('a', 'A', 5)
+        self.assertEqual(cache.bytes, 9)
+        cache.set('c', 'c', 4)
+        self.assertEqual(sorted(cache._links), ['a', 'c'])
+        self.assertEqual(cache.bytes, 9)
+        cache.set('d', 'd', 11)
+        self.assertFalse('d' in cache)
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -183,6 +183,26 @@ class TestXSLTMiddleware(unittest.TestCase):
         self.assertTrue('<div id="content">Content content</div>' in response.body)
         self.assertTrue('<title>Transformed</title>' in response.body)
     
+    def test_transform_response(self):
+        from lxml import etree
+        
+        from diazo.wsgi import XSLTMiddleware
+        from webob import Request
+        
+        app = XSLTMiddleware(None, {}, tree=etree.fromstring(XSLT))
+        environ = Request.blank('/').environ
+        headerlist = [('Content-Type', 'text/html'), ('Content-Length', str(len(HTML)))]
+        status, headerlist, body = app.transform_response(environ, '200 OK', headerlist, HTML)
+        
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(dict(headerlist)['Content-Type'], 'text/html; charset=UTF-8')
+        self.assertEqual(dict(headerlist)['Content-Length'], str(len(body)))
+        self.assertTrue('<div id="content">Content content</div>' in body)
+        
+        # Responses which are not themed are returned unchanged
+        status, headerlist, body = app.transform_response(environ, '200 OK', [('Content-Type', 'text/plain')], 'Plain')
+        self.assertEqual((status, headerlist, body), ('200 OK', [('Content-Type', 'text/plain')], 'Plain'))
+    
     def test_head_request(self):
         from lxml import etree
         
@@ -225,6 +245,31 @@ class TestXSLTMiddleware(unittest.TestCase):
         
         self.assertEqual(response.headers['Content-Length'], '178')
     
+    def test_serialize_once(self):
+        from lxml import etree
+        
+        from diazo.wsgi import XSLTMiddleware
+        from webob import Request
+        
+        def application(environ, start_response):
+            status = '200 OK'
+            response_headers = [('Content-Type', 'text/html'),
+                                ('Content-Length', '1')]
+            start_response(status, response_headers)
+            return [HTML]
+        
+        app = XSLTMiddleware(application, {}, tree=etree.fromstring(XSLT))
+        headers = []
+        def start_response(status, response_headers, exc_info=None):
+            headers.extend(response_headers)
+        app_iter = app(Request.blank('/').environ, start_response)
+        
+        # The tree is available to later middleware
+        self.assertEqual(app_iter.tree.xpath('//title/text()'), ['Transformed'])
+        body = ''.join(app_iter)
+        self.assertTrue(body is str(app_iter))
+        self.assertEqual(dict(headers)['Content-Length'], str(len(body)))
+    
     def test_dont_update_content_length(self):
         from lxml import etree
         
@@ -505,6 +550,185 @@ class TestXSLTMiddleware(unittest.TestCase):
         self.assertTrue('<div id="content">Content content</div>' in response.body)
         self.assertTrue('<title>Transformed</title>' in response.body)
     
+    def test_compressed_response(self):
+        import gzip
+        import zlib
+        from StringIO import StringIO
+        from lxml import etree
+        
+        from diazo.wsgi import XSLTMiddleware
+        from webob import Request
+        
+        buf = StringIO()
+        f = gzip.GzipFile(fileobj=buf, mode='wb')
+        f.write(HTML)
+        f.close()
+        gzipped = buf.getvalue()
+        
+        def application(environ, start_response):
+            status = '200 OK'
+            response_headers = [('Content-Type', 'text/html'),
+                                ('Content-Encoding', 'gzip'),
+                                ('Content-Length', str(len(gzipped))),
+                                ('ETag', '"1"')]
+            start_response(status, response_headers)
+            return [gzipped[:10], gzipped[10:20], gzipped[20:]]
+        
+        app = XSLTMiddleware(application, {}, tree=etree.fromstring(XSLT), compression_min_size=0)
+        
+        request = Request.blank('/')
+        response = request.get_response(app)
+        self.assertEqual(response.headers.get('Content-Encoding'), None)
+        self.assertTrue('<title>Transformed</title>' in response.body)
+        self.assertEqual(response.headers['Content-Length'], str(len(response.body)))
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        themed = response.body
+        
+        request = Request.blank('/', headers={'Accept-Encoding': 'gzip, deflate'})
+        response = request.get_response(app)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Content-Length'], str(len(response.body)))
+        self.assertTrue(response.headers['ETag'].startswith('W/"1-diazo-'))
+        self.assertEqual(zlib.decompress(response.body, 16 + zlib.MAX_WBITS), themed)
+        
+        # Compression may be turned off or limited to larger responses
+        app = XSLTMiddleware(application, {}, tree=etree.fromstring(XSLT), compression_level=0)
+        response = request.get_response(app)
+        self.assertEqual(response.headers.get('Content-Encoding'), None)
+        self.assertEqual(response.body, themed)
+        app = XSLTMiddleware(application, {}, tree=etree.fromstring(XSLT), compression_min_size=len(themed) + 1)
+        response = request.get_response(app)
+        self.assertEqual(response.body, themed)
+    
+    def test_compress_output(self):
+        import zlib
+        from lxml import etree
+        
+        from diazo.wsgi import XSLTMiddleware
+        from webob import Request
+        
+        # Raw deflate data, as sent by some servers
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        deflated = compressor.compress(HTML) + compressor.flush()
+        
+        def application(environ, start_response):
+            status = '200 OK'
+            response_headers = [('Content-Type', 'text/html'),
+                                ('Content-Encoding', 'deflate')]
+            start_response(status, response_headers)
+            return [deflated]
+        
+        app = XSLTMiddleware(application, {}, tree=etree.fromstring(XSLT),
+            compression_level=9, compression_min_size=0)
+        request = Request.blank('/', headers={'Accept-Encoding': 'gzip;q=0, deflate'})
+        response = request.get_response(app)
+        self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+        self.assertTrue('<title>Transformed</title>' in zlib.decompress(response.body))
+    
+    def test_accepted_encoding(self):
+        from diazo.wsgi import accepted_encoding
+        
+        self.assertEqual(accepted_encoding(None), None)
+        self.assertEqual(accepted_encoding('gzip'), 'gzip')
+        self.assertEqual(accepted_encoding('deflate, gzip'), 'gzip')
+        self.assertEqual(accepted_encoding('gzip;q=0.5, deflate'), 'deflate')
+        self.assertEqual(accepted_encoding('*'), 'gzip')
+        self.assertEqual(accepted_encoding('identity, *;q=0'), None)
+        self.assertEqual(accepted_encoding('br'), None)
+    
+    def test_stream_untransformed(self):
+        from lxml import etree
+        
+        from diazo.wsgi import XSLTMiddleware
+        
+        produced = []
+        closed = []
+        
+        class AppIter(object):
+            def __iter__(self):
+                for i in range(3):
+                    produced.append(i)
+                    yield 'chunk%d' % i
+            def close(self):
+                closed.append(True)
+        
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'application/pdf')])
+            return AppIter()
+        
+        def generator(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'application/pdf')])
+            for i in range(3):
+                produced.append(i)
+                yield 'chunk%d' % i
+        
+        started = []
+        def start_response(status, response_headers, exc_info=None):
+            started.append(status)
+        
+        app = XSLTMiddleware(application, {}, tree=etree.fromstring(XSLT))
+        app_iter = app({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/file'}, start_response)
+        self.assertEqual(started, ['200 OK'])
+        self.assertEqual(produced, [])
+        self.assertTrue(isinstance(app_iter, AppIter))
+        
+        # Applications may start the response when first iterated
+        app = XSLTMiddleware(generator, {}, tree=etree.fromstring(XSLT))
+        app_iter = app({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/file'}, start_response)
+        self.assertEqual(produced, [0])
+        self.assertEqual(''.join(app_iter), 'chunk0chunk1chunk2')
+        app_iter.close()
+    
+    def test_transform_max_size(self):
+        from lxml import etree
+        
+        from diazo.wsgi import XSLTMiddleware
+        from webob import Request
+        
+        headers = [('Content-Type', 'text/html')]
+        def application(environ, start_response):
+            start_response('200 OK', headers)
+            return iter([HTML[:20], HTML[20:]])
+        
+        app = XSLTMiddleware(application, {}, tree=etree.fromstring(XSLT), transform_max_size=len(HTML))
+        response = Request.blank('/').get_response(app)
+        self.assertTrue('<title>Transformed</title>' in response.body)
+        
+        app = XSLTMiddleware(application, {}, tree=etree.fromstring(XSLT), transform_max_size=40)
+        response = Request.blank('/').get_response(app)
+        self.assertEqual(response.body, HTML)
+        
+        headers.append(('Content-Length', str(len(HTML))))
+        response = Request.blank('/').get_response(app)
+        self.assertEqual(response.body, HTML)
+    
+    def test_incremental_parse(self):
+        from lxml import etree, html
+        
+        from diazo.wsgi import XSLTMiddleware
+        from webob import Request
+        
+        produced = []
+        fed = []
+        
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/html')])
+            for i in range(0, len(HTML), 20):
+                produced.append(i)
+                yield HTML[i:i + 20]
+        
+        class Parser(html.HTMLParser):
+            def feed(self, data):
+                fed.append(len(produced))
+                return html.HTMLParser.feed(self, data)
+        
+        app = XSLTMiddleware(application, {}, tree=etree.fromstring(XSLT))
+        app.parser_class = Parser
+        response = Request.blank('/').get_response(app)
+        self.assertTrue('<div id="content">Content content</div>' in response.body)
+        # Each chunk is parsed as it arrives
+        self.assertEqual(fed, range(1, len(produced) + 1))
+    
     def test_301(self):
         from lxml import etree
         
@@ -756,6 +980,308 @@ class TestXSLTMiddleware(unittest.TestCase):
         response = request.get_response(app)
         
         self.assertTrue('<p>value1</p>' in response.body)
+    
+    def test_threads(self):
+        import threading
+        from lxml import etree
+        
+        from diazo.wsgi import XSLTMiddleware
+        from webob import Request
+        
+        def application(environ, start_response):
+            status = environ['test.status']
+            response_headers = [('Content-Type', 'text/html'), ('X-Status', status)]
+            start_response(status, response_headers)
+            return [HTML]
+        
+        app = XSLTMiddleware(application, {}, tree=etree.fromstring(XSLT_PARAM),
+            environ_param_map={'test.param1': 'someparam'})
+        errors = []
+        transforms = []
+        
+        def run(n):
+            transforms.append(app.transform)
+            status = '%d OK' % (200 + n)
+            for i in range(25):
+                request = Request.blank('/')
+                request.environ['test.param1'] = 'thread%d' % n
+                request.environ['test.status'] = status
+                response = request.get_response(app)
+                if response.status != status or response.headers['X-Status'] != status:
+                    errors.append((n, response.status))
+                elif '<p>thread%d</p>' % n not in response.body:
+                    errors.append((n, response.body))
+        
+        threads = [threading.Thread(target=run, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(set(id(transform) for transform in transforms)), 4)
+
+    def test_response_cache(self):
+        from lxml import etree
+        
+        from diazo.wsgi import XSLTMiddleware
+        from webob import Request
+        
+        headers = [('Content-Type', 'text/html')]
+        bodies = [HTML]
+        def application(environ, start_response):
+            start_response('200 OK', list(headers))
+            return [bodies[0]]
+        
+        app = XSLTMiddleware(application, {}, tree=etree.fromstring(XSLT_PARAM),
+            environ_param_map={'test.param1': 'someparam'},
+            response_cache_size=100000)
+        
+        def get(value='value1', **request_headers):
+            request = Request.blank('/', headers=request_headers)
+            request.environ['test.param1'] = value
+            return request.get_response(app)
+        
+        first = get()
+        self.assertTrue('<p>value1</p>' in first.body)
+        
+        # A cache hit does not transform the response
+        def fail(*args, **kw):
+            raise AssertionError("Transformed")
+        transform = app.transform
+        app._local.transform = fail
+        self.assertEqual(get().body, first.body)
+        self.assertEqual(get().headers['Content-Type'], first.headers['Content-Type'])
+        self.assertEqual(app.response_cache.stats()['hits'], 2)
+        self.assertRaises(AssertionError, get, **{'Cache-Control': 'no-cache'})
+        app._local.transform = transform
+        
+        # The parameters and body are part of the key
+        self.assertTrue('<p>value2</p>' in get('value2').body)
+        bodies[0] = HTML_ALTERNATIVE
+        self.assertTrue('Alternative content' in get().body)
+        self.assertEqual(len(app.response_cache), 3)
+        
+        # Responses with a strong ETag are identified by it
+        headers.append(('ETag', '"1"'))
+        self.assertTrue('Alternative content' in get().body)
+        bodies[0] = HTML
+        self.assertTrue('Alternative content' in get().body)
+        
+        headers.append(('Vary', 'Accept-Language'))
+        self.assertTrue('Content content' in get(**{'Accept-Language': 'de'}).body)
+        
+        # Unless the response is private
+        headers.append(('Cache-Control', 'private'))
+        bodies[0] = HTML_ALTERNATIVE
+        self.assertTrue('Alternative content' in get().body)
+        
+        size = len(app.response_cache)
+        headers[-1] = ('Cache-Control', 'no-store')
+        bodies[0] = HTML
+        self.assertTrue('Content content' in get().body)
+        self.assertEqual(len(app.response_cache), size)
+
+    def test_conditional_get(self):
+        from lxml import etree
+        
+        from diazo.wsgi import XSLTMiddleware
+        from webob import Request
+        
+        seen = []
+        etags = ['"1"']
+        def application(environ, start_response):
+            if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+            seen.append(if_none_match)
+            if if_none_match == etags[0] == '"2"':
+                start_response('304 Not Modified', [('ETag', etags[0])])
+                return []
+            start_response('200 OK', [('Content-Type', 'text/html'), ('ETag', etags[0]),
+                                      ('Cache-Control', 'max-age=60')])
+            return [HTML]
+        
+        app = XSLTMiddleware(application, {}, tree=etree.fromstring(XSLT))
+        other = XSLTMiddleware(application, {}, tree=etree.fromstring(XSLT_PARAM))
+        
+        response = Request.blank('/').get_response(app)
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('"1-diazo-'))
+        self.assertNotEqual(Request.blank('/').get_response(other).headers['ETag'], etag)
+        
+        # A matching ETag is not modified, without transforming the response
+        def fail(*args, **kw):
+            raise AssertionError("Transformed")
+        app._local.transform = fail
+        response = Request.blank('/', headers={'If-None-Match': etag}).get_response(app)
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.body, '')
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.headers['Cache-Control'], 'max-age=60')
+        self.assertEqual(seen[-1], '"1"')
+        response = Request.blank('/', headers={'If-None-Match': '"0", W/' + etag}).get_response(app)
+        self.assertEqual(response.status_int, 304)
+        
+        # The upstream application may answer the revalidation itself
+        etags[0] = '"2"'
+        etag2 = etag.replace('"1-', '"2-')
+        response = Request.blank('/', headers={'If-None-Match': etag2}).get_response(app)
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.headers['ETag'], etag2)
+        
+        # ETags for a different theme are not sent upstream
+        del app._local.transform
+        other_etag = Request.blank('/').get_response(other).headers['ETag']
+        response = Request.blank('/', headers={'If-None-Match': other_etag}).get_response(app)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(seen[-1], None)
+        self.assertEqual(response.headers['ETag'], etag2)
+        self.assertTrue('<title>Transformed</title>' in response.body)
+    
+    def test_conditional_get_not_themed(self):
+        from lxml import etree
+        
+        from diazo.wsgi import XSLTMiddleware
+        from webob import Request
+        
+        seen = []
+        def application(environ, start_response):
+            if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+            seen.append(if_none_match)
+            if if_none_match == '"json"':
+                start_response('304 Not Modified', [('ETag', '"json"')])
+                return []
+            start_response('200 OK', [('Content-Type', 'application/json'), ('ETag', '"json"')])
+            return ['{}']
+        
+        # ETags of responses which are not themed reach the application
+        app = XSLTMiddleware(application, {}, tree=etree.fromstring(XSLT))
+        response = Request.blank('/', headers={'If-None-Match': '"json"'}).get_response(app)
+        self.assertEqual(seen, ['"json"'])
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.headers['ETag'], '"json"')
+        
+        # Weak tags are forwarded unchanged
+        del seen[:]
+        response = Request.blank('/', headers={'If-None-Match': 'W/"json", "other"'}).get_response(app)
+        self.assertEqual(seen, ['W/"json", "other"'])
+    
+    def test_etag_suffix_stable(self):
+        from diazo.compiler import compile_theme
+        from diazo.wsgi import XSLTMiddleware
+        from webob import Request
+        
+        # Names made by generate-id() differ between compiles, but another
+        # process compiling the same theme must produce the same ETags
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/html')])
+            return [HTML]
+        
+        environ = Request.blank('/').environ
+        suffixes = []
+        for i in range(2):
+            tree = compile_theme(testfile('simple_transform.xml'))
+            suffixes.append(XSLTMiddleware(application, {}, tree=tree).etag_suffix(environ))
+        self.assertEqual(suffixes[0], suffixes[1])
+
+class TestWSGIResolver(unittest.TestCase):
+    
+    def application(self, environ, start_response):
+        from webob import Request
+        request = Request(environ)
+        self.requested.append(request.path_qs)
+        status, cache_control = self.responses.get(request.path, ('200 OK', None))
+        response_headers = [('Content-Type', 'text/html')]
+        if cache_control:
+            response_headers.append(('Cache-Control', cache_control))
+        start_response(status, response_headers)
+        return ['<p>%s</p>' % request.path_qs]
+    
+    def setUp(self):
+        self.requested = []
+        self.responses = {}
+    
+    def test_fetch(self):
+        from diazo.utils import LRUCache
+        from diazo.wsgi import WSGIResolver
+        
+        self.responses['/missing'] = ('404 Not Found', None)
+        self.responses['/private'] = ('200 OK', 'private, max-age=60')
+        self.responses['/short'] = ('200 OK', 'max-age=0')
+        self.responses['/long'] = ('200 OK', 'max-age=60')
+        
+        resolver = WSGIResolver(self.application)
+        self.assertEqual(resolver.fetch('/a'), '<p>/a</p>')
+        self.assertEqual(resolver.fetch('/a'), '<p>/a</p>')
+        self.assertEqual(self.requested, ['/a', '/a'])
+        
+        cache = LRUCache()
+        resolver = WSGIResolver(self.application, cache, cache_ttl=60)
+        del self.requested[:]
+        for url in ['/a', '/a?b=c', '/missing', '/private', '/short']:
+            resolver.fetch(url)
+            resolver.fetch(url)
+        self.assertEqual(resolver.fetch('/missing'), None)
+        self.assertEqual(self.requested, ['/a', '/a?b=c', '/missing', '/private', '/private', '/short', '/short'])
+        
+        # The cache may be shared, and its entries expire
+        resolver = WSGIResolver(self.application, cache, cache_ttl=0)
+        del self.requested[:]
+        resolver.fetch('/a')
+        resolver.fetch('/long')
+        resolver.fetch('/long')
+        cache.set('/a', (0, 'expired'))
+        self.assertEqual(resolver.fetch('/a'), '<p>/a</p>')
+        self.assertEqual(self.requested, ['/long', '/a'])
+        
+        resolver = WSGIResolver(self.application, LRUCache(), cache_ttl=60, negative_ttl=0)
+        del self.requested[:]
+        resolver.fetch('/missing')
+        resolver.fetch('/missing')
+        self.assertEqual(self.requested, ['/missing', '/missing'])
+    
+    def test_cache_ttls(self):
+        import time
+        from diazo.utils import LRUCache
+        from diazo.wsgi import DiazoMiddleware, WSGIResolver
+        
+        self.responses['/nav/long'] = ('200 OK', 'max-age=60')
+        cache = LRUCache()
+        resolver = WSGIResolver(self.application, cache, cache_ttl=10,
+                                cache_ttls=[('^/nav', 300), ('^/news', 0)])
+        for url in ['/a', '/nav/main', '/nav/long', '/news']:
+            resolver.fetch(url)
+        now = time.time()
+        self.assertAlmostEqual(cache.get('/a')[0], now + 10, -1)
+        self.assertAlmostEqual(cache.get('/nav/main')[0], now + 300, -1)
+        self.assertAlmostEqual(cache.get('/nav/long')[0], now + 60, -1)
+        self.assertEqual(cache.get('/news'), None)
+        
+        app = DiazoMiddleware(self.application, {}, testfile('simple_transform.xml'),
+                              include_cache_ttls='^/nav 300\n\n^/news 0\n')
+        self.assertEqual(app.include_cache_ttls, [['^/nav', '300'], ['^/news', '0']])
+        self.assertNotEqual(app.include_cache, None)
+    
+    def test_single_flight(self):
+        import threading
+        import time
+        from diazo.wsgi import WSGIResolver
+        
+        release = threading.Event()
+        def application(environ, start_response):
+            release.wait()
+            return self.application(environ, start_response)
+        
+        resolver = WSGIResolver(application)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(resolver.fetch('/nav')))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['<p>/nav</p>'] * 4)
+        self.assertEqual(self.requested, ['/nav'])
 
 class TestDiazoMiddleware(unittest.TestCase):
     
@@ -842,6 +1368,29 @@ class TestDiazoMiddleware(unittest.TestCase):
         self.assertTrue('<title>Transformed</title>' in response.body)
         self.assertTrue('<link rel="stylesheet" href="/static/theme.css" />' in response.body)
     
+    def test_runtime_prefix(self):
+        from diazo.wsgi import DiazoMiddleware
+        from webob import Request
+        
+        def application(environ, start_response):
+            status = '200 OK'
+            response_headers = [('Content-Type', 'text/html')]
+            start_response(status, response_headers)
+            return [HTML]
+        
+        app = DiazoMiddleware(application, {}, testfile('simple_transform.xml'),
+                prefix='/static', runtime_prefix=True)
+        response = Request.blank('/').get_response(app)
+        self.assertTrue('<title>Transformed</title>' in response.body)
+        self.assertTrue('<link rel="stylesheet" href="/static/theme.css" />' in response.body)
+        
+        # The same compiled theme serves a prefix set for the request
+        transform_middleware = app.transform_middleware
+        request = Request.blank('/', environ={'diazo.absolute_prefix': 'http://cdn.example.com/site'})
+        response = request.get_response(app)
+        self.assertTrue('<link rel="stylesheet" href="http://cdn.example.com/site/theme.css" />' in response.body)
+        self.assertTrue(app.transform_middleware is transform_middleware)
+    
     def test_path_param(self):
         from diazo.wsgi import DiazoMiddleware
         from webob import Request
@@ -953,6 +1502,123 @@ class TestDiazoMiddleware(unittest.TestCase):
         self.assertTrue('<div id="content">Alternative content</div>' in response.body)
         self.assertFalse('<div id="content">Theme content</div>' in response.body)
         self.assertTrue('<title>Transformed</title>' in response.body)
+    
+    def test_response_cache_with_includes(self):
+        from diazo.wsgi import DiazoMiddleware
+        from webob import Request
+        
+        included = [HTML_ALTERNATIVE]
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/html')])
+            if environ['PATH_INFO'] == '/other.html':
+                return [included[0]]
+            return [HTML]
+        
+        # The response cache cannot tell when an include changes
+        app = DiazoMiddleware(application, {}, testfile('subrequest.xml'), response_cache_size=100000)
+        response = Request.blank('/').get_response(app)
+        self.assertTrue('<div id="content">Alternative content</div>' in response.body)
+        included[0] = HTML_ALTERNATIVE.replace('Alternative content', 'Changed content')
+        response = Request.blank('/').get_response(app)
+        self.assertTrue('<div id="content">Changed content</div>' in response.body)
+        self.assertEqual(app.transform_middleware.response_cache, None)
+        
+        # Themes without includes are cached
+        app = DiazoMiddleware(application, {}, testfile('simple_transform.xml'), response_cache_size=100000)
+        Request.blank('/').get_response(app)
+        self.assertEqual(len(app.transform_middleware.response_cache), 1)
+
+    def test_transform_response(self):
+        from diazo.wsgi import DiazoMiddleware
+        from webob import Request
+        
+        def application(environ, start_response):
+            status = '200 OK'
+            response_headers = [('Content-Type', 'text/html')]
+            start_response(status, response_headers)
+            return [HTML_ALTERNATIVE]
+        
+        app = DiazoMiddleware(application, {}, testfile('subrequest.xml'))
+        environ = Request.blank('/').environ
+        status, headerlist, body = app.transform_response(environ, '200 OK', [('Content-Type', 'text/html')], HTML)
+        self.assertEqual(status, '200 OK')
+        self.assertTrue('<div id="content">Alternative content</div>' in body)
+        self.assertTrue('<title>Transformed</title>' in body)
+        
+        results = []
+        result = app.transform_async(Request.blank('/').environ, '200 OK', [('Content-Type', 'text/html')],
+                                     HTML, callback=results.append)
+        self.assertEqual(result.get(5)[2], body)
+        self.assertEqual(results, [result.get()])
+    
+    def test_include_cache(self):
+        from diazo.wsgi import DiazoMiddleware
+        from webob import Request
+        
+        requested = []
+        def application(environ, start_response):
+            status = '200 OK'
+            response_headers = [('Content-Type', 'text/html')]
+            start_response(status, response_headers)
+            
+            request = Request(environ)
+            requested.append(request.path)
+            if request.path.endswith('/other.html'):
+                return [HTML_ALTERNATIVE]
+            else:
+                return [HTML]
+        
+        app = DiazoMiddleware(application, {}, testfile('subrequest.xml'), include_cache_ttl=60)
+        for i in range(3):
+            response = Request.blank('/').get_response(app)
+            self.assertTrue('<div id="content">Alternative content</div>' in response.body)
+        self.assertEqual(requested.count('/other.html'), 1)
+        self.assertEqual(requested.count('/'), 3)
+
+    def test_prefetch_includes(self):
+        import threading
+        import time
+        from diazo.wsgi import DiazoMiddleware
+        from webob import Request
+        
+        lock = threading.Lock()
+        active = [0]
+        concurrent = []
+        requested = []
+        def application(environ, start_response):
+            status = '200 OK'
+            response_headers = [('Content-Type', 'text/html')]
+            start_response(status, response_headers)
+            
+            request = Request(environ)
+            if request.path == '/' or request.path.startswith('/news/'):
+                return [HTML.replace('</body>', '<p id="footer"/></body>')]
+            if request.path == '/plain':
+                return [HTML]
+            lock.acquire()
+            requested.append(request.path)
+            active[0] += 1
+            concurrent.append(active[0])
+            lock.release()
+            time.sleep(0.05)
+            lock.acquire()
+            active[0] -= 1
+            lock.release()
+            return [HTML_ALTERNATIVE.replace('Alternative', request.path)]
+        
+        app = DiazoMiddleware(application, {}, testfile('prefetch.xml'), prefetch_includes=True)
+        response = Request.blank('/news/item').get_response(app)
+        self.assertTrue('<div id="content">/other.html content</div>' in response.body)
+        self.assertTrue('/news.html content' in response.body)
+        self.assertTrue('/footer.html content' in response.body)
+        self.assertEqual(sorted(requested), ['/footer.html', '/news.html', '/other.html'])
+        self.assertTrue(max(concurrent) > 1)
+        
+        # Only the includes used by the request are fetched
+        del requested[:]
+        response = Request.blank('/plain').get_response(app)
+        self.assertTrue('<div id="content">/other.html content</div>' in response.body)
+        self.assertEqual(requested, ['/other.html'])
 
     def test_esi(self):
         from diazo.wsgi import DiazoMiddleware
@@ -982,6 +1648,344 @@ class TestDiazoMiddleware(unittest.TestCase):
         # Strip response body in this test due to https://bugzilla.gnome.org/show_bug.cgi?id=652766
         self.assertEqual('<div id="content">Alternative content</div>', response.body.strip())
 
+    def test_filter_xpath(self):
+        from diazo.wsgi import DiazoMiddleware, XSLTMiddleware
+        from diazo.utils import pkg_parse
+        from webob import Request
+        
+        body = ('<html><head><title>Title</title><script>if (a < b) f();</script></head>'
+                '<body><div id="content">Content &amp;\r\nmore<br>text</div><p>One</p><p>Two</p></body></html>')
+        def application(environ, start_response):
+            status = '200 OK'
+            response_headers = [('Content-Type', 'text/html')]
+            start_response(status, response_headers)
+            return [body]
+        
+        app = DiazoMiddleware(application, {}, testfile('esi.xml'), filter_xpath=True)
+        xslt = XSLTMiddleware(application, {}, tree=pkg_parse('filter_xhtml.xsl'),
+                              environ_param_map={'diazo.filter_xpath': 'xpath'},
+                              doctype='', unquoted_params=['xpath'])
+        def filtered(app, xpath):
+            return Request.blank('/?;filter_xpath=' + xpath).get_response(app).body
+        
+        for xpath in ["//*[@id = 'content']", '//p', '//script']:
+            request = Request.blank('/', environ={'diazo.filter_xpath': xpath})
+            self.assertEqual(filtered(app, xpath), request.get_response(xslt).body)
+        self.assertEqual(filtered(app, '//p'), '<p>One</p><p>Two</p>')
+        self.assertEqual(filtered(app, '//script'), '<script>if (a < b) f();</script>')
+        self.assertEqual(filtered(app, '//title/text()'), 'Title')
+        self.assertEqual(filtered(app, '//table'), '<!--WARNING: No content found-->')
+        
+        # Compiled expressions are reused
+        xpaths = app.filter_middleware.xpaths
+        self.assertTrue('//p' in xpaths)
+        hits = xpaths.stats()['hits']
+        filtered(app, '//p')
+        self.assertEqual(xpaths.stats()['hits'], hits + 1)
+    
+    def test_metrics(self):
+        from diazo.wsgi import DiazoMiddleware
+        from webob import Request
+        
+        def application(environ, start_response):
+            if environ['PATH_INFO'] == '/error':
+                raise ValueError("Application error")
+            status = '200 OK'
+            response_headers = [('Content-Type', 'text/html')]
+            start_response(status, response_headers)
+            return [HTML]
+        
+        app = DiazoMiddleware(application, {}, testfile('simple_transform.xml'),
+                              metrics_path='/diazo-metrics', server_timing=True)
+        request = Request.blank('/')
+        response = request.get_response(app)
+        self.assertTrue('<title>Transformed</title>' in response.body)
+        phases = [timing.split(';')[0] for timing in response.headers['Server-Timing'].split(', ')]
+        self.assertEqual(phases, ['diazo-app', 'diazo-parse', 'diazo-serialize', 'diazo-total', 'diazo-transform'])
+        self.assertEqual(sorted(request.environ['diazo.timing']), ['app', 'parse', 'serialize', 'total', 'transform'])
+        
+        Request.blank('/script.js').get_response(app)
+        self.assertRaises(ValueError, Request.blank('/error').get_response, app)
+        
+        counters = app.metrics.snapshot()['counters']
+        self.assertEqual(counters['themed'], 1)
+        self.assertEqual(counters['bypassed'], 1)
+        self.assertEqual(counters['errors'], 1)
+        self.assertEqual(counters['bytes_in'], len(HTML))
+        self.assertEqual(counters['bytes_out'], len(response.body))
+        phases = app.metrics.snapshot()['phases']
+        self.assertEqual(phases['compile']['count'], 1)
+        self.assertEqual(phases['transform']['count'], 1)
+        
+        response = Request.blank('/diazo-metrics').get_response(app)
+        self.assertEqual(response.headers['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        self.assertTrue('diazo_themed_total 1\n' in response.body)
+        self.assertTrue('diazo_phase_seconds_count{phase="transform"} 1\n' in response.body)
+    
+    def test_debug_reload(self):
+        import shutil
+        import tempfile
+        import time
+        from diazo.wsgi import DiazoMiddleware
+        from webob import Request
+        
+        def application(environ, start_response):
+            status = '200 OK'
+            response_headers = [('Content-Type', 'text/html')]
+            start_response(status, response_headers)
+            return [HTML]
+        
+        tempdir = tempfile.mkdtemp()
+        try:
+            shutil.copy(testfile('simple_transform.xml'), tempdir)
+            shutil.copy(testfile('theme.html'), tempdir)
+            themefn = os.path.join(tempdir, 'theme.html')
+            
+            app = DiazoMiddleware(application, {}, os.path.join(tempdir, 'simple_transform.xml'), debug=True)
+            request = Request.blank('/')
+            response = request.get_response(app)
+            self.assertTrue('<title>Transformed</title>' in response.body)
+            
+            dependencies = [os.path.basename(url) for url, version in app.dependencies]
+            self.assertTrue('simple_transform.xml' in dependencies)
+            self.assertTrue('theme.html' in dependencies)
+            
+            # Unchanged dependencies reuse the compiled theme
+            transform_middleware = app.transform_middleware
+            response = request.get_response(app)
+            self.assertTrue(app.transform_middleware is transform_middleware)
+            
+            theme = open(themefn).read().replace('Transformed', 'Reloaded')
+            open(themefn, 'w').write(theme)
+            future = time.time() + 10
+            os.utime(themefn, (future, future))
+            
+            response = request.get_response(app)
+            self.assertFalse(app.transform_middleware is transform_middleware)
+            self.assertTrue('<title>Reloaded</title>' in response.body)
+        finally:
+            shutil.rmtree(tempdir)
+    
+    def test_debug_check_interval(self):
+        from diazo.wsgi import DiazoMiddleware
+        from webob import Request
+    
+        fetched = []
+        def application(environ, start_response):
+            if environ['PATH_INFO'] == '/theme.html':
+                fetched.append(True)
+            start_response('200 OK', [('Content-Type', 'text/html')])
+            return [HTML]
+    
+        app = DiazoMiddleware(application, {}, testfile('simple_transform.xml'), debug=True,
+                              debug_check_interval=60)
+        request = Request.blank('/')
+        request.get_response(app)
+        version = app.dependency_version('/theme.html')
+        app.dependencies.append(('/theme.html', version))
+        del fetched[:]
+    
+        # Files are checked on every request, subrequests only once the
+        # interval has passed
+        self.assertFalse(app.dependencies_changed())
+        self.assertEqual(fetched, [])
+        app.dependencies_checked -= 60
+        self.assertFalse(app.dependencies_changed())
+        self.assertEqual(fetched, [True])
+        self.assertFalse(app.dependencies_changed())
+        self.assertEqual(fetched, [True])
+    
+    def test_eager_compile(self):
+        import threading
+        from diazo.wsgi import DiazoMiddleware
+        from webob import Request
+        
+        def application(environ, start_response):
+            status = '200 OK'
+            response_headers = [('Content-Type', 'text/html')]
+            start_response(status, response_headers)
+            return [HTML]
+        
+        app = DiazoMiddleware(application, {}, testfile('simple_transform.xml'), eager_compile=True, warm_up='2')
+        self.assertFalse(app.transform_middleware is None)
+        self.assertFalse(getattr(app.transform_middleware._local, 'transform', None) is None)
+        
+        # Request threads take the prepared transforms
+        prepared = list(app.transform_middleware._prepared)
+        self.assertEqual(len(prepared), 2)
+        used = []
+        def warmed_request():
+            Request.blank('/').get_response(app)
+            used.append(app.transform_middleware.transform)
+        threads = [threading.Thread(target=warmed_request) for i in range(2)]
+        for thread in threads:
+            thread.start()
+            thread.join()
+        self.assertEqual(sorted(map(id, used)), sorted(map(id, prepared)))
+        self.assertEqual(app.transform_middleware._prepared, [])
+        
+        # Concurrent first requests share a single compile
+        compiles = []
+        class CountingMiddleware(DiazoMiddleware):
+            def get_transform_middleware(self):
+                compiles.append(threading.current_thread().name)
+                return DiazoMiddleware.get_transform_middleware(self)
+        
+        app = CountingMiddleware(application, {}, testfile('simple_transform.xml'))
+        results = []
+        def request():
+            results.append(Request.blank('/').get_response(app).body)
+        threads = [threading.Thread(target=request) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(compiles), 1)
+        self.assertEqual(len(results), 4)
+        for body in results:
+            self.assertTrue('<title>Transformed</title>' in body)
+        
+        app = CountingMiddleware(application, {}, testfile('simple_transform.xml'), background_compile=True)
+        app.compile_thread.join()
+        self.assertEqual(compiles[1:], ['diazo-compile'])
+        response = Request.blank('/').get_response(app)
+        self.assertTrue('<title>Transformed</title>' in response.body)
+        self.assertEqual(len(compiles), 2)
+    
+    def test_swap_while_compiling(self):
+        from diazo.wsgi import DiazoMiddleware
+        from webob import Request
+        
+        def application(environ, start_response):
+            status = '200 OK'
+            response_headers = [('Content-Type', 'text/html')]
+            start_response(status, response_headers)
+            return [HTML]
+        
+        app = DiazoMiddleware(application, {}, testfile('simple_transform.xml'), debug=True, eager_compile=True)
+        transform_middleware = app.transform_middleware
+        app.dependencies = [(url, None) for url, version in app.dependencies]
+        
+        # The previous theme is used while another thread recompiles
+        app.compile_lock.acquire()
+        try:
+            self.assertTrue(app.get_current_middleware() is transform_middleware)
+            response = Request.blank('/').get_response(app)
+            self.assertTrue('<title>Transformed</title>' in response.body)
+        finally:
+            app.compile_lock.release()
+        self.assertFalse(app.get_current_middleware() is transform_middleware)
+
+
+class TestThemeRegistryMiddleware(unittest.TestCase):
+    
+    def application(self, environ, start_response):
+        status = '200 OK'
+        response_headers = [('Content-Type', 'text/html')]
+        start_response(status, response_headers)
+        return [HTML]
+    
+    def test_select_tenant(self):
+        from diazo.wsgi import ThemeRegistryMiddleware
+        from webob import Request
+        
+        tenants = {
+            'one.example.com': {'rules': testfile('simple_transform.xml')},
+            'two.example.com': {'rules': testfile('simple_transform.xml'), 'doctype': '<!DOCTYPE html>'},
+            }
+        app = ThemeRegistryMiddleware(self.application, {}, tenants)
+        
+        response = Request.blank('http://one.example.com:8080/').get_response(app)
+        self.assertTrue('<title>Transformed</title>' in response.body)
+        self.assertFalse(response.body.startswith('<!DOCTYPE html>'))
+        response = Request.blank('http://two.example.com/').get_response(app)
+        self.assertTrue(response.body.startswith('<!DOCTYPE html>\n'))
+        response = Request.blank('http://one.example.com/').get_response(app)
+        
+        # Unknown tenants are not themed
+        response = Request.blank('http://three.example.com/').get_response(app)
+        self.assertEqual(response.body, HTML)
+        
+        stats = app.stats()
+        self.assertEqual(sorted(stats), ['one.example.com', 'two.example.com'])
+        self.assertEqual((stats['one.example.com']['compiles'], stats['one.example.com']['hits']), (1, 1))
+        self.assertEqual((stats['two.example.com']['compiles'], stats['two.example.com']['hits']), (1, 0))
+        self.assertTrue(stats['one.example.com']['loaded'])
+        self.assertTrue(stats['one.example.com']['size'] > 0)
+    
+    def test_eviction(self):
+        from diazo.wsgi import ThemeRegistryMiddleware, tenant_from_path
+        from webob import Request
+        
+        tenants = {
+            'one': {'rules': testfile('simple_transform.xml')},
+            'two': {'rules': testfile('simple_transform.xml')},
+            }
+        app = ThemeRegistryMiddleware(self.application, {}, tenants, select=tenant_from_path, max_tenants=1)
+        for path in ['/one/', '/two/a', '/one/b']:
+            response = Request.blank(path).get_response(app)
+            self.assertTrue('<title>Transformed</title>' in response.body)
+        stats = app.stats()
+        self.assertEqual(stats['one']['compiles'], 2)
+        self.assertEqual(stats['two']['compiles'], 1)
+        self.assertFalse(stats['two']['loaded'])
+        
+        # Tenants share their thread pools, so none are left behind
+        self.assertEqual(sorted(app.pools), ['transform'])
+        self.assertTrue(app.get_middleware('one').transform_pool is app.pools['transform'])
+        
+        # Themes larger than the memory limit are kept on their own
+        app = ThemeRegistryMiddleware(self.application, {}, tenants, select='path', max_memory=100)
+        for path in ['/one/', '/one/', '/two/', '/one/']:
+            response = Request.blank(path).get_response(app)
+            self.assertTrue('<title>Transformed</title>' in response.body)
+        stats = app.stats()
+        self.assertEqual(stats['one']['compiles'], 2)
+        self.assertEqual(stats['one']['hits'], 1)
+        self.assertFalse(stats['one']['size'] < 100)
+        self.assertEqual(app.middlewares.bytes, 100)
+    
+    def test_estimate_size(self):
+        import threading
+        from diazo.wsgi import ThemeRegistryMiddleware
+        from webob import Request
+        
+        tenants = {'localhost': {'rules': testfile('simple_transform.xml')}}
+        app = ThemeRegistryMiddleware(self.application, {}, tenants)
+        Request.blank('/').get_response(app)
+        size = app.stats()['localhost']['size']
+        
+        # Each thread applying the theme adds a copy of the stylesheet
+        thread = threading.Thread(target=lambda: Request.blank('/').get_response(app))
+        thread.start()
+        thread.join()
+        Request.blank('/').get_response(app)
+        stats = app.stats()['localhost']
+        self.assertEqual(stats['transforms'], 2)
+        self.assertTrue(stats['size'] > size)
+        self.assertEqual(app.middlewares.bytes, stats['size'])
+    
+    def test_read_tenants(self):
+        import shutil
+        import tempfile
+        from diazo.wsgi import ThemeRegistryMiddleware
+        from webob import Request
+        
+        tempdir = tempfile.mkdtemp()
+        try:
+            shutil.copy(testfile('simple_transform.xml'), tempdir)
+            shutil.copy(testfile('theme.html'), tempdir)
+            filename = os.path.join(tempdir, 'tenants.ini')
+            open(filename, 'w').write('[localhost]\nrules = simple_transform.xml\ndoctype = <!DOCTYPE html>\n')
+            
+            app = ThemeRegistryMiddleware(self.application, {}, filename)
+            self.assertEqual(app.tenants['localhost']['rules'], os.path.join(tempdir, 'simple_transform.xml'))
+            response = Request.blank('/').get_response(app)
+            self.assertTrue(response.body.startswith('<!DOCTYPE html>\n'))
+            self.assertTrue('<title>Transformed</title>' in response.body)
+        finally:
+            shutil.rmtree(tempdir)
+
 
 def test_suite():
     return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -1,6 +1,13 @@
 import logging
 import pkg_resources
 import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 from lxml import etree
 from optparse import OptionParser
@@ -17,6 +24,7 @@ namespaces = dict(
     oldcss1="http://namespaces.plone.org/xdv+css",
     oldcss2="http://namespaces.plone.org/diazo+css",
     xsl="http://www.w3.org/1999/XSL/Transform",
+    xi="http://www.w3.org/2001/XInclude",
     )
 
 def localname(name):
@@ -57,8 +65,8 @@ class LoggingXSLTWrapper:
 def pkg_parse(name, parser=None):
     return etree.parse(open(pkg_resources.resource_filename('diazo', name)), parser=parser)
 
-def pkg_xsl(name, parser=None):
-    return LoggingXSLTWrapper(etree.XSLT(pkg_parse(name, parser)), logger)
+def pkg_xsl(name, parser=None, extensions=None):
+    return LoggingXSLTWrapper(etree.XSLT(pkg_parse(name, parser), extensions=extensions), logger)
 
 def quote_param(value):
     """Quote for passing as an XSL parameter.
@@ -87,6 +95,158 @@ def split_params(s):
         xsl_params[tokens[0]] = len(tokens) > 1 and tokens[1] or None
     return xsl_params
 
+# Fields of the links in LRUCache's list
+PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+class LRUCache(object):
+    """A thread safe mapping holding at most ``maxsize`` items, discarding the
+    least recently used item when full. Counts hits and misses for ``get``.
+
+    When ``maxbytes`` is set, the sizes given to ``set`` are also limited to
+    that total.
+    """
+
+    def __init__(self, maxsize=1000, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self._links = {}
+        self._sizes = {}
+        self.bytes = 0
+        # Circular doubly linked list, least recently used first
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            link = self._links.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._unlink(link)
+            self._append(link)
+            return link[VALUE]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, size=0):
+        """Store value, which takes up size bytes. Values larger than
+        ``maxbytes`` are not stored.
+        """
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        self._lock.acquire()
+        try:
+            link = self._links.get(key)
+            if link is not None:
+                self._unlink(link)
+                link[VALUE] = value
+                self.bytes -= self._sizes[key]
+            else:
+                link = [None, None, key, value]
+                self._links[key] = link
+            self._sizes[key] = size
+            self.bytes += size
+            self._append(link)
+            while len(self._links) > self.maxsize or (
+                    self.maxbytes is not None and self.bytes > self.maxbytes):
+                oldest = self._root[NEXT]
+                self._unlink(oldest)
+                del self._links[oldest[KEY]]
+                self.bytes -= self._sizes.pop(oldest[KEY])
+        finally:
+            self._lock.release()
+
+    def _unlink(self, link):
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+
+    def _append(self, link):
+        root = self._root
+        last = root[PREV]
+        link[PREV], link[NEXT] = last, root
+        last[NEXT] = root[PREV] = link
+
+    def clear(self):
+        """Discard all items and reset the statistics
+        """
+        self._lock.acquire()
+        try:
+            self._clear()
+            self.hits = self.misses = 0
+        finally:
+            self._lock.release()
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def __len__(self):
+        return len(self._links)
+
+    def stats(self):
+        """Return a dict of the ``hits``, ``misses``, ``size``, ``maxsize``,
+        ``bytes`` and ``maxbytes`` of the cache.
+        """
+        return dict(hits=self.hits, misses=self.misses, size=len(self._links), maxsize=self.maxsize,
+                    bytes=self.bytes, maxbytes=self.maxbytes)
+
+def resident_memory():
+    """Return the current resident memory of this process in kilobytes, or
+    None where it is not available (it is read from /proc/self/statm).
+    """
+    try:
+        f = open('/proc/self/statm')
+    except IOError:
+        return None
+    try:
+        pages = int(f.read().split()[1])
+    finally:
+        f.close()
+    if resource is None:
+        return None
+    return pages * resource.getpagesize() // 1024
+
+def record_stage(profile, name, start, doc=None):
+    """Append a ``(name, seconds, nodes, memory)`` tuple for a compilation
+    stage started at time ``start`` to profile, if it is not None.
+
+    * ``nodes`` is the number of nodes in ``doc`` after the stage
+    * ``memory`` is the resident memory of the process in kilobytes after
+      the stage. Unlike the peak, the difference from the previous stage
+      shows the memory the stage allocated and kept.
+    """
+    if profile is None:
+        return
+    seconds = time.time() - start
+    nodes = None
+    if doc is not None:
+        nodes = int(doc.xpath('count(//node())'))
+    profile.append((name, seconds, nodes, resident_memory()))
+
+def format_profile(profile):
+    """Format the stages recorded by ``record_stage`` as a table, with the
+    resident memory after each stage and the change since the previous one.
+    """
+    lines = ['%-32s %10s %8s %10s %10s' % ('stage', 'ms', 'nodes', 'RSS KB', '+KB')]
+    total = 0
+    previous = None
+    for name, seconds, nodes, memory in profile:
+        total += seconds
+        delta = '-'
+        if memory is not None and previous is not None:
+            delta = '%+d' % (memory - previous)
+        lines.append('%-32s %10.2f %8s %10s %10s' % (name, seconds * 1000,
+            nodes is not None and nodes or '-', memory is not None and memory or '-', delta))
+        previous = memory
+    lines.append('%-32s %10.2f' % ('total', total * 1000))
+    return '\n'.join(lines) + '\n'
+
 def _createOptionParser(usage):
     parser = OptionParser(usage=usage)
     parser.add_option("-o", "--output", metavar="output.xsl",
@@ -119,4 +279,10 @@ def _createOptionParser(usage):
     parser.add_option("-e", "--extra", metavar="extra.xsl",
                       help="Extra XSL to be included in the transform (depracated, use inline xsl in the rules instead)",
                       dest="extra", default=None)
+    parser.add_option("--native", action="store_true",
+                      help="Run some of the rules processing stages in Python rather than XSLT",
+                      dest="native", default=False)
+    parser.add_option("--profile", action="store_true",
+                      help="Print the time taken by each compilation stage to stderr",
+                      dest="profile", default=False)
     return parser
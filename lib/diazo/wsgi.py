@@ -1,22 +1,40 @@
 import re
+import hashlib
+import ConfigParser
+import itertools
+import logging
 import pkg_resources
+import os
 import os.path
+import threading
+import time
+import urllib2
+import zlib
 
+from multiprocessing.pool import ThreadPool
+from cgi import escape
 from urllib import unquote_plus
 
 from webob import Request
+from webob import Response
 
 from lxml import etree, html
 
 from repoze.xmliter.serializer import XMLSerializer
-from repoze.xmliter.utils import getHTMLSerializer
 
+from diazo.cache import Dependencies, ThemeCache, url_filename
 from diazo.compiler import compile_theme
+from diazo.compiler import find_includes
+from diazo.metrics import Metrics
+from diazo.metrics import server_timing
 from diazo.utils import pkg_parse
 from diazo.utils import quote_param
+from diazo.utils import LRUCache
 
 DIAZO_OFF_HEADER = 'X-Diazo-Off'
 
+logger = logging.getLogger('diazo')
+
 def asbool(value):
     if isinstance(value, basestring):
         value = value.strip().lower()
@@ -29,25 +47,224 @@ def asbool(value):
     else:
         return bool(value)
 
-class FilesystemResolver(etree.Resolver):
+def xpath_key(context, name, value):
+    """The ``diazo-id`` and ``diazo-class`` keys, for evaluating conditions
+    outside of the compiled theme.
+    """
+    tree = context.context_node.getroottree()
+    if name == 'diazo-id':
+        return tree.xpath('//*[@id = $value]', value=value)
+    elif name == 'diazo-class':
+        return tree.xpath("//*[contains(concat(' ', normalize-space(@class), ' '), $value)]",
+                          value=' %s ' % value)
+    raise ValueError("Unknown key %r" % name)
+
+XPATH_EXTENSIONS = {(None, 'key'): xpath_key}
+
+# Headers sent with a 304 Not Modified response
+NOT_MODIFIED_HEADERS = ('cache-control', 'content-location', 'date', 'expires', 'last-modified', 'vary')
+
+def parse_etags(value):
+    """Return the list of entity tags in an If-None-Match header. Weak tags
+    are returned without the W/ prefix, as If-None-Match uses the weak
+    comparison.
+    """
+    if not value:
+        return []
+    tags = []
+    for tag in value.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag:
+            tags.append(tag)
+    return tags
+
+# Matches the end of an entity tag with a suffix added by etag_suffix
+THEMED_ETAG = re.compile(r'-diazo-[0-9a-f]{16}"$')
+
+# Names made by the XSLT generate-id() function, which differ on every compile
+GENERATED_ID = re.compile(r'\bid[mp]?\d+\b')
+
+def theme_digest(tree):
+    """Return a hash of the compiled theme which is the same each time the
+    theme is compiled, numbering generated ids in the order they appear.
+    """
+    ids = {}
+    serialized = GENERATED_ID.sub(lambda match: ids.setdefault(match.group(0), 'diazo-id-%d' % len(ids)),
+                                  etree.tostring(tree))
+    return hashlib.sha1(serialized).hexdigest()
+
+def add_etag_suffix(etag, suffix):
+    """Add suffix to the opaque part of an entity tag
+    """
+    weak = etag.startswith('W/')
+    if weak:
+        etag = etag[2:]
+    if etag.endswith('"'):
+        etag = etag[:-1] + suffix + '"'
+    else:
+        etag = '"%s%s"' % (etag, suffix)
+    return weak and 'W/' + etag or etag
+
+# Content codings of upstream responses which are decoded for theming
+DECODED_ENCODINGS = ('gzip', 'x-gzip', 'deflate')
+
+# Finds calls to document() in a compiled theme
+DOCUMENT_CALLS = etree.XPath("//xsl:*/@*[contains(., 'document(')]", 
+                            namespaces=dict(xsl="http://www.w3.org/1999/XSL/Transform"))
+
+def decode_iter(app_iter, content_encoding):
+    """Decompress the chunks of a gzip or deflate encoded response as they
+    are read.
+    """
+    if content_encoding.lower() in ('gzip', 'x-gzip'):
+        wbits = 16 + zlib.MAX_WBITS
+    else:
+        wbits = zlib.MAX_WBITS
+    decompressor = None
+    try:
+        for chunk in app_iter:
+            if not chunk:
+                continue
+            if decompressor is None:
+                # Some servers send deflate data without the zlib header
+                if wbits == zlib.MAX_WBITS and ord(chunk[0]) & 0x0f != 8:
+                    wbits = -zlib.MAX_WBITS
+                decompressor = zlib.decompressobj(wbits)
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+        if decompressor is not None:
+            data = decompressor.flush()
+            if data:
+                yield data
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+def accepted_encoding(accept_encoding):
+    """Return the content coding to use for a response, gzip, deflate or None,
+    given the Accept-Encoding header of the request.
+    """
+    if not accept_encoding:
+        return None
+    qualities = {}
+    for item in accept_encoding.split(','):
+        parts = item.split(';')
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        qualities[parts[0].strip().lower()] = quality
+    default = qualities.get('*', 0)
+    gzip = max(qualities.get('gzip', default), qualities.get('x-gzip', 0))
+    deflate = qualities.get('deflate', default)
+    if gzip > 0 and gzip >= deflate:
+        return 'gzip'
+    elif deflate > 0:
+        return 'deflate'
+    return None
+
+def encode_body(body, content_encoding, level):
+    """Compress body with the gzip or deflate content coding
+    """
+    if content_encoding == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    else:
+        compressor = zlib.compressobj(level)
+    return compressor.compress(body) + compressor.flush()
+
+class StreamIterator(object):
+    """Iterate over the chunks already read from the response of an
+    application, followed by the rest of its response.
+    """
+    
+    def __init__(self, chunks, iterator, app_iter):
+        self.chunks = chunks
+        self.iterator = iterator
+        self.app_iter = app_iter
+    
+    def __iter__(self):
+        return itertools.chain(self.chunks, self.iterator)
+    
+    def close(self):
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
+
+def replay_response(process, environ, status, headerlist, body):
+    """Call ``process(app, environ, start_response)`` with an application
+    which returns the given response, returning the processed response as a
+    ``(status, headerlist, body)`` tuple.
+    """
+    def app(environ, start_response):
+        start_response(status, list(headerlist))
+        return [body]
+    
+    captured = {}
+    def start_response(status, headerlist, exc_info=None):
+        captured['status'] = status
+        captured['headerlist'] = headerlist
+    
+    app_iter = process(app, environ, start_response)
+    try:
+        body = ''.join(app_iter)
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+    return captured['status'], captured['headerlist'], body
+
+class BufferedXMLSerializer(XMLSerializer):
+    """An XMLSerializer which keeps its serialized bytes, so that calculating
+    the Content-Length and iterating the response serialize the tree once.
+    Middleware which modifies ``tree`` should return a new serializer.
+    """
+    
+    _buffer = None
+    
+    def serialize(self, encoding=None):
+        if encoding is not None:
+            return XMLSerializer.serialize(self, encoding)
+        if self._buffer is None:
+            self._buffer = XMLSerializer.serialize(self)
+        return self._buffer
+
+class DependencyResolver(etree.Resolver):
+    """Base class for resolvers which can record the urls they resolve
+    """
+    
+    # Set to a list to record resolved urls
+    dependencies = None
+    
+    def record(self, system_url):
+        if self.dependencies is not None:
+            self.dependencies.append(system_url)
+
+class FilesystemResolver(DependencyResolver):
     """Resolver for filesystem paths
     """
     def resolve(self, system_url, public_id, context):
         if not '://' in system_url and os.path.exists(system_url):
+            self.record(system_url)
             return self.resolve_filename(system_url, context)
         else:
             return None
 
-class NetworkResolver(etree.Resolver):
+class NetworkResolver(DependencyResolver):
     """Resolver for network urls
     """
     def resolve(self, system_url, public_id, context):
         if '://' in system_url and system_url != 'file:///__diazo__':
+            self.record(system_url)
             return self.resolve_filename(system_url, context)
         else:
             return None
 
-class PythonResolver(etree.Resolver):
+class PythonResolver(DependencyResolver):
     """Resolver for python:// urls
     """
     
@@ -59,14 +276,59 @@ class PythonResolver(etree.Resolver):
         package, resource_name = spec.split('/', 1)
         filename = pkg_resources.resource_filename(package, resource_name)
         
+        self.record(system_url)
         return self.resolve_filename(filename, context)
 
-class WSGIResolver(etree.Resolver):
+class _Subrequest(object):
+    """A subrequest in progress, which other threads may wait for
+    """
+    
+    body = None
+    
+    def __init__(self):
+        self.event = threading.Event()
+
+class WSGIResolver(DependencyResolver):
     """Resolver that performs a WSGI subrequest
     """
     
-    def __init__(self, app):
+    def __init__(self, app, cache=None, cache_ttl=0, negative_ttl=None, cache_ttls=()):
+        """Create the resolver. The parameters are:
+        
+        * ``app``, the WSGI application to make subrequests to
+        * ``cache``, can be set to a ``diazo.utils.LRUCache`` in which the
+          results of subrequests are cached. The cache may be shared between
+          resolvers.
+        * ``cache_ttl``, the number of seconds successful responses are
+          cached for, unless they have a Cache-Control max-age
+        * ``negative_ttl``, the number of seconds failed responses are cached
+          for, unless they have a Cache-Control max-age. Defaults to
+          ``cache_ttl``.
+        * ``cache_ttls``, a list of ``(pattern, seconds)`` tuples. Successful
+          responses for urls matching a regular expression pattern are
+          cached for the seconds given with the first pattern that matches,
+          rather than ``cache_ttl``, unless they have a Cache-Control
+          max-age.
+        
+        Responses with Cache-Control no-store, no-cache or private are not
+        cached. Concurrent resolutions of the same url share a subrequest.
+        """
         self.app = app
+        self.cache = cache
+        self.cache_ttl = cache_ttl
+        if negative_ttl is None:
+            negative_ttl = cache_ttl
+        self.negative_ttl = negative_ttl
+        self.cache_ttls = [(re.compile(pattern), int(seconds)) for pattern, seconds in cache_ttls]
+        self._lock = threading.Lock()
+        self._subrequests = {}
+        self._local = threading.local()
+    
+    def use_prefetched(self, bodies):
+        """Resolve the urls in the dict bodies from it in the current thread,
+        until called again with None.
+        """
+        self._local.prefetched = bodies
     
     def resolve(self, system_url, public_id, context):
         # Ignore URLs with a scheme
@@ -77,19 +339,87 @@ class WSGIResolver(etree.Resolver):
         if system_url.startswith('diazo:'):
             return None
         
-        subrequest = Request.blank(system_url)
-        response = subrequest.get_response(self.app)
+        # Leave filesystem paths to the FilesystemResolver. Resolvers are
+        # stored in a set, so the order they are consulted in is arbitrary.
+        if os.path.exists(system_url):
+            return None
         
-        status_code = response.status.split()[0]
-        if not status_code == '200':
+        body = self.fetch(system_url)
+        if body is None:
             return None
         
-        return self.resolve_string(response.body, context)
+        self.record(system_url)
+        return self.resolve_string(body, context)
+    
+    def fetch(self, url):
+        """Return the body of a successful subrequest for url, or None.
+        """
+        prefetched = getattr(self._local, 'prefetched', None)
+        if prefetched is not None and url in prefetched:
+            return prefetched[url]
+        
+        if self.cache is not None:
+            entry = self.cache.get(url)
+            if entry is not None and entry[0] > time.time():
+                return entry[1]
+        
+        self._lock.acquire()
+        try:
+            subrequest = self._subrequests.get(url)
+            waiting = subrequest is not None
+            if not waiting:
+                subrequest = self._subrequests[url] = _Subrequest()
+        finally:
+            self._lock.release()
+        
+        if waiting:
+            subrequest.event.wait()
+            return subrequest.body
+        
+        try:
+            response = Request.blank(url).get_response(self.app)
+            status_code = response.status.split()[0]
+            if status_code == '200':
+                subrequest.body = response.body
+            if self.cache is not None:
+                ttl = self.ttl(response, subrequest.body is not None, url)
+                if ttl > 0:
+                    self.cache.set(url, (time.time() + ttl, subrequest.body), len(subrequest.body or ''))
+        finally:
+            self._lock.acquire()
+            try:
+                del self._subrequests[url]
+            finally:
+                self._lock.release()
+            subrequest.event.set()
+        return subrequest.body
+    
+    def ttl(self, response, success=True, url=None):
+        """Return the number of seconds to cache a subrequest response for url
+        """
+        cache_control = response.cache_control
+        if cache_control.no_store or cache_control.no_cache or cache_control.private:
+            return 0
+        max_age = cache_control.s_maxage
+        if max_age is None:
+            max_age = cache_control.max_age
+        if max_age is not None:
+            return int(max_age)
+        if not success:
+            return self.negative_ttl
+        if url is not None:
+            for pattern, seconds in self.cache_ttls:
+                if pattern.search(url):
+                    return seconds
+        return self.cache_ttl
 
 class XSLTMiddleware(object):
     """Apply XSLT in middleware
     """
     
+    # Feed parser for the upstream response
+    parser_class = html.HTMLParser
+    
     def __init__(self, app, global_conf,
                  filename=None, tree=None,
                  read_network=False,
@@ -105,6 +435,15 @@ class XSLTMiddleware(object):
                  unquoted_params=None,
                  doctype=None,
                  content_type=None,
+                 response_cache=None,
+                 response_cache_size=None,
+                 compression_level=None,
+                 compression_min_size=1024,
+                 transform_max_size=None,
+                 include_resolver=None,
+                 prefetch_pool=None,
+                 metrics=None,
+                 server_timing=False,
                  **params
     ):
         """Initialise, giving a filename or parsed XSLT tree.
@@ -135,6 +474,36 @@ class XSLTMiddleware(object):
           the XSLT, for example, "<!DOCTYPE html>".
         * ``content_type``, can be set to a string which will be set in the
           Content-Type header. By default it is inferred from the stylesheet.
+        * ``response_cache``, can be set to a ``diazo.utils.LRUCache`` in
+          which the transformed output is cached, keyed on the upstream
+          response, the stylesheet and the parameters. The cache may be
+          shared between middleware instances. It is not used when the
+          stylesheet includes other documents, as the key cannot tell when
+          they change.
+        * ``response_cache_size``, can be set to a size in bytes to create a
+          response cache of that size.
+        * ``compression_level``, can be set from 1 to 9 to compress the output
+          with gzip or deflate when the client accepts it, or to 0 to never
+          compress it. By default only output for responses which were
+          compressed by the application is compressed, at level 6. Compressed
+          responses from the application are always decompressed for the
+          transformation.
+        * ``compression_min_size``, the size in bytes below which the output
+          is not compressed.
+        * ``transform_max_size``, can be set to a size in bytes above which
+          responses are not transformed, but streamed through to the client.
+        * ``include_resolver``, can be set to the ``WSGIResolver`` used by the
+          stylesheet to fetch the documents it includes before the
+          transformation, in parallel. Includes whose conditions are false
+          for the request are not fetched.
+        * ``prefetch_pool``, the thread pool used to fetch includes. By
+          default a pool of 4 threads is created.
+        * ``metrics``, can be set to a ``diazo.metrics.Metrics`` in which the
+          outcome of each request and the time taken by each phase is
+          recorded. The times for a request are always kept in the
+          ``diazo.timing`` environ key.
+        * ``server_timing``, can be set to True to send the times for each
+          request in a ``Server-Timing`` response header.
          
         Additional keyword arguments will be passed to the transformation as
         parameters.
@@ -170,7 +539,15 @@ class XSLTMiddleware(object):
         self.read_network = asbool(read_network)
         self.read_file = asbool(read_file)
         self.access_control = etree.XSLTAccessControl(read_file=self.read_file, write_file=False, create_dir=False, read_network=self.read_network, write_network=False)
-        self.transform = etree.XSLT(tree, access_control=self.access_control)
+        self.tree = tree
+        # XSLT objects and their error logs are not shared between threads
+        self._local = threading.local()
+        self._local.transform = etree.XSLT(tree, access_control=self.access_control)
+        # Transforms made ready by prepare_transforms, for threads to take
+        self._prepared = []
+        # The number of XSLT transforms created, which each hold a copy of
+        # the stylesheet
+        self.transform_count = 1
         self.update_content_length = asbool(update_content_length)
         self.ignored_extensions = ignored_extensions
         
@@ -182,29 +559,173 @@ class XSLTMiddleware(object):
         self.unquoted_params = unquoted_params and frozenset(unquoted_params) or ()
         self.params = params
         self.doctype = doctype
+        
+        if response_cache is None and response_cache_size:
+            response_cache = LRUCache(maxbytes=int(response_cache_size))
+        if response_cache is not None and DOCUMENT_CALLS(tree):
+            logger.info("Not caching themed responses, the theme includes other documents")
+            response_cache = None
+        self.response_cache = response_cache
+        if compression_level is not None:
+            compression_level = int(compression_level)
+        self.compression_level = compression_level
+        self.compression_min_size = int(compression_min_size)
+        if transform_max_size is not None:
+            transform_max_size = int(transform_max_size)
+        self.transform_max_size = transform_max_size
+        
+        self.include_resolver = include_resolver
+        self.includes = []
+        if include_resolver is not None:
+            for url, condition in find_includes(tree):
+                if condition is not None:
+                    try:
+                        condition = etree.XPath(condition, extensions=XPATH_EXTENSIONS)
+                    except etree.XPathSyntaxError:
+                        condition = None
+                self.includes.append((url, condition))
+            if self.includes and prefetch_pool is None:
+                prefetch_pool = ThreadPool(4)
+        self.prefetch_pool = prefetch_pool
+        self.metrics = metrics
+        self.server_timing = asbool(server_timing)
+        
+        # Identifies the output for a given input, for caching and ETags. It
+        # is the same in every process applying the same theme.
+        self.theme_version = hashlib.sha1(repr((theme_digest(tree),
+            doctype, content_type, sorted(params.items())))).hexdigest()
+    
+    @property
+    def transform(self):
+        """The XSLT transform for the current thread
+        """
+        transform = getattr(self._local, 'transform', None)
+        if transform is None:
+            try:
+                transform = self._prepared.pop()
+            except IndexError:
+                transform = etree.XSLT(self.tree, access_control=self.access_control)
+                self.transform_count += 1
+            self._local.transform = transform
+        return transform
+    
+    def prepare_transforms(self, count, tree):
+        """Create ``count`` XSLT transforms and apply each of them to tree,
+        so that the first request in up to ``count`` threads does not have
+        to build one.
+        """
+        for i in range(count):
+            transform = etree.XSLT(self.tree, access_control=self.access_control)
+            self.transform_count += 1
+            transform(tree)
+            self._prepared.append(transform)
     
     def __call__(self, environ, start_response):
+        return self.process(self.app, environ, start_response)
+    
+    def transform_response(self, environ, status, headerlist, body):
+        """Apply the transform to a response which was produced outside of
+        WSGI, returning a ``(status, headerlist, body)`` tuple. The
+        parameters are:
+        
+        * ``environ``, a WSGI environ for the request
+        * ``status``, the response status line, e.g. '200 OK'
+        * ``headerlist``, a list of ``(name, value)`` response headers
+        * ``body``, the response body as a string
+        
+        This blocks while the response is parsed and transformed, so servers
+        with an event loop should call it from a worker thread.
+        """
+        return replay_response(self.process, environ, status, headerlist, body)
+    
+    def process(self, app, environ, start_response):
+        """Call ``app`` and apply the transform to its response
+        """
+        start = time.time()
+        environ.setdefault('diazo.timing', {})
+        if self.server_timing:
+            start_response = self.timing_start_response(environ, start_response, start)
+        try:
+            return self._process(app, environ, start_response)
+        except Exception:
+            self.count('errors')
+            raise
+        finally:
+            self.record_phase(environ, 'total', start)
+    
+    def _process(self, app, environ, start_response):
         request = Request(environ)
         
-        ignore = self.should_ignore(request)
-
-        if not ignore:
-            # We do not deal with Range requests
+        if self.should_ignore(request):
+            self.count('bypassed')
+            if request.method == 'HEAD':
+                # Let WebOb drop the body
+                return request.get_response(app)(environ, start_response)
+            return app(environ, start_response)
+        
+        # We do not deal with Range requests
+        try:
+            del request.headers['Range']
+        except KeyError:
+            pass
+        
+        # Revalidate the upstream response for the ETags we sent. Whether
+        # the response is themed is not known yet, so other ETags are passed
+        # through for the application to answer. ETags of a different theme
+        # or parameters are dropped.
+        etag_suffix = self.etag_suffix(environ)
+        if_none_match = parse_etags(request.headers.get('If-None-Match'))
+        if if_none_match:
+            # Tags are forwarded as the client sent them, weak or not
+            upstream = []
+            for sent in request.headers['If-None-Match'].split(','):
+                sent = sent.strip()
+                if not sent:
+                    continue
+                if sent.endswith(etag_suffix + '"'):
+                    upstream.append(sent[:-len(etag_suffix) - 1] + '"')
+                elif not THEMED_ETAG.search(sent):
+                    upstream.append(sent)
+            if upstream:
+                request.headers['If-None-Match'] = ', '.join(upstream)
+            else:
+                del request.headers['If-None-Match']
+        
+        captured = dict(etag_suffix=etag_suffix, if_none_match=if_none_match, written=[])
+        start = time.time()
+        app_iter = app(environ, self._sr(captured, start_response))
+        chunks = captured['written']
+        iterator = iter(app_iter)
+        
+        # The application may call start_response when first iterated
+        while 'response' not in captured:
             try:
-                del request.headers['Range']
-            except KeyError:
-                pass
-
-        response = request.get_response(self.app)
-
-        sr = self._sr(start_response)
-        app_iter = response(environ, sr)
+                chunks.append(iterator.next())
+            except StopIteration:
+                raise AssertionError("The application did not call start_response")
+        self.record_phase(environ, 'app', start)
         
-        if ignore or not self.should_transform(response):
-            start_response(self._status,
-                           self._response_headers,
-                           self._exc_info)
-            return app_iter
+        # Responses we do not transform have been started already
+        if not captured['transform']:
+            self.count('bypassed')
+            if not chunks:
+                return app_iter
+            return StreamIterator(chunks, iterator, app_iter)
+        
+        response = captured['response']
+        upstream_headers = list(response.headerlist)
+        themed_etag, not_modified = self.themed_etag(response, etag_suffix, if_none_match)
+        
+        # The client has the current version of the themed response
+        if not_modified:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+            headers = [(name, value) for name, value in response.headers.items()
+                       if name.lower() in NOT_MODIFIED_HEADERS]
+            headers.append(('ETag', themed_etag))
+            self.count('not_modified')
+            start_response('304 Not Modified', headers, captured['exc_info'])
+            return []
         
         # Set up parameters
         
@@ -221,9 +742,118 @@ class XSLTMiddleware(object):
             else:
                 params[key] = quote_param(value)
         
-        # Apply the transformation
-        app_iter = getHTMLSerializer(app_iter)
-        tree = self.transform(app_iter.tree, **params)
+        # We decode compressed responses and encode the output ourselves
+        upstream_encoding = response.headers.get('Content-Encoding')
+        if upstream_encoding:
+            del response.headers['Content-Encoding']
+            if upstream_encoding.lower() not in DECODED_ENCODINGS:
+                upstream_encoding = None
+        
+        # Use the output cached for the same upstream response. Responses
+        # identified by a hash of their body are looked up once read.
+        cacheable = self.response_cache is not None and not response.cache_control.no_store
+        cache_key = None
+        if cacheable:
+            cache_key = self.response_cache_key(request, response)
+        if themed_etag is not None:
+            response.headers['ETag'] = themed_etag
+        if cache_key is not None:
+            body = self.cached_body(request, response, cache_key, upstream_encoding)
+            if body is not None:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+                self.count('cache_hits')
+                self.count('bytes_out', len(body))
+                start_response(response.status,
+                               response.headers.items(),
+                               captured['exc_info'])
+                return [body]
+        
+        # Parse the response as it arrives, unless it is to be looked up in
+        # the cache first
+        tree = None
+        parser = None
+        if not cacheable or cache_key is not None:
+            parser = self.parser_class()
+        if isinstance(app_iter, XMLSerializer) and not chunks:
+            # Other middleware has parsed the response already
+            tree = app_iter.tree
+            body = parser is None and str(app_iter) or None
+        else:
+            start = time.time()
+            source = itertools.chain(chunks, iterator)
+            body_chunks = []
+            if not self.read_response(source, body_chunks, parser, upstream_encoding):
+                self.count('bypassed')
+                start_response(response.status, upstream_headers, captured['exc_info'])
+                return StreamIterator(body_chunks, source, app_iter)
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+            body = ''.join(body_chunks)
+            if parser is not None:
+                tree = parser.close().getroottree()
+            self.record_phase(environ, 'parse', start)
+        upstream_size = body is not None and len(body) or 0
+        
+        if cacheable and cache_key is None:
+            cache_key = self.response_cache_key(request, response, body)
+            cached = self.cached_body(request, response, cache_key, upstream_encoding)
+            if cached is not None:
+                self.count('cache_hits')
+                self.count('bytes_out', len(cached))
+                start_response(response.status,
+                               response.headers.items(),
+                               captured['exc_info'])
+                return [cached]
+        
+        if tree is None:
+            start = time.time()
+            parser = self.parser_class()
+            self.read_response(iter([body]), [], parser, upstream_encoding)
+            tree = parser.close().getroottree()
+            self.record_phase(environ, 'parse', start)
+        
+        content_type, app_iter, body = self.apply_transform(tree, environ, params)
+        if cache_key is not None:
+            self.response_cache.set(cache_key, (content_type, body), len(body))
+        
+        start = time.time()
+        encoded = self.encode_body(request, response, body, upstream_encoding)
+        if encoded is not None:
+            body = encoded
+            app_iter = [encoded]
+            self.record_phase(environ, 'compress', start)
+        self.update_headers(response, content_type, body)
+        self.count('themed')
+        self.count('bytes_in', upstream_size)
+        self.count('bytes_out', len(body))
+
+        # Start response here, after we update response headers
+        start_response(response.status,
+                       response.headers.items(),
+                       captured['exc_info'])
+        # Return a repoze.xmliter XMLSerializer, which helps avoid re-parsing
+        # the content tree in later middleware stages
+        return app_iter
+
+    def apply_transform(self, tree, environ, params):
+        """Apply the transform to the parsed response, returning a
+        ``(content_type, app_iter, body)`` tuple.
+        """
+        # Apply the transformation, with the includes fetched beforehand
+        prefetched = None
+        if self.includes:
+            start = time.time()
+            prefetched = self.prefetch_includes(tree, environ)
+            self.include_resolver.use_prefetched(prefetched)
+            self.record_phase(environ, 'includes', start)
+        start = time.time()
+        try:
+            tree = self.transform(tree, **params)
+        finally:
+            if prefetched is not None:
+                self.include_resolver.use_prefetched(None)
+        self.record_phase(environ, 'transform', start)
         
         # Set content type
         # Unfortunately lxml does not expose docinfo.mediaType
@@ -236,36 +866,214 @@ class XSLTMiddleware(object):
         encoding = tree.docinfo.encoding
         if not encoding:
             encoding = "UTF-8"
-        response.headers['Content-Type'] = '%s; charset=%s' % (content_type, encoding)
+        content_type = '%s; charset=%s' % (content_type, encoding)
         
-        app_iter = XMLSerializer(tree, doctype=self.doctype)
+        # We still return the parsed tree so that other middleware could
+        # avoid having to re-parse. The serialized output is kept for the
+        # response body.
+        start = time.time()
+        app_iter = BufferedXMLSerializer(tree, doctype=self.doctype)
+        body = str(app_iter)
+        self.record_phase(environ, 'serialize', start)
+        return content_type, app_iter, body
+    
+    def record_phase(self, environ, phase, start):
+        """Record the time since start as taken by a phase of the request,
+        in the ``diazo.timing`` environ key and the metrics.
+        """
+        seconds = time.time() - start
+        timing = environ.setdefault('diazo.timing', {})
+        timing[phase] = timing.get(phase, 0.0) + seconds
+        if self.metrics is not None:
+            self.metrics.observe(phase, seconds)
+    
+    def count(self, name, value=1):
+        """Add value to the named counter of the metrics
+        """
+        if self.metrics is not None:
+            self.metrics.increment(name, value)
+    
+    def timing_start_response(self, environ, start_response, start):
+        """Return a start_response which adds a Server-Timing header with the
+        times recorded for the request so far
+        """
+        def timing_start_response(status, response_headers, exc_info=None):
+            timing = dict(environ.get('diazo.timing', {}))
+            timing['total'] = time.time() - start
+            response_headers = list(response_headers) + [('Server-Timing', server_timing(timing))]
+            return start_response(status, response_headers, exc_info)
+        return timing_start_response
+    
+    def update_headers(self, response, content_type, body):
+        """Set the headers of the response for the transformed body
+        """
+        response.headers['Content-Type'] = content_type
         
-        # Calculate the content length - we still return the parsed tree
-        # so that other middleware could avoid having to re-parse, even if
-        # we take a hit on serialising here
+        # Calculate the content length
         if self.update_content_length and 'Content-Length' in response.headers:
-            response.headers['Content-Length'] = str(len(str(app_iter)))
+            response.headers['Content-Length'] = str(len(body))
         
         # Remove Content-Range if set by the application we theme
         if self.update_content_length and 'Content-Range' in response.headers:
             del(response.headers['Content-Range'])
-
-        # Start response here, after we update response headers
-        self._response_headers = response.headers.items()
-        start_response(self._status,
-                       self._response_headers,
-                       self._exc_info)
-        # Return a repoze.xmliter XMLSerializer, which helps avoid re-parsing
-        # the content tree in later middleware stages
-        return app_iter
-
-    def _sr(self, start_response):
-        """Capture a start_response call
+    
+    def encode_body(self, request, response, body, upstream_encoding=None):
+        """Compress the transformed body if the client accepts it, setting
+        the response headers. Returns the compressed body, or None if it is
+        not compressed.
+        """
+        level = self.compression_level
+        if level is None:
+            level = upstream_encoding and 6 or 0
+        if not level or len(body) < self.compression_min_size:
+            return None
+        
+        if 'accept-encoding' not in [name.lower() for name in response.vary or ()]:
+            response.vary = tuple(response.vary or ()) + ('Accept-Encoding',)
+        content_encoding = accepted_encoding(request.headers.get('Accept-Encoding'))
+        if content_encoding is None:
+            return None
+        
+        response.headers['Content-Encoding'] = content_encoding
+        # The compressed body is no longer byte for byte the same
+        etag = response.headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            response.headers['ETag'] = 'W/' + etag
+        return encode_body(body, content_encoding, level)
+    
+    def prefetch_includes(self, tree, environ):
+        """Fetch the includes used to transform the content tree in parallel,
+        returning a dict of their urls to their bodies. Includes with
+        conditions which cannot be evaluated outside of the transformation
+        are fetched.
+        """
+        variables = {}
+        for name, value in self.params.items():
+            if value is not None and name not in self.unquoted_params:
+                variables[name] = value
+        for key, name in self.environ_param_map.items():
+            if environ.get(key) is not None and name not in self.unquoted_params:
+                variables[name] = environ[key]
+        path = variables.get('path', '')
+        if not path.endswith('/'):
+            path += '/'
+        variables['normalized_path'] = path
+        
+        urls = []
+        for url, condition in self.includes:
+            if condition is not None:
+                try:
+                    if not condition(tree, **variables):
+                        continue
+                except (etree.XPathError, ValueError):
+                    pass
+            urls.append(url)
+        if len(urls) > 1:
+            bodies = self.prefetch_pool.map(self.include_resolver.fetch, urls)
+        else:
+            bodies = [self.include_resolver.fetch(url) for url in urls]
+        return dict(zip(urls, bodies))
+    
+    def read_response(self, source, chunks, parser=None, content_encoding=None):
+        """Read the response from the iterator source into the list chunks,
+        feeding it to parser as it arrives. Returns False if the response is
+        larger than ``transform_max_size``, when reading stops.
+        """
+        too_large = []
+        def read():
+            size = 0
+            for chunk in source:
+                chunks.append(chunk)
+                size += len(chunk)
+                if self.transform_max_size is not None and size > self.transform_max_size:
+                    too_large.append(True)
+                    return
+                yield chunk
+        
+        data = read()
+        if parser is not None and content_encoding:
+            data = decode_iter(data, content_encoding)
+        for chunk in data:
+            if parser is not None:
+                parser.feed(chunk)
+        return not too_large
+    
+    def cached_body(self, request, response, cache_key, upstream_encoding=None):
+        """Return the cached body of the transformed response, setting the
+        response headers, or None if it is not cached.
+        """
+        if 'no-cache' in request.headers.get('Cache-Control', ''):
+            return None
+        cached = self.response_cache.get(cache_key)
+        if cached is None:
+            return None
+        content_type, body = cached
+        body = self.encode_body(request, response, body, upstream_encoding) or body
+        self.update_headers(response, content_type, body)
+        return body
+    
+    def response_cache_key(self, request, response, body=None):
+        """Return the key of the transformed response in the response cache.
+        Responses which may be shared are identified by their url and strong
+        ETag, others by a hash of their body, or None if body is not given.
+        The key includes the environ values passed as parameters.
+        """
+        cache_control = response.cache_control
+        etag = response.headers.get('ETag')
+        vary = response.headers.get('Vary', '')
+        if etag and not etag.startswith('W/') and not cache_control.private and '*' not in vary:
+            varied = tuple(request.headers.get(name.strip()) for name in vary.split(',') if name.strip())
+            validator = ('etag', request.url, etag, varied)
+        elif body is not None:
+            validator = ('sha1', hashlib.sha1(body).hexdigest())
+        else:
+            return None
+        
+        return (self.theme_version, response.status, self.environ_values(request.environ), validator)
+    
+    def environ_values(self, environ):
+        """Return the environ values passed as parameters
+        """
+        return tuple(sorted((name, environ.get(key)) for key, name in self.environ_param_map.items()))
+    
+    def etag_suffix(self, environ):
+        """Return the suffix added to upstream ETags, which identifies the
+        stylesheet and parameters used to transform the response.
+        """
+        return '-diazo-' + hashlib.sha1(repr((self.theme_version, self.environ_values(environ)))).hexdigest()[:16]
+    
+    def themed_etag(self, response, etag_suffix, if_none_match):
+        """Return the ETag of the transformed response and whether it matches
+        the If-None-Match header of the request.
+        """
+        etag = response.headers.get('ETag')
+        if not etag:
+            return None, False
+        themed_etag = add_etag_suffix(etag, etag_suffix)
+        return themed_etag, '*' in if_none_match or parse_etags(themed_etag)[0] in if_none_match
+    
+    def _sr(self, captured, start_response):
+        """Capture a start_response call in the dict captured, deciding
+        whether to transform the response. Other responses are started
+        straight away so that they can be streamed through. State is kept
+        per request so that the middleware may be used by many threads.
         """
         def callback(status, response_headers, exc_info=None):
-            self._status = status
-            self._response_headers = response_headers
-            self._exc_info = exc_info
+            response = Response(status=status, headerlist=list(response_headers), app_iter=[])
+            captured['response'] = response
+            captured['exc_info'] = exc_info
+            captured['transform'] = self.should_transform(response) and not (
+                self.transform_max_size is not None and response.content_length is not None
+                and response.content_length > self.transform_max_size)
+            if captured['transform']:
+                return captured['written'].append
+            
+            if response.status_int == 304:
+                themed_etag, not_modified = self.themed_etag(response,
+                    captured['etag_suffix'], captured['if_none_match'])
+                if not_modified:
+                    response.headers['ETag'] = themed_etag
+            return start_response(status, response.headerlist, exc_info)
         return callback
    
     def should_ignore(self, request):
@@ -300,7 +1108,7 @@ class XSLTMiddleware(object):
             return False
         
         content_encoding = response.headers.get('Content-Encoding')
-        if content_encoding in ('zip', 'deflate', 'compress',):
+        if content_encoding and content_encoding.lower() not in ('identity',) + DECODED_ENCODINGS:
             return False
         
         status_code = response.status.split()[0]
@@ -309,6 +1117,95 @@ class XSLTMiddleware(object):
         
         return True
 
+class XPathFilterMiddleware(XSLTMiddleware):
+    """Return the nodes of the response selected by the XPath expression in
+    the ``diazo.filter_xpath`` environ key.
+    
+    The result is the same as applying ``filter_xhtml.xsl``, but the selected
+    nodes are serialized directly rather than copied by an XSLT transform.
+    """
+    
+    # Serializing in a document with this doctype selects libxml2's XHTML
+    # output rules, as used by the XSLT
+    fragment_document = ('<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" '
+                         '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd"><html/>')
+    
+    def __init__(self, app, global_conf, xpath_cache_size=1000, **kw):
+        """Create the middleware. ``xpath_cache_size`` is the number of
+        compiled XPath expressions to keep. Other arguments are passed to
+        ``XSLTMiddleware``.
+        """
+        kw.setdefault('tree', pkg_parse('filter_xhtml.xsl'))
+        kw.setdefault('environ_param_map', {'diazo.filter_xpath': 'xpath'})
+        kw.setdefault('unquoted_params', ['xpath'])
+        kw.setdefault('doctype', '')
+        super(XPathFilterMiddleware, self).__init__(app, global_conf, **kw)
+        self.xpaths = LRUCache(maxsize=int(xpath_cache_size))
+    
+    def compile_xpath(self, expression):
+        """Return the compiled XPath for expression
+        """
+        xpath = self.xpaths.get(expression)
+        if xpath is None:
+            xpath = etree.XPath(expression)
+            self.xpaths.set(expression, xpath)
+        return xpath
+    
+    def apply_transform(self, tree, environ, params):
+        start = time.time()
+        expression = environ.get('diazo.filter_xpath') or '/'
+        if expression == '/':
+            # lxml does not return document nodes
+            result = [tree.getroot()]
+        else:
+            result = self.compile_xpath(expression)(tree)
+        if not isinstance(result, list):
+            result = [result]
+        self.record_phase(environ, 'transform', start)
+        start = time.time()
+        body = ''.join([self.serialize(node) for node in result])
+        self.record_phase(environ, 'serialize', start)
+        if not body:
+            # Make sure we at least return something to avoid errors
+            body = '<!--WARNING: No content found-->'
+        content_type = '%s; charset=UTF-8' % (self.content_type or 'text/html')
+        return content_type, [body], body
+    
+    def serialize(self, node):
+        """Serialize a node or other XPath result as the XSLT would
+        """
+        if isinstance(node, basestring):
+            parent = getattr(node, 'getparent', lambda: None)()
+            text = node.replace('\r\n', '\n')
+            if parent is not None and parent.tag in ('style', 'script') and not node.is_attribute:
+                return text.encode('utf-8')
+            return escape(text).encode('utf-8')
+        if isinstance(node, bool):
+            return node and 'true' or 'false'
+        if isinstance(node, float):
+            if node == int(node):
+                return str(int(node))
+            return repr(node)
+        
+        # The parsed response is not used again, so the node is moved into a
+        # document which selects XHTML output rather than copied. The text of
+        # scripts and styles is left unescaped.
+        document = etree.fromstring(self.fragment_document)
+        node.tail = None
+        document.append(node)
+        if node.tag == 'html':
+            node.attrib.pop('xmlns', None)
+        raw = {}
+        for element in node.iter('style', 'script'):
+            if element.text:
+                marker = 'diazo-raw-%d' % len(raw)
+                raw[marker] = element.text.replace('\r\n', '\n')
+                element.text = marker
+        body = etree.tostring(node, encoding='UTF-8').replace('&#13;\n', '\n')
+        for marker, text in raw.items():
+            body = body.replace(marker, text.encode('utf-8'), 1)
+        return body
+
 class DiazoMiddleware(object):
     """Invoke the Diazo transform as middleware
     """
@@ -318,6 +1215,7 @@ class DiazoMiddleware(object):
                  prefix=None,
                  includemode='document',
                  debug=False,
+                 debug_check_interval=5,
                  read_network=False,
                  read_file=True,
                  update_content_length=True,
@@ -332,13 +1230,40 @@ class DiazoMiddleware(object):
                 doctype=None,
                 content_type=None,
                 filter_xpath=False,
+                cache_dir=None,
+                cache_max_size=None,
+                response_cache_size=None,
+                include_cache_ttl=None,
+                include_negative_ttl=None,
+                include_cache_ttls=None,
+                prefetch_includes=False,
+                prefetch_threads=4,
+                prefetch_pool=None,
+                compression_level=None,
+                compression_min_size=1024,
+                transform_max_size=None,
+                transform_threads=4,
+                transform_pool=None,
+                eager_compile=False,
+                background_compile=False,
+                warm_up=False,
+                runtime_prefix=False,
+                filter_xpath_cache_size=1000,
+                metrics=False,
+                metrics_path=None,
+                server_timing=False,
                 **params
     ):
         """Create the middleware. The parameters are:
         
         * ``rules``, the rules file
         * ``theme``, a URL to the theme file (may be a file:// URL)
-        * ``debug``, set to True to recompile the theme on each request
+        * ``debug``, set to True to recompile the theme whenever the rules,
+          theme or any other file read by the compiler changes
+        * ``debug_check_interval``, in debug mode files are checked for
+          changes on every request, but WSGI subrequests and network
+          resources read by the compiler are fetched again at most once in
+          this many seconds. Defaults to 5.
         * ``prefix`` can be set to a string that will be prefixed to
           any *relative* URL referenced in an image, link or stylesheet in the
           theme HTML file before the theme is passed to the compiler. This
@@ -348,6 +1273,10 @@ class DiazoMiddleware(object):
           example, an ``<img src="images/foo.jpg" />`` can be turned into 
           ``<img src="/static/images/foo.jpg" />`` with a ``prefix`` of
           "/static".
+        * ``runtime_prefix``, can be set to True to apply the prefix when the
+          theme is applied rather than when it is compiled. The prefix is
+          taken from the ``diazo.absolute_prefix`` environ key if it is set by
+          a middleware higher up the chain, otherwise from ``prefix``.
         * ``includemode`` can be set to 'document', 'esi' or 'ssi' to change
           the way in which includes are processed
         * ``read_network``, should be set to True to allow resolving resources
@@ -372,6 +1301,67 @@ class DiazoMiddleware(object):
           Content-Type header. By default it is inferred from the stylesheet.
         * ``filter_xpath``, should be set to True to enable filter_xpath support
           for external includes.
+        * ``filter_xpath_cache_size``, the number of compiled filter_xpath
+          expressions to keep.
+        * ``metrics``, can be set to True to record counters and timing
+          histograms for the requests in ``self.metrics``, a
+          ``diazo.metrics.Metrics``.
+        * ``metrics_path``, can be set to a path, e.g. "/diazo-metrics", at
+          which the metrics are served in the Prometheus text format. This
+          enables ``metrics``.
+        * ``server_timing``, can be set to True to send the time taken by
+          each phase of a request in a ``Server-Timing`` response header.
+        * ``cache_dir``, can be set to a directory in which compiled themes are
+          stored, so that restarting the process does not require a full
+          compile unless the rules or theme have changed.
+        * ``cache_max_size``, can be set to the maximum size in bytes of the
+          ``cache_dir`` directory.
+        * ``response_cache_size``, can be set to a size in bytes to cache the
+          themed output of upstream responses in memory. The cache is kept
+          when the theme is recompiled. Themes which include other documents
+          with ``href`` are not cached.
+        * ``include_cache_ttl``, can be set to a number of seconds to cache
+          the responses to subrequests made for includes, unless they have a
+          Cache-Control max-age. Set it to 0 to only cache responses with a
+          max-age.
+        * ``include_negative_ttl``, the number of seconds failed include
+          subrequests are cached for. Defaults to ``include_cache_ttl``.
+        * ``include_cache_ttls``, can be set to override ``include_cache_ttl``
+          for some includes, as a list of ``(pattern, seconds)`` tuples or a
+          string with a regular expression and a number of seconds on each
+          line, e.g. ``^/nav 300``. The first pattern to match the url of an
+          include applies.
+        * ``prefetch_includes``, should be set to True to make the subrequests
+          for the includes used by a request in parallel, before the theme is
+          applied, rather than one after another.
+        * ``prefetch_threads``, the number of threads used to prefetch
+          includes.
+        * ``prefetch_pool``, can be set to a thread pool shared with other
+          middleware to prefetch includes in, instead of creating one of
+          ``prefetch_threads`` threads.
+        * ``compression_level``, can be set from 1 to 9 to compress the
+          themed output with gzip or deflate when the client accepts it, or to
+          0 to never compress it. By default only output for responses which
+          were compressed by the application is compressed.
+        * ``compression_min_size``, the size in bytes below which the output
+          is not compressed.
+        * ``transform_max_size``, can be set to a size in bytes above which
+          responses are not themed, but streamed through to the client.
+        * ``transform_threads``, the number of threads used by
+          ``transform_async``.
+        * ``transform_pool``, can be set to a thread pool shared with other
+          middleware for ``transform_async``, instead of creating one of
+          ``transform_threads`` threads.
+        * ``eager_compile``, should be set to True to compile the theme when
+          the middleware is created rather than on the first request.
+        * ``background_compile``, should be set to True to compile the theme
+          in a background thread, ``compile_thread``, when the middleware is
+          created. Requests arriving before it has finished wait for it.
+        * ``warm_up``, can be set to a number of threads to prepare each
+          newly compiled theme for before it is used, by building an XSLT
+          transform for each and applying it to an empty document. True
+          prepares it for one thread. Unconditional includes are fetched
+          from the application.
         
         Additional keyword arguments will be passed to the theme
         transformation as parameters.
@@ -383,8 +1373,11 @@ class DiazoMiddleware(object):
         self.rules = rules
         self.theme = theme
         self.absolute_prefix = prefix
+        self.runtime_prefix = asbool(runtime_prefix)
         self.includemode = includemode
         self.debug = asbool(debug)
+        self.debug_check_interval = float(debug_check_interval)
+        self.dependencies_checked = 0
         self.read_network = asbool(read_network)
         self.read_file = asbool(read_file)
         self.update_content_length = asbool(update_content_length)
@@ -393,9 +1386,52 @@ class DiazoMiddleware(object):
         self.content_type = content_type
         self.unquoted_params = unquoted_params
         self.filter_xpath = asbool(filter_xpath)
+        self.filter_xpath_cache_size = int(filter_xpath_cache_size)
+        self.metrics_path = metrics_path
+        self.metrics = None
+        if asbool(metrics) or metrics_path:
+            self.metrics = Metrics()
+        self.server_timing = asbool(server_timing)
+        self.compression_level = compression_level
+        self.compression_min_size = compression_min_size
+        self.transform_max_size = transform_max_size
+        self.cache = None
+        if cache_dir:
+            self.cache = ThemeCache(cache_dir, cache_max_size)
+        self.response_cache = None
+        if response_cache_size:
+            self.response_cache = LRUCache(maxbytes=int(response_cache_size))
+        self.prefetch_includes = asbool(prefetch_includes)
+        self.prefetch_pool = prefetch_pool
+        if self.prefetch_includes and prefetch_pool is None:
+            self.prefetch_pool = ThreadPool(int(prefetch_threads))
+        self.transform_threads = int(transform_threads)
+        self.transform_pool = transform_pool
+        self.transform_pool_lock = threading.Lock()
+        self.include_resolver = None
+        self.include_cache = None
+        self.include_cache_ttl = self.include_negative_ttl = 0
+        if isinstance(include_cache_ttls, basestring):
+            include_cache_ttls = [line.rsplit(None, 1) for line in include_cache_ttls.splitlines()
+                                  if line.strip()]
+        self.include_cache_ttls = include_cache_ttls or ()
+        if include_cache_ttl is not None or self.include_cache_ttls:
+            self.include_cache = LRUCache()
+        if include_cache_ttl is not None:
+            self.include_cache_ttl = int(include_cache_ttl)
+            if include_negative_ttl is not None:
+                self.include_negative_ttl = int(include_negative_ttl)
+            else:
+                self.include_negative_ttl = self.include_cache_ttl
         
         self.access_control = etree.XSLTAccessControl(read_file=self.read_file, write_file=False, create_dir=False, read_network=self.read_network, write_network=False)
         self.transform_middleware = None
+        self.compile_lock = threading.Lock()
+        try:
+            self.warm_up = int(warm_up)
+        except ValueError:
+            self.warm_up = asbool(warm_up) and 1 or 0
+        self.dependencies = ()
         self.filter_middleware = self.get_filter_middleware()
         
         self.environ_param_map = environ_param_map or {}
@@ -404,8 +1440,19 @@ class DiazoMiddleware(object):
                 'diazo.host': 'host',
                 'diazo.scheme': 'scheme',
             })
+        if self.runtime_prefix:
+            self.environ_param_map['diazo.absolute_prefix'] = 'diazo-prefix'
         
         self.params = params.copy()
+        
+        self.compile_thread = None
+        if asbool(background_compile):
+            self.compile_thread = threading.Thread(target=self.compile_in_background,
+                                                   name='diazo-compile')
+            self.compile_thread.daemon = True
+            self.compile_thread.start()
+        elif asbool(eager_compile):
+            self.get_current_middleware()
     
     def compile_theme(self):
         """Compile the Diazo theme, returning an lxml tree (containing an XSLT
@@ -413,10 +1460,23 @@ class DiazoMiddleware(object):
         """
         
         filesystem_resolver = FilesystemResolver(self.app)
-        wsgi_resolver = WSGIResolver(self.app)
+        wsgi_resolver = WSGIResolver(self.app, self.include_cache,
+                self.include_cache_ttl, self.include_negative_ttl, self.include_cache_ttls)
+        self.include_resolver = wsgi_resolver
         python_resolver = PythonResolver()
         network_resolver = NetworkResolver()
         
+        # Record everything read during the compile. The resolvers remain
+        # attached to the compiled theme, so stop recording afterwards. When
+        # caching, the files are hashed as they are read.
+        if self.cache is not None:
+            dependencies = Dependencies()
+        else:
+            dependencies = []
+        resolvers = (filesystem_resolver, wsgi_resolver, python_resolver, network_resolver)
+        for resolver in resolvers:
+            resolver.dependencies = dependencies
+        
         rules_parser = etree.XMLParser(recover=False)
         rules_parser.resolvers.add(filesystem_resolver)
         rules_parser.resolvers.add(wsgi_resolver)
@@ -436,20 +1496,126 @@ class DiazoMiddleware(object):
             if value not in xsl_params:
                 xsl_params[value] = None
         
-        return compile_theme(self.rules,
-                theme=self.theme,
-                absolute_prefix=self.absolute_prefix,
-                includemode=self.includemode,
-                access_control=self.access_control,
-                read_network=self.read_network,
-                parser=theme_parser,
-                rules_parser=rules_parser,
-                xsl_params=xsl_params,
-            )
+        try:
+            compiled = compile_theme(self.rules,
+                    theme=self.theme,
+                    absolute_prefix=self.absolute_prefix,
+                    includemode=self.includemode,
+                    access_control=self.access_control,
+                    read_network=self.read_network,
+                    parser=theme_parser,
+                    rules_parser=rules_parser,
+                    xsl_params=xsl_params,
+                    cache=self.cache,
+                    dependencies=dependencies,
+                    runtime_prefix=self.runtime_prefix,
+                )
+        finally:
+            for resolver in resolvers:
+                resolver.dependencies = None
+        
+        seen = set()
+        self.dependencies = []
+        self.dependencies_checked = time.time()
+        for url in dependencies:
+            if url not in seen:
+                seen.add(url)
+                self.dependencies.append((url, self.dependency_version(url)))
+        return compiled
+    
+    def dependency_version(self, url):
+        """Return a value which changes when the resource at url changes:
+        the modification time and size of files, or a hash of the content
+        of WSGI subrequests and network resources.
+        """
+        filename = url_filename(url)
+        if filename is not None and os.path.exists(filename):
+            st = os.stat(filename)
+            return (st.st_mtime, st.st_size)
+        try:
+            if '://' in url:
+                if not self.read_network:
+                    return None
+                body = urllib2.urlopen(url).read()
+            else:
+                response = Request.blank(url).get_response(self.app)
+                body = response.status + response.body
+        except (IOError, ValueError):
+            return None
+        return hashlib.sha1(body).hexdigest()
+    
+    def dependencies_changed(self):
+        """Determine if any file or url read when compiling the theme has
+        changed since. Files are always checked, other urls only once every
+        ``debug_check_interval`` seconds.
+        """
+        if not self.dependencies:
+            return True
+        now = time.time()
+        check_urls = now - self.dependencies_checked >= self.debug_check_interval
+        if check_urls:
+            self.dependencies_checked = now
+        for url, version in self.dependencies:
+            if not check_urls:
+                filename = url_filename(url)
+                if filename is None or not os.path.exists(filename):
+                    continue
+            if self.dependency_version(url) != version:
+                return True
+        return False
+    
+    def get_current_middleware(self):
+        """Return the transform middleware, compiling the theme first when
+        it has not been compiled or, in debug mode, when it has changed.
+        Only one thread compiles at a time. While a changed theme is being
+        recompiled other requests use the previous one, and the new one is
+        swapped in once it is ready.
+        """
+        middleware = self.transform_middleware
+        if middleware is not None and not (self.debug and self.dependencies_changed()):
+            return middleware
+        if middleware is not None and not self.compile_lock.acquire(False):
+            return middleware
+        if middleware is None:
+            self.compile_lock.acquire()
+        try:
+            # Another thread may have compiled the theme while we waited
+            if self.transform_middleware is not middleware:
+                return self.transform_middleware
+            start = time.time()
+            middleware = self.get_transform_middleware()
+            if self.warm_up:
+                self.warm_up_middleware(middleware)
+            if self.metrics is not None:
+                self.metrics.observe('compile', time.time() - start)
+            self.transform_middleware = middleware
+            return middleware
+        finally:
+            self.compile_lock.release()
+    
+    def compile_in_background(self):
+        """Compile the theme, logging any error. The theme is compiled on the
+        next request instead if this fails.
+        """
+        try:
+            self.get_current_middleware()
+        except Exception:
+            logger.exception("Failed to compile theme %s" % self.rules)
+    
+    def warm_up_middleware(self, middleware):
+        """Prepare transforms of the compiled theme for ``warm_up`` threads,
+        so that they are ready before the first requests.
+        """
+        try:
+            middleware.prepare_transforms(self.warm_up,
+                etree.HTML('<html><head></head><body></body></html>').getroottree())
+        except Exception:
+            logger.exception("Failed to warm up theme %s" % self.rules)
     
     def get_transform_middleware(self):
+        tree = self.compile_theme()
         return XSLTMiddleware(self.app, self.global_conf,
-                tree=self.compile_theme(),
+                tree=tree,
                 read_network=self.read_network,
                 read_file=self.read_file,
                 update_content_length=self.update_content_length,
@@ -458,45 +1624,295 @@ class DiazoMiddleware(object):
                 doctype=self.doctype,
                 content_type=self.content_type,
                 unquoted_params=self.unquoted_params,
+                response_cache=self.response_cache,
+                compression_level=self.compression_level,
+                compression_min_size=self.compression_min_size,
+                transform_max_size=self.transform_max_size,
+                include_resolver=self.prefetch_includes and self.include_resolver or None,
+                prefetch_pool=self.prefetch_pool,
+                metrics=self.metrics,
+                server_timing=self.server_timing,
                 **self.params
             )
 
     def get_filter_middleware(self):
-        tree = pkg_parse('filter_xhtml.xsl')
-        return XSLTMiddleware(self.app, self.global_conf,
-                tree=tree,
+        return XPathFilterMiddleware(self.app, self.global_conf,
                 read_network=False,
                 read_file=False,
                 update_content_length=self.update_content_length,
                 ignored_extensions=self.ignored_extensions,
-                environ_param_map={'diazo.filter_xpath': 'xpath'},
-                doctype='',
                 content_type=self.content_type,
-                unquoted_params=['xpath'],
+                compression_level=self.compression_level,
+                compression_min_size=self.compression_min_size,
+                xpath_cache_size=self.filter_xpath_cache_size,
+                metrics=self.metrics,
+                server_timing=self.server_timing,
             )
 
     def __call__(self, environ, start_response):
+        return self.process(self.app, environ, start_response)
+    
+    def transform_response(self, environ, status, headerlist, body):
+        """Theme a response which was produced outside of WSGI, returning a
+        ``(status, headerlist, body)`` tuple. See
+        ``XSLTMiddleware.transform_response``.
+        """
+        return replay_response(self.process, environ, status, headerlist, body)
+    
+    def transform_async(self, environ, status, headerlist, body, callback=None):
+        """Call ``transform_response`` in a thread pool of
+        ``transform_threads`` threads, returning an ``AsyncResult``.
+        ``callback`` is called with the result in the pool thread.
+        """
+        pool = self.transform_pool
+        if pool is None:
+            with self.transform_pool_lock:
+                if self.transform_pool is None:
+                    self.transform_pool = ThreadPool(self.transform_threads)
+                pool = self.transform_pool
+        return pool.apply_async(self.transform_response,
+                                (environ, status, headerlist, body),
+                                callback=callback)
+    
+    def process(self, app, environ, start_response):
+        """Call ``app`` and theme its response
+        """
+        if self.metrics_path and environ.get('PATH_INFO') == self.metrics_path:
+            response = Response(self.metrics.prometheus(),
+                                content_type='text/plain; version=0.0.4',
+                                charset='utf-8')
+            response.cache_control = 'no-cache'
+            return response(environ, start_response)
+        
         if self.filter_xpath:
             filter_xpath = ';filter_xpath='
             query_string = environ.get('QUERY_STRING', '')
             if filter_xpath in query_string:
                 environ['QUERY_STRING'], xpath = query_string.rsplit(filter_xpath, 1)
                 environ['diazo.filter_xpath'] = unquote_plus(xpath)
-                return self.filter_middleware(environ, start_response)
+                return self.filter_middleware.process(app, environ, start_response)
         
-        transform_middleware = self.transform_middleware
-        if transform_middleware is None or self.debug:
-            transform_middleware = self.get_transform_middleware()
-        if transform_middleware is not None and not self.debug:
-            self.transform_middleware = transform_middleware
+        transform_middleware = self.get_current_middleware()
         
         # Set up variables, some of which are used as transform parameters
         request = Request(environ)
         
         environ['diazo.rules'] = self.rules
-        environ['diazo.absolute_prefix'] = self.absolute_prefix
+        if self.runtime_prefix:
+            environ.setdefault('diazo.absolute_prefix', self.absolute_prefix)
+        else:
+            environ['diazo.absolute_prefix'] = self.absolute_prefix
         environ['diazo.path'] = request.path
         environ['diazo.host'] = request.host
         environ['diazo.scheme'] = request.host
             
-        return transform_middleware(environ, start_response)
+        return transform_middleware.process(app, environ, start_response)
+
+def tenant_from_host(environ):
+    """Return the host name of the request, without the port, as the tenant
+    name.
+    """
+    return Request(environ).host.split(':', 1)[0].lower()
+
+def tenant_from_path(environ):
+    """Return the first segment of the request path as the tenant name.
+    """
+    segments = environ.get('PATH_INFO', '').lstrip('/').split('/', 1)
+    return segments[0] or None
+
+TENANT_SELECTORS = {
+    'host': tenant_from_host,
+    'path': tenant_from_path,
+    }
+
+def read_tenants(filename):
+    """Read the tenants of a ``ThemeRegistryMiddleware`` from an ini file,
+    with a section for each tenant whose keys are ``DiazoMiddleware``
+    options, e.g:
+    
+        [example.com]
+        rules = example/rules.xml
+        prefix = /static
+    
+    Relative ``rules`` and ``theme`` paths are resolved against the directory
+    of the file.
+    """
+    config = ConfigParser.RawConfigParser()
+    if not config.read([filename]):
+        raise IOError("Could not read tenants file '%s'" % filename)
+    base = os.path.dirname(os.path.abspath(filename))
+    tenants = {}
+    for section in config.sections():
+        options = dict(config.items(section))
+        for name in ('rules', 'theme'):
+            value = options.get(name)
+            if value and '://' not in value:
+                options[name] = os.path.join(base, value)
+        tenants[section] = options
+    return tenants
+
+class ThemeRegistryMiddleware(object):
+    """Apply one of many Diazo themes, chosen for each request
+    """
+    
+    def __init__(self, app, global_conf, tenants,
+                 select='host',
+                 max_tenants=1000,
+                 max_memory=None,
+                 **options
+    ):
+        """Create the middleware. The parameters are:
+        
+        * ``tenants``, a dict of tenant names to the ``DiazoMiddleware``
+          options for the tenant, or the name of an ini file read by
+          ``read_tenants``. The options must include ``rules``.
+        * ``select``, a function called with the environ which returns the
+          name of the tenant for the request, or 'host' or 'path' to use
+          ``tenant_from_host`` or ``tenant_from_path``. Requests for unknown
+          tenants are not themed.
+        * ``max_tenants``, the number of compiled themes kept in memory.
+        * ``max_memory``, can be set to a size in bytes to limit the
+          estimated memory used by the compiled themes kept in memory (see
+          ``estimate_size``). A theme estimated to be larger than this is
+          kept in memory on its own, with a warning.
+        
+        The least recently used themes are discarded and compiled again when
+        next requested. Additional keyword arguments are used as defaults for
+        the options of each tenant. The tenants share the thread pools used
+        to prefetch includes and for ``transform_async``, so discarding a
+        theme leaves no threads behind.
+        """
+        self.app = app
+        self.global_conf = global_conf
+        if isinstance(tenants, basestring):
+            tenants = read_tenants(tenants)
+        self.tenants = tenants
+        if isinstance(select, basestring):
+            select = TENANT_SELECTORS[select]
+        self.select = select
+        if max_memory is not None:
+            max_memory = int(max_memory)
+        self.max_memory = max_memory
+        self.middlewares = LRUCache(maxsize=int(max_tenants), maxbytes=max_memory)
+        self.options = options
+        self.pools = {}
+        self.pools_lock = threading.Lock()
+        self.locks = {}
+        self.tenant_stats = {}
+        self.stats_lock = threading.Lock()
+    
+    def get_middleware(self, name):
+        """Return the ``DiazoMiddleware`` for the tenant, compiling its theme
+        if it is not in memory.
+        """
+        middleware = self.middlewares.get(name)
+        if middleware is None:
+            lock = self.locks.setdefault(name, threading.Lock())
+            lock.acquire()
+            try:
+                middleware = self.middlewares.get(name)
+                if middleware is None:
+                    middleware = self.create_middleware(name)
+                    return middleware
+            finally:
+                lock.release()
+        self.record(name, hits=1)
+        # Threads serving requests create copies of the stylesheet
+        transform_middleware = middleware.transform_middleware
+        if transform_middleware is not None and \
+                transform_middleware.transform_count != self.tenant_stats[name]['transforms']:
+            self.store(name, middleware)
+        return middleware
+    
+    def shared_pool(self, name, threads):
+        """Return the thread pool called name shared by the tenants, creating
+        it with the given number of threads the first time
+        """
+        self.pools_lock.acquire()
+        try:
+            pool = self.pools.get(name)
+            if pool is None:
+                pool = self.pools[name] = ThreadPool(int(threads))
+            return pool
+        finally:
+            self.pools_lock.release()
+    
+    def create_middleware(self, name):
+        """Create the middleware for the tenant and compile its theme
+        """
+        options = self.options.copy()
+        options.update(self.tenants[name])
+        options['eager_compile'] = True
+        options.pop('background_compile', None)
+        if asbool(options.get('prefetch_includes', False)):
+            options['prefetch_pool'] = self.shared_pool('prefetch', options.get('prefetch_threads', 4))
+        options['transform_pool'] = self.shared_pool('transform', options.get('transform_threads', 4))
+        start = time.time()
+        middleware = DiazoMiddleware(self.app, self.global_conf, **options)
+        self.record(name, compiles=1, compile_time=time.time() - start)
+        self.store(name, middleware)
+        return middleware
+    
+    def store(self, name, middleware):
+        """Keep the middleware for the tenant in memory, with its estimated
+        size
+        """
+        size = self.estimate_size(middleware)
+        stored_size = size
+        if self.max_memory is not None and size > self.max_memory:
+            logger.warning("The theme of tenant %s is estimated to use %d bytes, more than "
+                           "max_memory, it is kept in memory on its own" % (name, size))
+            stored_size = self.max_memory
+        self.middlewares.set(name, middleware, stored_size)
+        self.record(name, size=size, transforms=middleware.transform_middleware.transform_count)
+    
+    def estimate_size(self, middleware):
+        """Estimate the memory used by the compiled theme of the middleware.
+        The memory used by a compiled stylesheet is not known, so the size
+        of the serialized stylesheet is counted once for the stylesheet
+        document and again for each XSLT transform created for it, as every
+        thread applying the theme has its own copy.
+        """
+        transform_middleware = middleware.transform_middleware
+        return len(etree.tostring(transform_middleware.tree)) * (1 + transform_middleware.transform_count)
+    
+    def record(self, name, hits=0, compiles=0, compile_time=0.0, size=None, transforms=None):
+        self.stats_lock.acquire()
+        try:
+            stats = self.tenant_stats.get(name)
+            if stats is None:
+                stats = self.tenant_stats[name] = dict(hits=0, compiles=0, compile_time=0.0, size=0,
+                                                       transforms=0)
+            stats['hits'] += hits
+            stats['compiles'] += compiles
+            stats['compile_time'] += compile_time
+            if size is not None:
+                stats['size'] = size
+            if transforms is not None:
+                stats['transforms'] = transforms
+        finally:
+            self.stats_lock.release()
+    
+    def stats(self):
+        """Return a dict of tenant names to their statistics: the number of
+        requests served by an already compiled theme (``hits``), the number
+        of times the theme was compiled (``compiles``), the total seconds
+        spent compiling (``compile_time``), the estimated size of the
+        compiled theme (``size``), the number of XSLT transforms created for
+        it (``transforms``) and whether it is in memory (``loaded``).
+        """
+        self.stats_lock.acquire()
+        try:
+            result = {}
+            for name, stats in self.tenant_stats.items():
+                result[name] = dict(stats, loaded=name in self.middlewares)
+            return result
+        finally:
+            self.stats_lock.release()
+    
+    def __call__(self, environ, start_response):
+        name = self.select(environ)
+        if name not in self.tenants:
+            return self.app(environ, start_response)
+        environ['diazo.tenant'] = name
+        return self.get_middleware(name)(environ, start_response)
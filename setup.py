@@ -33,9 +33,11 @@ development, check it into Subversion, and not touch Diazo during deployment.'''
         diazocompiler = diazo.compiler:main
         diazorun = diazo.run:main
         diazopreprocessor = diazo.rules:main
+        diazobatch = diazo.batch:main
         
         [paste.filter_app_factory]
         xslt = diazo.wsgi:XSLTMiddleware
         main = diazo.wsgi:DiazoMiddleware
+        registry = diazo.wsgi:ThemeRegistryMiddleware
         """,
     )